@@ -0,0 +1,52 @@
+"""Time from start() to the first discovered peer, with and without the peer cache.
+
+Needs working multicast (mDNS) on the host. Run from the repository root:
+    python -m benchmarks.bench_discovery --peers 3
+"""
+import argparse
+import time
+from src.core.network import NetworkManager
+from src.core.peers import PeerCache
+from src.core.security import SecurityManager
+
+def wait_for_peer(nm, timeout):
+    deadline = time.monotonic() + timeout
+    while nm.first_peer_after is None and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return nm.first_peer_after
+
+def main():
+    parser = argparse.ArgumentParser(description="Peer discovery startup benchmark")
+    parser.add_argument('--peers', type=int, default=3, help="Peers already on the network")
+    parser.add_argument('--timeout', type=float, default=15.0)
+    args = parser.parse_args()
+
+    others = [NetworkManager(SecurityManager(None), f"peer{i}") for i in range(args.peers)]
+    for nm in others:
+        nm.start(lambda msg: None)
+    cache = PeerCache()
+    try:
+        # A cold start learns about everyone through mDNS and fills the cache
+        cold = NetworkManager(SecurityManager(None), "bench", peer_cache=cache)
+        cold.start(lambda msg: None)
+        cold_time = wait_for_peer(cold, args.timeout)
+        deadline = time.monotonic() + args.timeout
+        while len(cold.peers) < args.peers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        cold.stop()
+
+        # A restart with the same cache can reach them before browsing answers
+        warm = NetworkManager(SecurityManager(None), "bench", peer_cache=cache)
+        warm.start(lambda msg: None)
+        warm_time = wait_for_peer(warm, args.timeout)
+        warm.stop()
+    finally:
+        for nm in others:
+            nm.stop()
+
+    for label, seconds in (("cold (mDNS)", cold_time), ("warm (cache)", warm_time)):
+        result = f"{seconds * 1000:.1f} ms" if seconds is not None else "no peer found"
+        print(f"{label:>13}: time to first peer {result}")
+
+if __name__ == "__main__":
+    main()
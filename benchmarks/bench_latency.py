@@ -0,0 +1,69 @@
+"""Chat latency (p50/p99) and messages/sec, sending each message at once vs coalescing.
+
+Run from the repository root:  python -m benchmarks.bench_latency --count 20000 --window-ms 5
+"""
+import argparse
+import threading
+import time
+from src.core.network import NetworkManager
+from src.core.security import SecurityManager
+from src.core.inbound import InboundLimiter
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run(window, count, interval, password, engine="threads"):
+    # Every message comes from one loopback address, so per-peer limits would measure the throttle
+    limiter = InboundLimiter(max_peer_connections=None, peer_rate=None)
+    receiver = NetworkManager(SecurityManager(password), "receiver", engine=engine, limiter=limiter)
+    sender = NetworkManager(SecurityManager(password), "sender", engine=engine, coalesce=window)
+    # Discovery is off, so introduce the receiver the way mDNS would
+    sender.peers.add("receiver", {'address': '127.0.0.1', 'port': receiver.port, 'id': receiver.my_id,
+                                  'username': "receiver", 'wire': 'bin1', 'codecs': set(), 'batch': True,
+                                  'multi': True})
+    latencies = []
+    done = threading.Event()
+
+    def on_message(msg):
+        latencies.append(time.perf_counter() - float(msg['content']))
+        if len(latencies) == count:
+            done.set()
+
+    receiver.start(on_message, discovery=False)
+    sender.start(lambda msg: None, discovery=False)
+    try:
+        start = time.perf_counter()
+        for _ in range(count):
+            # Arrivals are counted at the receiver, so don't block on each batch being written
+            sender.send_message('127.0.0.1', receiver.port, content=repr(time.perf_counter()), wait=False)
+            if interval:
+                time.sleep(interval)
+        done.wait(60)
+        elapsed = time.perf_counter() - start
+    finally:
+        sender.stop()
+        receiver.stop()
+    return latencies, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat latency and coalescing benchmark")
+    parser.add_argument('--count', type=int, default=20000, help="Messages in the burst workload")
+    parser.add_argument('--paced', type=int, default=200, help="Messages in the paced workload")
+    parser.add_argument('--interval-ms', type=float, default=20, help="Gap between paced messages")
+    parser.add_argument('--window-ms', type=float, default=5, help="Coalescing window")
+    parser.add_argument('--password', default="bench")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    args = parser.parse_args()
+
+    workloads = (("burst", args.count, 0.0), ("paced", args.paced, args.interval_ms / 1000))
+    for workload, count, interval in workloads:
+        for label, window in (("immediate", 0.0), ("coalesced", args.window_ms / 1000)):
+            latencies, elapsed = run(window, count, interval, args.password, args.engine)
+            status = "" if len(latencies) == count else f" ({len(latencies)}/{count} received)"
+            p50 = percentile(latencies, 0.50) * 1000
+            p99 = percentile(latencies, 0.99) * 1000
+            print(f"{workload:>5} {label:>9}: {len(latencies) / elapsed:>9,.0f} msgs/sec   p50 {p50:7.2f} ms   p99 {p99:7.2f} ms{status}")
+
+if __name__ == "__main__":
+    main()
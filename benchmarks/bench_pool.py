@@ -0,0 +1,58 @@
+"""Loopback messages/sec with and without the persistent connection pool.
+
+Run from the repository root:  python -m benchmarks.bench_pool --count 5000
+"""
+import argparse
+import threading
+import time
+from src.core.network import NetworkManager
+from src.core.security import SecurityManager
+from src.core.inbound import InboundLimiter
+
+def run(pooled, count, password, engine="threads"):
+    # Every message comes from one loopback address, so per-peer limits would measure the throttle
+    limiter = InboundLimiter(max_peer_connections=None, peer_rate=None)
+    receiver = NetworkManager(SecurityManager(password), "receiver", engine=engine, limiter=limiter)
+    sender = NetworkManager(SecurityManager(password), "sender", pooled=pooled, engine=engine)
+    # Discovery is off, so introduce the receiver the way mDNS would; only such peers are pooled
+    sender.peers.add("receiver", {'address': '127.0.0.1', 'port': receiver.port, 'id': receiver.my_id,
+                                  'username': "receiver", 'wire': 'bin1', 'codecs': set(), 'multi': True})
+    done = threading.Event()
+    received = [0]
+    lock = threading.Lock()
+
+    def on_message(msg):
+        # Called from several decode workers at once
+        with lock:
+            received[0] += 1
+            if received[0] == count:
+                done.set()
+
+    receiver.start(on_message, discovery=False)
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            sender.send_message('127.0.0.1', receiver.port, content=f"message {i}")
+        done.wait(60)
+        elapsed = time.perf_counter() - start
+    finally:
+        sender.stop()
+        receiver.stop()
+    return received[0], elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Connection pool benchmark")
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--password', default="bench")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    args = parser.parse_args()
+
+    # The asyncio engine always keeps persistent connections
+    modes = (True,) if args.engine == 'asyncio' else (False, True)
+    for pooled in modes:
+        received, elapsed = run(pooled, args.count, args.password, args.engine)
+        label = "pooled" if pooled else "one-shot"
+        print(f"{label:>9}: {received}/{args.count} msgs in {elapsed:.2f}s -> {received / elapsed:,.0f} msgs/sec")
+
+if __name__ == "__main__":
+    main()
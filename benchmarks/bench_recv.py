@@ -0,0 +1,56 @@
+"""Microbenchmark of NetworkManager._recv_all against the old concatenating reader.
+
+Run from the repository root:  python -m benchmarks.bench_recv
+"""
+import argparse
+import socket
+import threading
+import time
+from src.core.network import NetworkManager
+from src.core.security import SecurityManager
+
+SIZES = {"1KB": 1024, "1MB": 1024 * 1024, "100MB": 100 * 1024 * 1024}
+
+def legacy_recv_all(sock, count):
+    buf = b''
+    while count:
+        newbuf = sock.recv(count)
+        if not newbuf: return None
+        buf += newbuf
+        count -= len(newbuf)
+    return buf
+
+def time_recv(recv, size, repeat):
+    payload = b'\x00' * size
+    best = float('inf')
+    for _ in range(repeat):
+        a, b = socket.socketpair()
+        writer = threading.Thread(target=a.sendall, args=(payload,))
+        start = time.perf_counter()
+        writer.start()
+        data = recv(b, size)
+        elapsed = time.perf_counter() - start
+        writer.join()
+        a.close()
+        b.close()
+        assert len(data) == size
+        best = min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive path benchmark")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    nm = NetworkManager(SecurityManager(), "bench")
+    try:
+        for label, size in SIZES.items():
+            repeat = args.repeat if size < SIZES["100MB"] else max(1, args.repeat // 2)
+            old = time_recv(legacy_recv_all, size, repeat)
+            new = time_recv(nm._recv_all, size, repeat)
+            print(f"{label:>6}: legacy {old * 1000:9.2f} ms   recv_into {new * 1000:9.2f} ms   ({old / new:.1f}x)")
+    finally:
+        nm.stop()
+
+if __name__ == "__main__":
+    main()
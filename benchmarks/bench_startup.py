@@ -0,0 +1,123 @@
+"""Startup cost: time to the CLI prompt and the GUI window, and what importing the app pulls in.
+
+Run from the repository root:  python -m benchmarks.bench_startup
+With --check it exits non-zero when a startup target is missed or a heavy
+dependency is imported eagerly again, so it can guard against regressions.
+The GUI is only timed where customtkinter is installed and a display is
+available; otherwise that measurement is reported as skipped.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+
+TARGET_PROMPT_MS = 250 # Time from launching `main.py cli` to its prompt
+TARGET_WINDOW_MS = 1000 # Time from launching the GUI to its main window being drawn
+TARGET_IMPORT_MS = 100 # Cumulative import time of each entry module
+# Only needed once the network starts (or a password is set), so never at import time
+DEFERRED = ('zeroconf', 'cryptography', 'asyncio', 'netifaces', 'lz4', 'customtkinter')
+ENTRY_MODULES = ('main', 'src.cli.main')
+WINDOW_READY = b'window-ready'
+# Builds the app as `main.py gui --name bench` does (a name skips the login dialog),
+# reports once the event loop has drawn the window, then closes it
+GUI_PROBE = """
+from src.gui.app import App
+app = App(None, 'bench')
+def ready():
+    print('window-ready', flush=True)
+    app.on_closing()
+app.after_idle(ready)
+app.mainloop()
+"""
+
+def import_times(module, runs=1):
+    """{module: best cumulative microseconds} from `python -X importtime -c "import module"`."""
+    times = {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                name = name.strip()
+                times[name] = min(times.get(name, int(cumulative)), int(cumulative))
+    return times
+
+def time_to_prompt(runs):
+    """Best wall time from spawning `main.py cli` to its prompt appearing."""
+    best = float('inf')
+    prompt = b'(bench) '
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, 'main.py', 'cli', '--name', 'bench'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = b''
+        while prompt not in output:
+            chunk = os.read(proc.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError(f"CLI exited before showing its prompt: {output!r}")
+            output += chunk
+        best = min(best, time.perf_counter() - start)
+        proc.communicate(b'exit\n', timeout=30)
+    return best
+
+def time_to_window(runs):
+    """Best wall time from spawning the GUI to its window being drawn; None if it can't run here."""
+    if importlib.util.find_spec('customtkinter') is None:
+        return None
+    if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        return None
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-c', GUI_PROBE], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        line = proc.stdout.readline()
+        elapsed = time.perf_counter() - start
+        proc.communicate(timeout=30)
+        if WINDOW_READY not in line:
+            raise RuntimeError(f"GUI exited before showing its window (status {proc.returncode})")
+        best = min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--check', action='store_true', help="Fail if a target is missed")
+    args = parser.parse_args()
+
+    failures = []
+    for module in ENTRY_MODULES:
+        times = import_times(module, args.runs)
+        total = times.get(module, 0) / 1000
+        eager = sorted(name for name in times if name.split('.')[0] in DEFERRED and '.' not in name)
+        print(f"import {module}: {total:.1f} ms" + (f", eagerly imports {', '.join(eager)}" if eager else ""))
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager)} at import time")
+        if total > TARGET_IMPORT_MS:
+            failures.append(f"importing {module} took {total:.1f} ms (target {TARGET_IMPORT_MS} ms)")
+
+    prompt_ms = time_to_prompt(args.runs) * 1000
+    print(f"time to CLI prompt: {prompt_ms:.0f} ms (target {TARGET_PROMPT_MS} ms)")
+    if prompt_ms > TARGET_PROMPT_MS:
+        failures.append(f"CLI prompt took {prompt_ms:.0f} ms (target {TARGET_PROMPT_MS} ms)")
+
+    window = time_to_window(args.runs)
+    if window is None:
+        print("time to GUI window: skipped (needs customtkinter and a display)")
+    else:
+        window_ms = window * 1000
+        print(f"time to GUI window: {window_ms:.0f} ms (target {TARGET_WINDOW_MS} ms)")
+        if window_ms > TARGET_WINDOW_MS:
+            failures.append(f"GUI window took {window_ms:.0f} ms (target {TARGET_WINDOW_MS} ms)")
+
+    if args.check and failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""The whole messaging and transfer pipeline in one run, saved as JSON for comparison.
+
+Two NetworkManagers talk over loopback with discovery off. The suite measures
+chat messages/sec and p50/p99 delivery latency, file transfer MB/s at several
+sizes, SecurityManager encrypt/decrypt throughput and peak RSS. Each
+measurement is the median of --repeat runs. Latency is taken from paced
+messages, so it shows the pipeline's cost rather than queueing in a burst.
+
+Run from the repository root:
+    python -m benchmarks.bench_suite --output baseline.json
+    python -m benchmarks.bench_suite --compare baseline.json
+
+With --compare, metrics that got worse by more than --tolerance percent are
+flagged and the exit status is 1.
+"""
+import sys
+# The suite must never announce itself on the LAN; any zeroconf import fails loudly
+sys.modules['zeroconf'] = None
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+from src.core.security import SecurityManager
+from benchmarks.bench_latency import run as run_chat, percentile
+from benchmarks.bench_streams import run as run_file
+
+SEED = 2024 # Payloads are the same from run to run
+CRYPTO_SIZES = {'1KB': 1024, '64KB': 64 * 1024, '1MB': 1024 * 1024}
+CRYPTO_BYTES = 64 * 1024 * 1024 # Encrypted per payload size and direction
+PACED_INTERVAL = 0.005 # Seconds between messages in the latency run
+# Metrics with these suffixes are better when lower; the rest when higher
+LOWER_IS_BETTER = ('_ms', '_rss_mb')
+
+def median_of(repeat, func):
+    """Median of each key across `repeat` calls of func() -> {name: value}."""
+    runs = [func() for _ in range(repeat)]
+    return {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+
+def bench_chat(count, paced, engine, password):
+    def once():
+        # Throughput from a burst; latency from paced messages, which don't queue behind each other
+        latencies, elapsed = run_chat(0.0, count, 0.0, password, engine)
+        if len(latencies) < count:
+            raise RuntimeError(f"Only {len(latencies)}/{count} chat messages arrived")
+        results = {'msgs_per_sec': count / elapsed}
+        latencies, _ = run_chat(0.0, paced, PACED_INTERVAL, password, engine)
+        if len(latencies) < paced:
+            raise RuntimeError(f"Only {len(latencies)}/{paced} paced chat messages arrived")
+        results['p50_ms'] = percentile(latencies, 0.50) * 1000
+        results['p99_ms'] = percentile(latencies, 0.99) * 1000
+        return results
+    return once
+
+def bench_file(path, size_mb, engine, password):
+    def once():
+        ok, elapsed = run_file(path, 1, password, engine)
+        if not ok:
+            raise RuntimeError(f"{size_mb} MB file transfer failed")
+        return {'mb_per_sec': size_mb / elapsed}
+    return once
+
+def bench_crypto(password):
+    security = SecurityManager(password)
+
+    def once():
+        rng = random.Random(SEED)
+        results = {}
+        for label, size in CRYPTO_SIZES.items():
+            data = rng.randbytes(size)
+            iterations = max(1, CRYPTO_BYTES // size)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                ciphertext = security.encrypt(data)
+            encrypt = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(iterations):
+                security.decrypt(ciphertext)
+            decrypt = time.perf_counter() - start
+            mb = iterations * size / (1024 * 1024)
+            results[f'encrypt_{label}_mb_per_sec'] = mb / encrypt
+            results[f'decrypt_{label}_mb_per_sec'] = mb / decrypt
+        return results
+    return once
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(args):
+    results = {}
+
+    def record(prefix, values):
+        for name, value in values.items():
+            results[f"{prefix}.{name}"] = value
+            print(f"  {prefix}.{name}: {value:,.2f}")
+
+    print(f"chat ({args.count} in a burst, {args.paced} paced, {args.engine})")
+    record('chat', median_of(args.repeat, bench_chat(args.count, args.paced, args.engine, args.password)))
+
+    print("file transfer")
+    rng = random.Random(SEED)
+    for size_mb in args.file_sizes:
+        fd, path = tempfile.mkstemp(prefix="anonbox-bench-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for _ in range(size_mb):
+                    f.write(rng.randbytes(1024 * 1024))
+            record(f'file_{size_mb}mb', median_of(args.repeat, bench_file(path, size_mb, args.engine, args.password)))
+        finally:
+            os.remove(path)
+
+    print("crypto")
+    record('crypto', median_of(args.repeat, bench_crypto(args.password)))
+
+    results['process.peak_rss_mb'] = peak_rss_mb()
+    print(f"  process.peak_rss_mb: {results['process.peak_rss_mb']:,.1f}")
+
+    meta = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'engine': args.engine, 'count': args.count, 'paced': args.paced, 'file_sizes_mb': args.file_sizes,
+            'repeat': args.repeat, 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+def compare(baseline, current, tolerance):
+    """Prints each metric against the baseline; returns the names that regressed beyond `tolerance` percent."""
+    regressions = []
+    print(f"\n{'metric':<36}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, value in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            print(f"{name:<36}{'-':>14}{value:>14,.2f}")
+            continue
+        change = (value - old) / old * 100
+        worse = -change if name.endswith(LOWER_IS_BETTER) else change
+        flag = "  REGRESSION" if worse < -tolerance else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:<36}{old:>14,.2f}{value:>14,.2f}{change:>+9.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Messaging and transfer benchmark suite")
+    parser.add_argument('--count', type=int, default=5000, help="Chat messages in the throughput burst")
+    parser.add_argument('--paced', type=int, default=400, help="Chat messages in the latency run")
+    parser.add_argument('--file-sizes', type=int, nargs='+', default=[1, 16, 64], help="File sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement; the median is kept")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--password', default="bench")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', help="Compare against a saved JSON result")
+    parser.add_argument('--tolerance', type=float, default=10.0, help="Percent change allowed before flagging (default: 10)")
+    args = parser.parse_args()
+
+    current = run_suite(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"\nSaved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('engine') != current['meta']['engine']:
+            print(f"Note: baseline used the {baseline['meta'].get('engine')} engine")
+        regressions = compare(baseline, current, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:g}%")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""Swarm simulator: many peers in one process, on loopback, with a local stand-in for mDNS.
+
+Each peer is a full NetworkManager. Discovery goes through the real
+PeerListener, fed by LocalMDNS instead of the LAN, so peers find each other
+the way they would over mDNS without sending a packet. For every peer count
+it runs scripted workloads and reports throughput, latency percentiles,
+failure rates, threads and memory per peer.
+
+Run from the repository root:
+    python -m benchmarks.bench_swarm --peers 10 50 100 200
+    python -m benchmarks.bench_swarm --peers 50 --workloads chat churn --engine asyncio
+
+All peers share one loopback address, so per-address inbound limits are off
+(on a LAN each peer has its own address).
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zeroconf import DNSCache
+from src.core.network import NetworkManager, SERVICE_TYPE
+from src.core.discovery import PeerListener, service_info
+from src.core.security import SecurityManager
+from src.core.inbound import InboundLimiter
+
+WORKLOADS = ('chat', 'broadcast', 'files', 'churn')
+SENDER_THREADS = 32 # Peers sending at once in a workload
+SETTLE_TIMEOUT = 30.0 # Seconds to wait for discovery or deliveries to finish
+
+class LocalMDNS:
+    """In-process stand-in for mDNS on a LAN.
+
+    Announced services go into a zeroconf DNSCache, which PeerListener
+    resolves from exactly as it would from a real Zeroconf's cache; joins
+    and leaves are passed to every listener's add_service/remove_service.
+    """
+
+    def __init__(self):
+        self.cache = DNSCache() # PeerListener only needs `.cache` from its zeroconf
+        self._lock = threading.Lock()
+        self._records = {} # service name -> DNS records
+        self._listeners = {} # NetworkManager -> PeerListener
+
+    def join(self, nm):
+        info = service_info(nm, '127.0.0.1')
+        records = [info.dns_pointer(), info.dns_service(), info.dns_text(), *info.dns_addresses()]
+        # One change at a time, so listeners never read the cache mid-update
+        with self._lock:
+            self.cache.async_add_records(records)
+            self._records[info.name] = records
+            listener = PeerListener(nm)
+            for name in self._records:
+                listener.add_service(self, SERVICE_TYPE, name)
+            for other in self._listeners.values():
+                other.add_service(self, SERVICE_TYPE, info.name)
+            self._listeners[nm] = listener
+
+    def leave(self, nm):
+        name = service_info(nm, '127.0.0.1').name
+        with self._lock:
+            self.cache.async_remove_records(self._records.pop(name))
+            self._listeners.pop(nm).close()
+            for other in self._listeners.values():
+                other.remove_service(self, SERVICE_TYPE, name)
+
+class Swarm:
+    """N peers plus the bookkeeping workloads need to count deliveries."""
+
+    def __init__(self, size, engine, password, download_root, relay_fanout=0):
+        self.engine = engine
+        self.relay_fanout = relay_fanout
+        self.password = password
+        self.download_root = download_root
+        self.mdns = LocalMDNS()
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.delivered = 0
+        self.peers = []
+        for i in range(size):
+            self.add_peer(f"peer-{i}")
+
+    def add_peer(self, username):
+        limiter = InboundLimiter(max_peer_connections=None, peer_rate=None)
+        nm = NetworkManager(SecurityManager(self.password), username, engine=self.engine, limiter=limiter,
+                            relay_fanout=self.relay_fanout)
+        nm.download_dir = tempfile.mkdtemp(prefix=f"{username}-", dir=self.download_root)
+        nm.start(self._on_message, discovery=False)
+        self.mdns.join(nm)
+        with self._lock:
+            self.peers.append(nm)
+        return nm
+
+    def remove_peer(self, nm):
+        with self._lock:
+            self.peers.remove(nm)
+        self.mdns.leave(nm)
+        nm.stop()
+
+    def _on_message(self, msg):
+        if msg.get('type') != 'chat':
+            return
+        sent_at = float(msg['content'].rsplit(' ', 1)[-1])
+        with self._lock:
+            self.latencies.append(time.perf_counter() - sent_at)
+            self.delivered += 1
+
+    def reset(self):
+        with self._lock:
+            self.latencies = []
+            self.delivered = 0
+
+    def wait_for(self, condition, timeout=SETTLE_TIMEOUT):
+        """Waits until condition() holds; returns whether it did."""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self):
+        for nm in list(self.peers):
+            nm.stop()
+
+def stamp(label):
+    return f"{label} {time.perf_counter()!r}"
+
+def chat_storm(swarm, args, churn=False):
+    """Every peer sends --messages chat messages, each to a random peer it knows.
+
+    With churn, peers keep sending at --churn-rate until --churn peers have
+    been replaced, one every --churn-interval seconds.
+    """
+    failures = [0]
+    sent = [0]
+    stop_churn = threading.Event()
+    churned = [0]
+
+    def keep_sending(nm, count):
+        if churn:
+            # A sender that was churned out stops with its peer
+            return not stop_churn.is_set() and nm.running
+        return count < args.messages
+
+    def send_all(nm):
+        rng = random.Random(nm.my_id)
+        sent_here = 0
+        while keep_sending(nm, sent_here):
+            sent_here += 1
+            peers = nm.peers.values()
+            if not peers:
+                break
+            peer = rng.choice(peers)
+            ok = nm.send_message(peer['address'], peer['port'], content=stamp("chat"))
+            with swarm._lock:
+                sent[0] += 1
+                failures[0] += not ok
+            if churn:
+                time.sleep(1 / args.churn_rate)
+
+    def churn_loop():
+        # Replace a random peer every interval; messages already on the way to it may fail
+        rng = random.Random(0)
+        while churned[0] < args.churn:
+            time.sleep(args.churn_interval)
+            with swarm._lock:
+                victim = rng.choice(swarm.peers)
+            swarm.remove_peer(victim)
+            swarm.add_peer(f"churn-{churned[0]}")
+            churned[0] += 1
+        stop_churn.set()
+
+    swarm.reset()
+    # Churn senders run until told to stop, so only as many as run at once
+    senders = swarm.peers[:SENDER_THREADS] if churn else list(swarm.peers)
+    churner = threading.Thread(target=churn_loop, daemon=True) if churn else None
+    start = time.perf_counter()
+    if churner:
+        churner.start()
+    with ThreadPoolExecutor(max_workers=SENDER_THREADS) as executor:
+        list(executor.map(send_all, senders))
+    if churner:
+        churner.join()
+    expected = sent[0] - failures[0]
+    swarm.wait_for(lambda: swarm.delivered >= expected, timeout=5.0 if churn else SETTLE_TIMEOUT)
+    elapsed = time.perf_counter() - start
+    result = report(swarm, sent[0], failures[0], elapsed)
+    if churn:
+        result['churned'] = churned[0]
+    return result
+
+def broadcast_fanout(swarm, args):
+    """--broadcasters peers each broadcast --messages messages to everyone they know."""
+    failures = [0]
+    sent = [0]
+    sender_seconds = [0.0] # Time the senders spent inside broadcast()
+
+    def broadcast_all(nm):
+        for _ in range(args.messages):
+            start = time.perf_counter()
+            results = nm.broadcast(stamp("broadcast"))
+            elapsed = time.perf_counter() - start
+            with swarm._lock:
+                sent[0] += len(results)
+                failures[0] += sum(not r['ok'] for r in results.values())
+                sender_seconds[0] += elapsed
+
+    swarm.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=SENDER_THREADS) as executor:
+        list(executor.map(broadcast_all, swarm.peers[:args.broadcasters]))
+    swarm.wait_for(lambda: swarm.delivered >= sent[0] - failures[0])
+    result = report(swarm, sent[0], failures[0], time.perf_counter() - start)
+    broadcasts = min(args.broadcasters, len(swarm.peers)) * args.messages
+    result['sender_ms'] = sender_seconds[0] * 1000 / broadcasts if broadcasts else 0.0
+    return result
+
+def file_shares(swarm, args, path):
+    """--sharers peers each share one file with --file-fanout random peers, all at once."""
+    rng = random.Random(1)
+    jobs = []
+    for nm in swarm.peers[:args.sharers]:
+        others = [item for item in nm.peers.items()]
+        jobs.append((nm, rng.sample(others, min(args.file_fanout, len(others)))))
+
+    def share(job):
+        nm, targets = job
+        return nm.share_file(targets, path)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=SENDER_THREADS) as executor:
+        reports = list(executor.map(share, jobs))
+    elapsed = time.perf_counter() - start
+    outcomes = [r['ok'] for report in reports for r in report.values()]
+    ok = sum(outcomes)
+    return {'sent': len(outcomes), 'failed': len(outcomes) - ok, 'seconds': elapsed,
+            'mb_per_sec': ok * os.path.getsize(path) / (1024 * 1024) / elapsed if elapsed else 0.0}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float('nan')
+
+def report(swarm, sent, failed, elapsed):
+    with swarm._lock:
+        latencies = list(swarm.latencies)
+    lost = max(0, sent - failed - len(latencies))
+    return {'sent': sent, 'failed': failed, 'lost': lost, 'seconds': elapsed,
+            'msgs_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000}
+
+def rss_mb():
+    """Current resident memory; peak memory where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run(size, args, path):
+    download_root = tempfile.mkdtemp(prefix="anonbox-swarm-")
+    rss_before = rss_mb()
+    threads_before = threading.active_count()
+    start = time.perf_counter()
+    swarm = Swarm(size, args.engine, args.password, download_root, args.relay_fanout)
+    try:
+        # Everyone should know everyone else before traffic starts
+        converged = swarm.wait_for(lambda: all(len(nm.peers) == size - 1 for nm in swarm.peers))
+        discovery = time.perf_counter() - start
+        print(f"\n{size} peers: discovery {'converged' if converged else 'INCOMPLETE'} in {discovery * 1000:.0f} ms, "
+              f"{(rss_mb() - rss_before) / size:.2f} MB and {(threading.active_count() - threads_before) / size:.1f} threads per peer")
+
+        for workload in args.workloads:
+            if workload == 'chat':
+                result = chat_storm(swarm, args)
+            elif workload == 'broadcast':
+                result = broadcast_fanout(swarm, args)
+            elif workload == 'files':
+                result = file_shares(swarm, args, path)
+            else:
+                result = chat_storm(swarm, args, churn=True)
+            print_result(workload, result)
+        print(f"  {'after':>9}: {threading.active_count()} threads, {rss_mb():.0f} MB RSS")
+    finally:
+        swarm.stop()
+        shutil.rmtree(download_root, ignore_errors=True)
+
+def print_result(workload, result):
+    sent = result['sent'] or 1
+    line = f"  {workload:>9}: {result['sent']:>7,} sent"
+    if 'msgs_per_sec' in result:
+        line += (f" {result['msgs_per_sec']:>9,.0f} msgs/sec   p50 {result['p50_ms']:7.2f} ms   p99 {result['p99_ms']:8.2f} ms"
+                 f"   failed {result['failed'] / sent:6.2%}   lost {result['lost'] / sent:6.2%}")
+    else:
+        line += f" {result['mb_per_sec']:>9,.1f} MB/s   failed {result['failed'] / sent:6.2%}"
+    if 'sender_ms' in result:
+        line += f"   sender {result['sender_ms']:.2f} ms/broadcast"
+    if 'churned' in result:
+        line += f"   ({result['churned']} peers replaced)"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process swarm simulator")
+    parser.add_argument('--peers', type=int, nargs='+', default=[10, 50, 100], help="Swarm sizes to run")
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--messages', type=int, default=20, help="Messages per sender in chat, churn and broadcast")
+    parser.add_argument('--broadcasters', type=int, default=5, help="Peers broadcasting at once")
+    parser.add_argument('--sharers', type=int, default=5, help="Peers sharing a file at once")
+    parser.add_argument('--file-fanout', type=int, default=3, help="Receivers per shared file")
+    parser.add_argument('--file-kb', type=int, default=1024, help="Size of the shared file")
+    parser.add_argument('--churn', type=int, default=10, help="Peers replaced in the churn workload")
+    parser.add_argument('--churn-interval', type=float, default=0.2, help="Seconds between peer replacements")
+    parser.add_argument('--churn-rate', type=float, default=50, help="Messages/sec per sender during churn")
+    parser.add_argument('--relay-fanout', type=int, default=0, help="Broadcast through a relay tree with this fanout")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--password', default="bench")
+    args = parser.parse_args()
+    # Sends to departed peers are expected here and counted as failures, not logged one by one
+    logging.getLogger("AnonBOX").setLevel(logging.CRITICAL)
+
+    fd, path = tempfile.mkstemp(prefix="anonbox-swarm-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(random.Random(0).randbytes(args.file_kb * 1024))
+        for size in args.peers:
+            run(size, args, path)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
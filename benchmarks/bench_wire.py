@@ -0,0 +1,52 @@
+"""Serialization cost and size of the JSON envelope versus the binary one.
+
+Run from the repository root:  python -m benchmarks.bench_wire
+"""
+import argparse
+import base64
+import os
+import time
+import uuid
+from src.core import protocol
+
+def sample_messages():
+    base = {
+        'sender_id': str(uuid.uuid4()),
+        'sender_name': "Anon-3f2a1c",
+        'type': 'chat',
+        'filename': None,
+        'timestamp': time.time(),
+    }
+    chat = dict(base, content="see you at the usual place in ten minutes")
+    blob = os.urandom(1024 * 1024)
+    # JSON can only carry bytes as text, which is what the old file path did
+    big_json = dict(base, type='file', filename="photo.jpg", content=base64.b64encode(blob).decode('ascii'))
+    big_binary = dict(base, type='file', filename="photo.jpg", content=blob)
+    return {"chat": (chat, chat), "1MB body": (big_json, big_binary)}
+
+def bench(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire format benchmark")
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    for label, (json_msg, binary_msg) in sample_messages().items():
+        iterations = args.iterations if label == "chat" else max(1, args.iterations // 1000)
+        json_data = protocol.encode_json(json_msg)
+        binary_data = protocol.encode_binary(binary_msg)
+        print(f"{label}:")
+        for name, encode, decode, msg, data in (
+            ("json", protocol.encode_json, protocol.decode_json, json_msg, json_data),
+            ("binary", protocol.encode_binary, protocol.decode_binary, binary_msg, binary_data),
+        ):
+            enc = bench(encode, msg, iterations)
+            dec = bench(decode, data, iterations)
+            print(f"  {name:>6}: {len(data):>9} bytes   encode {enc * 1e6:10.2f} us   decode {dec * 1e6:10.2f} us")
+
+if __name__ == "__main__":
+    main()
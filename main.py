@@ -1,22 +1,33 @@
 import sys
 import argparse
-from src.cli.main import run_cli
+import logging
 
 def main():
     parser = argparse.ArgumentParser(description="AnonBOX: P2P Amnesic Chat")
     parser.add_argument('mode', choices=['cli', 'gui'], nargs='?', default='gui', help='Mode to run: cli or gui (default)')
     parser.add_argument('--password', '-p', type=str, help='Vault password for encryption (Optional)')
     parser.add_argument('--name', '-n', type=str, help='Display Name (Optional)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='Network engine (default: threads)')
+    parser.add_argument('--compress', choices=['off', 'auto', 'zlib', 'lz4'], default='off', help='Compress payloads before encryption (default: off)')
+    parser.add_argument('--coalesce', type=float, default=0, metavar='MS', help='Batch chat messages sent within this many ms to the same peer (default: 0, off)')
+    parser.add_argument('--metrics-file', type=str, metavar='PATH', help='Periodically write metrics to this file in Prometheus text format (Optional; includes peer addresses)')
+    parser.add_argument('--relay-fanout', type=int, default=0, metavar='N', help='Broadcast through a relay tree, sending to N peers who pass it on (default: 0, off)')
+    parser.add_argument('--history-mb', type=float, default=16, help='Memory cap for in-RAM message history in MB (default: 16)')
     
     args = parser.parse_args()
+    history_bytes = int(args.history_mb * 1024 * 1024)
+    coalesce = args.coalesce / 1000
+    logging.basicConfig(level=logging.INFO)
     
     if args.mode == 'cli':
-        run_cli(args.password, args.name)
+        # Imported per mode, so each only loads what it needs
+        from src.cli.main import run_cli
+        run_cli(args.password, args.name, args.engine, args.compress, history_bytes, coalesce, args.metrics_file, args.relay_fanout)
     else:
         # GUI Import inside function to avoid dependency issues if just running CLI
         try:
             from src.gui.app import run_gui
-            run_gui(args.password, args.name)
+            run_gui(args.password, args.name, args.engine, args.compress, history_bytes, coalesce, args.metrics_file, args.relay_fanout)
         except ImportError as e:
             print(f"Failed to load GUI: {e}")
             print("Ensure customtkinter is installed or run in CLI mode.")
@@ -1,22 +1,35 @@
 import cmd
 import time
 import threading
-import base64
 import os
-from ..core.network import NetworkManager
+from ..core.network import NetworkManager, MAX_STREAMS
 from ..core.security import SecurityManager
+from ..core.peers import PeerCache
+from ..core.store import MessageStore, MAX_BYTES
+from ..core.metrics import StageProfiler
 
 class AnonCLI(cmd.Cmd):
     intro = 'Welcome to AnonBOX CLI. Type help or ? to list commands.\n'
     prompt = '(anonbox) '
     
-    def __init__(self, password=None, username=None):
+    def __init__(self, password=None, username=None, engine="threads", compression="off", history_bytes=MAX_BYTES, coalesce=0.0, metrics_file=None, relay_fanout=0):
         super().__init__()
         self.security = SecurityManager(password)
-        self.nm = NetworkManager(self.security, username)
-        self.nm.start(self.on_message)
+        self.store = MessageStore(history_bytes)
+        # Outlives the network layer, so `restart` can reach known peers before mDNS answers
+        self.peer_cache = PeerCache()
+        self.options = {'engine': engine, 'compression': compression, 'coalesce': coalesce, 'relay_fanout': relay_fanout}
+        self.metrics_file = metrics_file
+        self.nm = self._start_network(username)
         self.prompt = f"({self.nm.username}) "
 
+    def _start_network(self, username):
+        nm = NetworkManager(self.security, username, peer_cache=self.peer_cache, **self.options)
+        if self.metrics_file:
+            nm.metrics.start_dump(self.metrics_file, logger=nm.logger)
+        nm.start(self.on_message)
+        return nm
+
     def on_message(self, msg):
         sender_id = msg.get('sender_id', 'unknown')[:8]
         sender_name = msg.get('sender_name', sender_id)
@@ -24,23 +37,24 @@ class AnonCLI(cmd.Cmd):
         msg_type = msg.get('type', 'chat')
         
         if msg_type == 'chat':
+            self.store.add(content, msg.get('sender_id'), sender_name)
             print(f"\n[{sender_name}]: {content}\n{self.prompt}", end='', flush=True)
         elif msg_type == 'file':
              filename = msg.get('filename', 'unknown_file')
+             self.store.add(f"sent file: {filename}", msg.get('sender_id'), sender_name, type='file')
              print(f"\n[{sender_name}] sent file: {filename}\n{self.prompt}", end='', flush=True)
-             try:
-                 file_data = base64.b64decode(content)
-                 with open(f"received_{filename}", "wb") as f:
-                     f.write(file_data)
-                 print(f"(Saved as received_{filename})\n{self.prompt}", end='', flush=True)
-             except Exception as e:
-                 print(f"(Error saving file: {e})\n{self.prompt}", end='', flush=True)
+             if msg.get('saved_as'):
+                 print(f"(Saved as {msg['saved_as']})\n{self.prompt}", end='', flush=True)
+             else:
+                 print(f"(Error saving file: {msg.get('error')})\n{self.prompt}", end='', flush=True)
 
     def do_peers(self, arg):
         'List connected peers'
         print("\nConnected Peers:")
+        now = time.monotonic()
         for name, info in self.nm.peers.items():
-            print(f"- {info['username']} ({name}) at {info['address']}:{info['port']}")
+            latency = f", rtt {info['latency'] * 1000:.1f} ms" if info['latency'] is not None else ""
+            print(f"- {info['username']} ({name}) at {info['address']}:{info['port']}, seen {now - info['last_seen']:.0f}s ago{latency}")
         print("")
 
     def do_chat(self, arg):
@@ -56,6 +70,7 @@ class AnonCLI(cmd.Cmd):
         target = self._find_peer(target_id_part)
         if target:
             if self.nm.send_message(target['address'], target['port'], content=message):
+                self.store.add(message, target['id'], target['username'], outgoing=True)
                 print(f"Sent to {target['username']}")
             else:
                 print("Failed to send.")
@@ -63,10 +78,27 @@ class AnonCLI(cmd.Cmd):
             print("Peer not found.")
 
     def do_share(self, arg):
-        'Send a file: share <peer_id> <filename>'
+        'Send a file: share [--streams N] <peer_id> <filename> (N is at most 16)'
+        streams = 1
+        if arg.startswith('--streams'):
+            # Parallel connections help large files saturate fast links
+            option = arg.split(' ', 2)
+            try:
+                streams = int(option[1])
+                if streams < 1:
+                    raise ValueError
+            except (IndexError, ValueError):
+                print("--streams needs a positive number.")
+                return
+            if streams > MAX_STREAMS:
+                # More would run into the receiver's per-peer connection limit
+                print(f"Using the maximum of {MAX_STREAMS} streams.")
+                streams = MAX_STREAMS
+            arg = option[2] if len(option) > 2 else ''
+
         parts = arg.split(' ', 1)
         if len(parts) < 2:
-            print("Usage: share <peer_id> <filename>")
+            print("Usage: share [--streams N] <peer_id> <filename>")
             return
             
         target_id_part = parts[0]
@@ -78,30 +110,163 @@ class AnonCLI(cmd.Cmd):
 
         target = self._find_peer(target_id_part)
         if target:
-            try:
-                with open(filename, "rb") as f:
-                    file_data = f.read()
-                
-                print(f"Reading file ({len(file_data)} bytes)...")
-                encoded_data = base64.b64encode(file_data).decode('utf-8')
-                short_name = os.path.basename(filename)
-                
-                if self.nm.send_message(target['address'], target['port'], message_type='file', content=encoded_data, filename=short_name):
-                    print(f"Sent file '{short_name}' to {target['username']}")
-                else:
-                    print("Failed to send file.")
-            except Exception as e:
-                print(f"Error processing file: {e}")
+            short_name = os.path.basename(filename)
+            print(f"Sending file ({os.path.getsize(filename)} bytes)...")
+            if self.nm.send_file(target['address'], target['port'], filename, streams=streams):
+                self.store.add(f"sent file: {short_name}", target['id'], target['username'], type='file', outgoing=True)
+                print(f"Sent file '{short_name}' to {target['username']}")
+            else:
+                print("Failed to send file.")
         else:
             print("Peer not found.")
 
+    def do_share_all(self, arg):
+        'Send a file to every peer, encrypting it once: share-all <filename>'
+        filename = arg.strip()
+        if not filename:
+            print("Usage: share-all <filename>")
+            return
+
+        if not os.path.exists(filename):
+            print("File not found.")
+            return
+
+        peers = list(self.nm.peers.items())
+        if not peers:
+            print("No peers to share with.")
+            return
+
+        print(f"Sending file ({os.path.getsize(filename)} bytes) to {len(peers)} peers...")
+        self._print_delivery(self.nm.share_file(peers, filename), "File")
+
     def do_broadcast(self, arg):
         'Broadcast a message to all peers: broadcast <message>'
         if not arg:
              print("Usage: broadcast <message>")
              return
-        self.nm.broadcast(arg)
-        print("Broadcast sent.")
+        results = self.nm.broadcast(arg)
+        if not results:
+            print("No peers to broadcast to.")
+            return
+        self.store.add(arg, None, "broadcast", outgoing=True)
+        self._print_delivery(results, "Broadcast")
+
+    def do_history(self, arg):
+        'Show recent messages, optionally with one peer: history [peer_id] [count]'
+        parts = arg.split()
+        limit = 20
+        if parts and parts[-1].isdigit():
+            limit = int(parts.pop())
+        peer_id = None
+        if parts:
+            # Peers that have left can still be named by their full id
+            target = self._find_peer(parts[0])
+            peer_id = target['id'] if target else parts[0]
+        self._print_messages(self.store.history(peer_id, limit))
+
+    def do_search(self, arg):
+        'Search message history (keyword or substring, case-insensitive): search <text>'
+        query = arg.strip()
+        if not query:
+            print("Usage: search <text>")
+            return
+        self._print_messages(self.store.search(query))
+
+    def _print_messages(self, messages):
+        if not messages:
+            print("No messages.")
+            return
+        for m in messages:
+            stamp = time.strftime('%H:%M:%S', time.localtime(m.timestamp))
+            who = f"Me -> {m.sender_name}" if m.outgoing else m.sender_name
+            print(f"{stamp} [{who}]: {m.text}")
+
+    def do_compress(self, arg):
+        'Show or set payload compression: compress [off|auto|zlib|lz4]'
+        if arg:
+            try:
+                self.nm.compressor.set_codec(arg.strip())
+            except ValueError as e:
+                print(e)
+                return
+        print(f"Compression: {self.nm.compressor.name}")
+
+    def do_stats(self, arg):
+        'Show network statistics'
+        stats = self.nm.stats()
+        d = stats['discovery']
+        print("\nDiscovery:")
+        print(f"- peers: {d['peers']}")
+        first = f"{d['first_peer_after'] * 1000:.0f} ms after start" if d['first_peer_after'] is not None else "not yet"
+        print(f"- first peer: {first}")
+        i = stats['inbound']
+        dropped = i['dropped']
+        print("\nInbound:")
+        print(f"- connections: {i['connections']} open, {i['accepted']} accepted")
+        print(f"- decode queue: {i['queue_depth']} waiting, {i['decode_workers']} workers, {i['inflight_bytes']} bytes in flight")
+        print(f"- throttled: {i['throttled']} frames")
+        print(f"- dropped: {dropped['connections']} connections refused, {dropped['queue']} shed on a full queue, {dropped['memory']} over the memory budget")
+        if 'coalescing' in stats:
+            b = stats['coalescing']
+            print("\nCoalescing:")
+            print(f"- window: {b['window_ms']:.1f} ms")
+            print(f"- sent at once: {b['immediate']}, in batches: {b['batched']} ({b['batches']} frames)")
+        r = stats['relay']
+        if r['fanout'] or r['forwarded']:
+            print("\nRelay:")
+            print(f"- fanout: {r['fanout'] or 'off'} (broadcasts sent: {r['originated']})")
+            print(f"- forwarded: {r['forwarded']}, duplicates dropped: {r['duplicates']}, unreachable: {r['lost']}")
+        c = stats['compression']
+        print("\nCompression:")
+        print(f"- codec: {self.nm.compressor.name}")
+        print(f"- payloads: {c['messages']} ({c['compressed']} compressed, {c['skipped']} sent as-is)")
+        print(f"- bytes: {c['bytes_in']} -> {c['bytes_out']} (ratio {c['ratio']:.2f})")
+        print(f"- time: {c['ms_per_message']:.3f} ms per payload")
+        m = stats['metrics']
+        print("\nStages (p50 / p99 are bucket upper bounds):")
+        for stage, s in m['stages'].items():
+            if s['count']:
+                print(f"- {stage:<9} {s['count']:>8} x  mean {s['mean'] * 1e6:9.1f} us  p50 {s['p50'] * 1e6:9.1f} us  p99 {s['p99'] * 1e6:9.1f} us")
+        g = m['gauges']
+        print(f"\nThreads: {g['threads']}, outbound connections: {g['outbound_connections']}")
+        if m['events']:
+            print("Discovery events: " + ", ".join(f"{k} {v}" for k, v in sorted(m['events'].items())))
+        if m['peers']:
+            print("\nBytes per peer:")
+            for address, b in sorted(m['peers'].items()):
+                print(f"- {address}: {b['in']} in, {b['out']} out")
+        print("")
+
+    def do_profile(self, arg):
+        'Sample which network stage uses the CPU: profile [seconds] (default 10)'
+        try:
+            seconds = float(arg) if arg.strip() else 10.0
+        except ValueError:
+            print("Usage: profile [seconds]")
+            return
+        profiler = StageProfiler()
+        print(f"Profiling for {seconds:g}s...")
+        profiler.start()
+        try:
+            time.sleep(seconds)
+        finally:
+            profiler.stop()
+        unit = "s CPU" if profiler.exact else " samples"
+        for stage, used, share in profiler.report():
+            amount = f"{used:.3f}" if profiler.exact else f"{used}"
+            print(f"- {stage:<13} {amount}{unit} ({share:.0%})")
+        if not profiler.cpu:
+            print("No activity sampled.")
+
+    def do_restart(self, arg):
+        'Restart networking, e.g. after switching networks; recently seen peers are tried straight away'
+        print("Restarting network...")
+        old = self.nm
+        # The old registry empties as it stops; that mustn't clear the cache
+        old.peers.unsubscribe(self.peer_cache.on_peer_event)
+        old.stop()
+        self.nm = self._start_network(old.username)
+        print(f"Listening on port {self.nm.port}.")
 
     def do_exit(self, arg):
         'Exit the application'
@@ -109,24 +274,37 @@ class AnonCLI(cmd.Cmd):
         self.nm.stop()
         return True
 
+    def precmd(self, line):
+        # cmd only maps identifier characters to do_* methods, so accept share-all for share_all
+        command, sep, rest = line.partition(' ')
+        return command.replace('-', '_') + sep + rest
+
+    def _print_delivery(self, results, what):
+        delivered = sum(1 for r in results.values() if r['ok'])
+        relayed = sum(1 for r in results.values() if r['ok'] and r.get('relayed'))
+        print(f"{what} delivered to {delivered}/{len(results)} peers" + (f" ({relayed} via relays)." if relayed else "."))
+        for name, result in results.items():
+            if not result['ok']:
+                print(f"- {result['username']} ({name}): {result['error']}")
+
     def _find_peer(self, partial_id):
-        # Exact match
-        if partial_id in self.nm.peers:
-            return self.nm.peers[partial_id]
-        
-        # Partial match
-        for name, info in self.nm.peers.items():
-            if partial_id in name or partial_id in info['username']:
-                return info
-        return None
+        # Exact name or id first, then id, name or username prefix
+        found = self.nm.peers.find(partial_id)
+        return found[1] if found else None
 
-def run_cli(password=None, username=None):
+def run_cli(password=None, username=None, engine="threads", compression="off", history_bytes=MAX_BYTES, coalesce=0.0, metrics_file=None, relay_fanout=0):
+    cli = None
     try:
         if password:
             print("🔒 Encryption Enabled.")
         else:
             print("⚠️  No password provided. Running in plain text mode.")
             
-        AnonCLI(password, username).cmdloop()
+        cli = AnonCLI(password, username, engine, compression, history_bytes, coalesce, metrics_file, relay_fanout)
+        cli.cmdloop()
     except KeyboardInterrupt:
         print("\nExiting...")
+    finally:
+        # However we leave, zero the message history before the process goes
+        if cli:
+            cli.store.wipe()
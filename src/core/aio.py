@@ -0,0 +1,336 @@
+import asyncio
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .network import SERVER_IDLE_TIMEOUT, FINISH_TIMEOUT, ack_timeout
+from .transfer import IncomingFile, END_OF_CHUNKS, split_indexes
+from .inbound import Overloaded
+
+CONNECT_TIMEOUT = 5.0
+WORKERS = 4
+
+class AsyncioEngine:
+    """Runs accept, reads and writes for a NetworkManager on a single event loop.
+
+    Messages are decoded and delivered by the NetworkManager's decode pool,
+    and file I/O is offloaded to a small executor, so the loop keeps
+    servicing sockets. The loop lives on its own thread, and
+    the blocking send_frame/send_file calls are safe from any other thread.
+    """
+
+    def __init__(self, network_manager, workers=WORKERS):
+        self.nm = network_manager
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="anonbox-aio")
+        self.server = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._conns = {} # (ip, port) -> (reader, writer)
+        self._inbound = set() # writers of accepted connections
+        self._locks = {} # (ip, port) -> asyncio.Lock
+
+    def start(self):
+        self._call(self._start_server())
+
+    def stop(self):
+        if not self.loop.is_running():
+            return
+        try:
+            self._call(self._shutdown())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.executor.shutdown(wait=False)
+
+    def _call(self, coro):
+        # The loop is started on first use so sending works before start()
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self._thread.start()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Blocking engine call from inside the event loop")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _offload(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _start_server(self):
+        self.server = await asyncio.start_server(self._handle_conn, sock=self.nm.server_socket)
+
+    async def _shutdown(self):
+        if self.server:
+            self.server.close()
+        for _, writer in self._conns.values():
+            writer.close()
+        self._conns.clear()
+        # server.close() leaves accepted connections open; close them so peers see EOF
+        for writer in list(self._inbound):
+            writer.close()
+
+    # Receiving
+
+    async def _read_frame(self, reader):
+        try:
+            header = await reader.readexactly(4)
+            msg_len = self.nm._check_frame_len(struct.unpack('>I', header)[0])
+            return await reader.readexactly(msg_len)
+        except asyncio.IncompleteReadError:
+            return None
+
+    async def _read_inbound_frame(self, reader):
+        # Like _read_frame, but the frame counts against the decode budget until freed
+        try:
+            header = await reader.readexactly(4)
+            msg_len = self.nm._check_frame_len(struct.unpack('>I', header)[0])
+        except asyncio.IncompleteReadError:
+            return None
+        self.nm.limiter.reserve(msg_len)
+        start = time.perf_counter()
+        try:
+            frame = await reader.readexactly(msg_len)
+            self.nm.metrics.observe('receive', time.perf_counter() - start)
+            return frame
+        except BaseException as e:
+            self.nm.limiter.free(msg_len)
+            if isinstance(e, asyncio.IncompleteReadError):
+                return None
+            raise
+
+    async def _handle_conn(self, reader, writer):
+        nm = self.nm
+        address = writer.get_extra_info('peername')[0]
+        # Over the cap, refuse by closing straight away
+        if not nm.limiter.admit(address):
+            writer.close()
+            return
+        self._inbound.add(writer)
+        try:
+            while nm.running:
+                delay = nm.limiter.throttle(address)
+                if delay:
+                    # Not reading lets TCP flow control slow the sender down
+                    await asyncio.sleep(delay)
+                frame = await asyncio.wait_for(self._read_inbound_frame(reader), SERVER_IDLE_TIMEOUT)
+                if frame is None:
+                    return
+
+                nm.metrics.add_bytes(address, 'in', 4 + len(frame))
+                try:
+                    # Awaited so messages from one connection reach the callback in order
+                    offer = await asyncio.wrap_future(nm.decoder.submit(nm._process_frame, frame))
+                except Overloaded:
+                    nm.limiter.shed('queue')
+                    raise
+                except Exception as e:
+                    nm.logger.error(f"Decryption/Parse error: {e}")
+                    continue
+                finally:
+                    nm.limiter.free(len(frame))
+
+                # A failed transfer leaves unread chunks on the wire, so drop the connection
+                if offer is not None:
+                    keep_open = await self._receive_file(reader, writer, offer, address)
+                    await self._offload(nm._deliver, offer)
+                    if not keep_open:
+                        return
+        except asyncio.TimeoutError:
+            pass
+        except Overloaded as e:
+            nm.logger.warning(f"Shedding connection from {address}: {e}")
+        except Exception as e:
+            nm.logger.error(f"Client error: {e}")
+        finally:
+            self._inbound.discard(writer)
+            writer.close()
+            nm.limiter.release(address)
+
+    async def _receive_file(self, reader, writer, msg, address):
+        try:
+            incoming = IncomingFile(self.nm, msg)
+        except ValueError as e:
+            self.nm.logger.error(f"Refused file offer: {e}")
+            return False
+        try:
+            reply = await self._offload(incoming.open)
+            if reply:
+                writer.write(reply)
+            while not incoming.done:
+                header = await reader.readexactly(4)
+                frame_len = incoming.check_frame_len(struct.unpack('>I', header)[0])
+                self.nm.metrics.add_bytes(address, 'in', 4 + frame_len)
+                # Buffered chunks count against the decode budget like any inbound frame
+                self.nm.limiter.reserve(frame_len)
+                try:
+                    frame = await reader.readexactly(frame_len) if frame_len else b''
+                    await self._offload(incoming.write_frame, frame)
+                finally:
+                    self.nm.limiter.free(frame_len)
+            # finish() can block on sibling streams, so it stays off the engine's own workers
+            reply = await self.loop.run_in_executor(None, incoming.finish)
+            if reply:
+                writer.write(reply)
+                await writer.drain()
+        except Exception as e:
+            self.nm.logger.error(f"File receive error: {e}")
+            incoming.close(e)
+            return False
+        return True
+
+    # Sending
+
+    def send_frame(self, address, frame, connect_timeout=None, send_timeout=None, persistent=True):
+        send = self._send if persistent else self._send_once
+        self._call(send(address, frame, connect_timeout, send_timeout))
+
+    def close(self, address):
+        """Closes the kept-open connection to `address` and forgets it, e.g. when the peer leaves."""
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._forget, address)
+
+    def _forget(self, address):
+        conn = self._conns.pop(address, None)
+        if conn:
+            conn[1].close()
+        lock = self._locks.get(address)
+        # A send in progress still holds it; it reconnects if it needs to
+        if lock is not None and not lock.locked():
+            del self._locks[address]
+
+    def send_file_round(self, outgoing, targets, connect_timeout=None, send_timeout=None, streams=1):
+        return self._call(self._send_file_round(outgoing, targets, connect_timeout, send_timeout, streams))
+
+    async def _send(self, address, frame, connect_timeout=None, send_timeout=None):
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        async with lock:
+            for attempt in (0, 1):
+                conn = self._conns.get(address)
+                # Peers never write on this connection, so EOF means they closed it
+                if conn is None or conn[0].at_eof() or conn[1].is_closing():
+                    if conn:
+                        conn[1].close()
+                    conn = await self._open(address, connect_timeout)
+                    self._conns[address] = conn
+                try:
+                    conn[1].write(frame)
+                    await asyncio.wait_for(conn[1].drain(), send_timeout)
+                    return
+                except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                    conn[1].close()
+                    self._conns.pop(address, None)
+                    # A timed-out send is not retried so per-peer deadlines hold
+                    if attempt or isinstance(e, asyncio.TimeoutError):
+                        raise
+
+    async def _send_once(self, address, frame, connect_timeout=None, send_timeout=None):
+        # For peers that read one frame per connection
+        reader, writer = await self._open(address, connect_timeout)
+        try:
+            await self._write(writer, frame, send_timeout)
+        finally:
+            writer.close()
+
+    async def _open(self, address, connect_timeout):
+        start = time.monotonic()
+        conn = await asyncio.wait_for(asyncio.open_connection(*address), connect_timeout or CONNECT_TIMEOUT)
+        self.nm._on_connect(address, time.monotonic() - start)
+        return conn
+
+    async def _write(self, writer, frame, send_timeout):
+        writer.write(frame)
+        await asyncio.wait_for(writer.drain(), send_timeout)
+
+    async def _sendfile(self, writer, outgoing, chunk, send_timeout):
+        # Plaintext chunks go from the page cache to the socket with sendfile()
+        header, offset, length = chunk
+        await self._write(writer, header, send_timeout)
+        try:
+            await asyncio.wait_for(self.loop.sendfile(writer.transport, outgoing.file, offset, length, fallback=False), send_timeout)
+        except asyncio.SendfileNotAvailableError:
+            # Also raised when the connection fails before the first byte; a plain write
+            # either works or surfaces the real connection error
+            await self._write(writer, outgoing.map[offset:offset + length], send_timeout)
+
+    async def _read_reply(self, reader, timeout):
+        frame = await asyncio.wait_for(self._read_frame(reader), timeout)
+        if frame is None:
+            raise ConnectionError("Connection closed while waiting for a reply")
+        return await self._offload(self.nm._decode_message, frame)
+
+    async def _offer_file(self, outgoing, header, address, connect_timeout, send_timeout):
+        reader, writer = await self._open(address, connect_timeout)
+        try:
+            await self._write(writer, self.nm._frame_for(header, address), send_timeout)
+            ack = await self._read_reply(reader, ack_timeout(outgoing.size))
+            return reader, writer, outgoing.missing(ack)
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _finish_file(self, outgoing, reader, writer, send_timeout):
+        await self._write(writer, END_OF_CHUNKS, send_timeout)
+        outgoing.check_done(await self._read_reply(reader, FINISH_TIMEOUT))
+
+    async def _send_file_round(self, outgoing, targets, connect_timeout=None, send_timeout=None, streams=1):
+        # Files get their own connections so chat on the persistent ones isn't held up
+        keys = [(name, stream) for name in targets for stream in range(streams)]
+        header = await self._offload(outgoing.header)
+        # Every stream is offered before any chunk goes out, so the receiver knows to wait for all of them
+        opened = await asyncio.gather(*(self._offer_file(outgoing, header, targets[k[0]], connect_timeout, send_timeout) for k in keys),
+                                      return_exceptions=True)
+        errors = {}
+        conns = {} # (name, stream) -> (reader, writer, missing)
+        for key, result in zip(keys, opened):
+            if isinstance(result, BaseException):
+                errors.setdefault(key[0], result)
+            else:
+                conns[key] = result
+        for key in [key for key in conns if key[0] in errors]:
+            conns.pop(key)[1].close()
+
+        def drop(key, error):
+            errors.setdefault(key[0], error)
+            conns.pop(key)[1].close()
+
+        async def send_range(stream, indexes):
+            # Each chunk is read and encrypted once, then written to every peer missing it
+            for index in indexes:
+                needed_by = [k for k in conns if k[1] == stream and index in conns[k][2]]
+                if not needed_by:
+                    continue
+                if outgoing.zero_copy:
+                    chunk = outgoing.chunk_range(index)
+                    size = len(chunk[0]) + chunk[2]
+                    sent = await asyncio.gather(*(self._sendfile(conns[k][1], outgoing, chunk, send_timeout) for k in needed_by),
+                                                return_exceptions=True)
+                else:
+                    frame = await self._offload(outgoing.chunk_frame, index)
+                    size = len(frame)
+                    needed_by = [k for k in needed_by if k in conns]
+                    sent = await asyncio.gather(*(self._write(conns[k][1], frame, send_timeout) for k in needed_by),
+                                                return_exceptions=True)
+                for key, result in zip(needed_by, sent):
+                    if isinstance(result, BaseException):
+                        drop(key, result)
+                    else:
+                        self.nm.metrics.add_bytes(targets[key[0]][0], 'out', size)
+
+        try:
+            ranges = split_indexes(set().union(*(conn[2] for conn in conns.values())), streams)
+            await asyncio.gather(*(send_range(stream, indexes) for stream, indexes in enumerate(ranges)))
+
+            # The receiver answers once all streams have ended, so end them all before reading
+            live = list(conns)
+            done = await asyncio.gather(*(self._finish_file(outgoing, conns[k][0], conns[k][1], send_timeout) for k in live),
+                                        return_exceptions=True)
+            for key, result in zip(live, done):
+                if isinstance(result, BaseException):
+                    drop(key, result)
+        finally:
+            for _, writer, _ in conns.values():
+                writer.close()
+
+        for name in targets:
+            errors.setdefault(name, None)
+        return errors
@@ -0,0 +1,162 @@
+import threading
+import time
+from concurrent.futures import Future
+from . import protocol
+from .pool import CONNECT_TIMEOUT
+
+COALESCE_WINDOW = 0.005 # Seconds a message may wait for others to the same peer
+MAX_BATCH_BYTES = 64 * 1024 # A batch this big is sent without waiting out the window
+
+def tighter(a, b):
+    """The smaller of two timeouts, where None means no timeout was given."""
+    return b if a is None else a if b is None else min(a, b)
+
+class Outbox:
+    """Messages waiting to go to one peer."""
+    __slots__ = ('payloads', 'futures', 'size', 'connect_timeout', 'send_timeout', 'deadline', 'last_sent', 'send_lock')
+
+    def __init__(self):
+        self.payloads = []
+        self.futures = [] # One per payload, completed when its batch is written
+        self.size = 0
+        # The tightest timeouts any queued message was sent with; the batch is written with them
+        self.connect_timeout = None
+        self.send_timeout = None
+        self.deadline = None
+        self.last_sent = 0.0
+        # Held from taking a batch until it is written, so batches leave in order
+        self.send_lock = threading.Lock()
+
+class Coalescer:
+    """Sends chat messages to the same peer that follow each other closely as one batch frame.
+
+    A message to a peer that has been quiet for a window goes out at once,
+    so a lone message sees no extra latency. Messages that follow it within
+    the window are held until the window ends and then sent together: one
+    encryption, one GCM tag and one write for the lot.
+    """
+
+    def __init__(self, network_manager, window=COALESCE_WINDOW, max_bytes=MAX_BATCH_BYTES):
+        self.nm = network_manager
+        self.window = window
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._outboxes = {} # (address, port) -> Outbox
+        self._running = False
+        self.immediate = 0
+        self.batches = 0
+        self.batched = 0
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._flush_loop, name="anonbox-coalesce", daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._wake.notify()
+            outboxes = list(self._outboxes.items())
+        # Whatever is still held is sent rather than dropped
+        for endpoint, outbox in outboxes:
+            self._flush(endpoint, outbox)
+
+    def forget(self, endpoint):
+        with self._lock:
+            outbox = self._outboxes.get(endpoint)
+            if outbox is not None and not outbox.payloads:
+                del self._outboxes[endpoint]
+
+    def send(self, endpoint, prepared, connect_timeout=None, send_timeout=None):
+        """Sends `prepared` now if the peer is idle, otherwise queues it behind the current batch.
+
+        Errors from an immediate send are raised and None is returned. A
+        queued message returns a Future that completes when its batch has
+        been written, or fails with the write's error.
+        """
+        now = time.monotonic()
+        with self._lock:
+            outbox = self._outboxes.get(endpoint)
+            if outbox is None:
+                outbox = self._outboxes[endpoint] = Outbox()
+            # Once stopped there is no flush thread to send what's queued
+            immediate = not self._running or (not outbox.payloads and now - outbox.last_sent >= self.window)
+            if immediate:
+                outbox.last_sent = now
+                self.immediate += 1
+
+        if immediate:
+            with outbox.send_lock:
+                self.nm._write_frame(endpoint, self.nm._frame_for(prepared, endpoint), connect_timeout, send_timeout)
+            return
+
+        payload = self.nm._encode(prepared.msg, self.nm._wire_for(endpoint), self.nm._codec_for(endpoint))
+        future = Future()
+        with self._lock:
+            outbox.payloads.append(payload)
+            outbox.futures.append(future)
+            outbox.size += len(payload)
+            outbox.connect_timeout = tighter(outbox.connect_timeout, connect_timeout)
+            outbox.send_timeout = tighter(outbox.send_timeout, send_timeout)
+            if outbox.deadline is None:
+                outbox.deadline = now + self.window
+                self._wake.notify()
+            # stop() may have flushed this outbox while we were encoding
+            flush = outbox.size >= self.max_bytes or not self._running
+        if flush:
+            self._flush(endpoint, outbox)
+        return future
+
+    def wait_limit(self, connect_timeout, send_timeout):
+        """How long a queued message can take to be written; None when the caller set no send timeout."""
+        if send_timeout is None:
+            return None
+        # Its window in the queue, then possibly the batch already being written, then its own
+        return self.window + 2 * ((connect_timeout or CONNECT_TIMEOUT) + send_timeout)
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while self._running:
+                    now = time.monotonic()
+                    deadlines = [o.deadline for o in self._outboxes.values() if o.deadline is not None]
+                    if deadlines and min(deadlines) <= now:
+                        break
+                    self._wake.wait(min(deadlines) - now if deadlines else None)
+                if not self._running:
+                    return
+                due = [(e, o) for e, o in self._outboxes.items() if o.deadline is not None and o.deadline <= now]
+            for endpoint, outbox in due:
+                self._flush(endpoint, outbox)
+
+    def _flush(self, endpoint, outbox):
+        with outbox.send_lock:
+            with self._lock:
+                payloads, outbox.payloads = outbox.payloads, []
+                futures, outbox.futures = outbox.futures, []
+                connect_timeout, outbox.connect_timeout = outbox.connect_timeout, None
+                send_timeout, outbox.send_timeout = outbox.send_timeout, None
+                outbox.size = 0
+                outbox.deadline = None
+                outbox.last_sent = time.monotonic()
+                if payloads:
+                    self.batches += 1
+                    self.batched += len(payloads)
+            if not payloads:
+                return
+            # A single held message needs no batch wrapper
+            payload = payloads[0] if len(payloads) == 1 else protocol.encode_batch(payloads)
+            try:
+                self.nm._write_frame(endpoint, self.nm._build_frame(payload), connect_timeout, send_timeout)
+            except Exception as e:
+                self.nm.logger.error(f"Batch of {len(payloads)} messages to {endpoint[0]}:{endpoint[1]} failed: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                return
+            for future in futures:
+                future.set_result(None)
+
+    def summary(self):
+        with self._lock:
+            return {'window_ms': self.window * 1000, 'immediate': self.immediate,
+                    'batches': self.batches, 'batched': self.batched}
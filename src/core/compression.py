@@ -0,0 +1,130 @@
+import time
+import zlib
+import threading
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+
+CODEC_IDS = {'zlib': CODEC_ZLIB, 'lz4': CODEC_LZ4}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+MIN_SIZE = 256 # Smaller payloads aren't worth the CPU
+SAMPLE_SIZE = 4096 # Bytes compressed to decide whether the rest is worth it
+MAX_RATIO = 0.9 # Skip data that doesn't shrink below this fraction of its size
+
+_lz4_frame = None
+
+def _lz4():
+    """lz4.frame if installed (optional, much faster than zlib), else None.
+
+    Imported on first use rather than at startup.
+    """
+    global _lz4_frame
+    if _lz4_frame is None:
+        try:
+            import lz4.frame as lz4_frame
+        except ImportError:
+            lz4_frame = False
+        _lz4_frame = lz4_frame
+    return _lz4_frame or None
+
+def available_codecs():
+    """Codec names this build can decode, fastest first."""
+    return (['lz4'] if _lz4() else []) + ['zlib']
+
+def _compress(codec, data, level=None):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 1 if level is None else level)
+    if codec == CODEC_LZ4:
+        return _lz4().compress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+def decompress(codec, data, max_size):
+    """Decompresses `data`, refusing to produce more than `max_size` bytes."""
+    if codec == CODEC_ZLIB:
+        d = zlib.decompressobj()
+        out = d.decompress(data, max_size)
+        if d.unconsumed_tail or not d.eof:
+            raise ValueError("Compressed payload too large or truncated")
+        return out
+    if codec == CODEC_LZ4 and _lz4():
+        d = _lz4().LZ4FrameDecompressor()
+        out = d.decompress(data, max_length=max_size)
+        if not d.eof:
+            raise ValueError("Compressed payload too large or truncated")
+        return out
+    raise ValueError(f"Unsupported codec {codec}")
+
+class Compressor:
+    """Adaptive compression applied to payloads before they're encrypted.
+
+    A quick sample decides whether a payload is worth compressing at all, so
+    already-compressed media is sent as-is without paying for a full pass.
+    """
+
+    def __init__(self, codec="off"):
+        self.set_codec(codec)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def set_codec(self, codec):
+        if codec == "auto":
+            codec = available_codecs()[0]
+        if codec == "off":
+            self.codec = CODEC_NONE
+        elif codec == "lz4" and not _lz4():
+            raise ValueError("lz4 is not installed (pip install lz4)")
+        elif codec in CODEC_IDS:
+            self.codec = CODEC_IDS[codec]
+        else:
+            raise ValueError(f"Unknown compression codec: {codec}")
+
+    @property
+    def name(self):
+        return CODEC_NAMES.get(self.codec, "off")
+
+    def reset_stats(self):
+        self.stats = {'messages': 0, 'compressed': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+    def pick(self, peer_codecs):
+        """The codec to use for a peer that can decode `peer_codecs`."""
+        if self.codec == CODEC_NONE:
+            return CODEC_NONE
+        if CODEC_NAMES[self.codec] in peer_codecs:
+            return self.codec
+        return CODEC_ZLIB if 'zlib' in peer_codecs else CODEC_NONE
+
+    def compress(self, data, codec=None):
+        """Returns (codec, payload); codec is CODEC_NONE when the data was left alone."""
+        codec = self.codec if codec is None else codec
+        if codec == CODEC_NONE:
+            return CODEC_NONE, data
+
+        start = time.perf_counter()
+        result = CODEC_NONE, data
+        if len(data) >= MIN_SIZE:
+            sample = data[:SAMPLE_SIZE]
+            # Cheap probe on a prefix before committing to the whole payload
+            if len(data) <= SAMPLE_SIZE or len(_compress(codec, sample)) <= len(sample) * MAX_RATIO:
+                packed = _compress(codec, data)
+                if len(packed) <= len(data) * MAX_RATIO:
+                    result = codec, packed
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            stats = self.stats
+            stats['messages'] += 1
+            stats['compressed' if result[0] else 'skipped'] += 1
+            stats['bytes_in'] += len(data)
+            stats['bytes_out'] += len(result[1])
+            stats['seconds'] += elapsed
+        return result
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        messages = stats['messages']
+        stats['ratio'] = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else 1.0
+        stats['ms_per_message'] = stats['seconds'] * 1000 / messages if messages else 0.0
+        return stats
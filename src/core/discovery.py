@@ -0,0 +1,136 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser, ServiceListener
+from . import protocol
+from .compression import available_codecs
+from .network import SERVICE_TYPE, RESOLVE_WORKERS, RESOLVE_TIMEOUT
+
+_local_ip = None
+
+def local_ip():
+    """This host's LAN address, found once and then cached.
+
+    Prefers the interface holding the default route, then any non-loopback
+    IPv4 address, so an offline machine on a LAN still finds its address.
+    """
+    global _local_ip
+    if _local_ip is None:
+        _local_ip = _find_local_ip()
+    return _local_ip
+
+def _find_local_ip():
+    try:
+        import netifaces
+    except ImportError:
+        return _routed_ip()
+
+    try:
+        default = netifaces.gateways().get('default', {}).get(netifaces.AF_INET)
+        interfaces = ([default[1]] if default else []) + netifaces.interfaces()
+        for interface in interfaces:
+            for entry in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+                address = entry.get('addr')
+                if address and not address.startswith('127.'):
+                    return address
+    except (OSError, ValueError):
+        pass
+    return "127.0.0.1"
+
+def _routed_ip():
+    # Without netifaces: ask the kernel which address would route out (no packet is sent)
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(('8.8.8.8', 80))
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except OSError:
+        return "127.0.0.1"
+
+class PeerListener(ServiceListener):
+    """Turns zeroconf browse events into registry changes.
+
+    Lookups that aren't answered from zeroconf's cache run on a few worker
+    threads, so one slow peer doesn't hold up discovery of the rest.
+    """
+
+    def __init__(self, network_manager):
+        self.nm = network_manager
+        self._resolver = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix="anonbox-mdns")
+        self._lock = threading.Lock()
+        self._pending = set() # names being resolved
+        self._stale = set() # names that changed while being resolved
+
+    def remove_service(self, zc, type, name):
+        self.nm.peers.remove(name)
+
+    def add_service(self, zc, type, name):
+        self._resolve(zc, type, name)
+
+    def update_service(self, zc, type, name):
+        # A peer changed its name, port or properties; add_peer reports it as an update
+        self._resolve(zc, type, name)
+
+    def close(self):
+        self._resolver.shutdown(wait=False, cancel_futures=True)
+
+    def _resolve(self, zc, type, name):
+        info = ServiceInfo(type, name)
+        if info.load_from_cache(zc):
+            self.nm.add_peer(name, info)
+            return
+        with self._lock:
+            if name in self._pending:
+                self._stale.add(name)
+                return
+            self._pending.add(name)
+        self._resolver.submit(self._request, zc, type, name)
+
+    def _request(self, zc, type, name):
+        try:
+            info = ServiceInfo(type, name)
+            if info.request(zc, RESOLVE_TIMEOUT):
+                self.nm.add_peer(name, info)
+        except Exception as e:
+            self.nm.logger.error(f"Resolving {name} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+                again = name in self._stale
+                self._stale.discard(name)
+        if again and self.nm.running:
+            self._resolve(zc, type, name)
+
+def service_info(nm, address=None):
+    """The mDNS service a NetworkManager announces, at `address` or this host's LAN address."""
+    props = {'id': nm.my_id, 'user': nm.username, 'wire': protocol.WIRE_BINARY,
+             'codecs': ','.join(available_codecs()), 'batch': '1', 'relay': '1', 'multi': '1'}
+    return ServiceInfo(
+        SERVICE_TYPE,
+        f"AnonPeer-{nm.my_id[:8]}.{SERVICE_TYPE}",
+        addresses=[socket.inet_aton(address or local_ip())],
+        port=nm.port,
+        properties=props,
+        server=f"anonbox-{nm.my_id[:8]}.local."
+    )
+
+class Discovery:
+    """mDNS browsing and announcement for one NetworkManager.
+
+    Browsing starts as soon as this is built; announce() registers our own
+    service, which blocks for the probes zeroconf sends first.
+    """
+
+    def __init__(self, network_manager):
+        self.nm = network_manager
+        self.zeroconf = Zeroconf()
+        self.listener = PeerListener(network_manager)
+        self.browser = ServiceBrowser(self.zeroconf, SERVICE_TYPE, self.listener)
+
+    def announce(self):
+        self.zeroconf.register_service(service_info(self.nm))
+
+    def close(self):
+        self.listener.close()
+        self.zeroconf.close()
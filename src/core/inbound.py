@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+DECODE_WORKERS = 4 # Threads decrypting, parsing and delivering inbound messages
+DECODE_QUEUE = 64 # Frames waiting for a decode worker; more are shed
+MAX_CONNECTIONS = 256 # Inbound connections open at once
+MAX_PEER_CONNECTIONS = 32 # ...of which from one address (parallel file streams use several)
+PEER_RATE = 200.0 # Frames per second from one address
+PEER_BURST = 400 # ...allowed in a burst before throttling kicks in
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024 # Frame bytes read but not yet decoded, across all connections
+MAX_TRACKED_PEERS = 4096 # Idle rate-limit state is pruned beyond this
+
+class Overloaded(Exception):
+    """Inbound work was refused rather than queued; the connection should be closed."""
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Takes a token; returns how many seconds to wait first (0 if one was available)."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+class DecodePool:
+    """A fixed set of worker threads fed by a bounded queue.
+
+    submit() never blocks: when the queue is full it raises Overloaded, so
+    callers shed the work instead of piling it up.
+    """
+
+    def __init__(self, workers=DECODE_WORKERS, queue_size=DECODE_QUEUE):
+        self.workers = workers
+        # SimpleQueue is cheaper per item than Queue; the semaphore bounds it
+        self._queue = queue.SimpleQueue()
+        self._slots = threading.Semaphore(queue_size)
+        self._threads = []
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"anonbox-decode-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        # Workers finish what is queued before they reach the sentinel
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded("Decode queue full")
+        future = Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._slots.release()
+            future, func, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+class InboundLimiter:
+    """Admission control for inbound connections and frames, shared by both engines.
+
+    Connections beyond the global or per-address cap are refused. Each
+    address has a token bucket for frames; a peer over its rate is
+    throttled by not reading from it, so TCP pushes back on the sender.
+    Frames that would take the bytes awaiting decode over budget are shed
+    by closing the connection. Pass None for any limit to disable it.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_peer_connections=MAX_PEER_CONNECTIONS,
+                 peer_rate=PEER_RATE, peer_burst=PEER_BURST, max_inflight_bytes=MAX_INFLIGHT_BYTES):
+        self.max_connections = max_connections
+        self.max_peer_connections = max_peer_connections
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.max_inflight_bytes = max_inflight_bytes
+        self._lock = threading.Lock()
+        self._open = {} # address -> open connections
+        self._buckets = {} # address -> TokenBucket
+        self.connections = 0
+        self.inflight_bytes = 0
+        self.accepted = 0
+        self.throttled = 0
+        self.dropped = {'connections': 0, 'queue': 0, 'memory': 0}
+
+    def admit(self, address):
+        """Counts a new connection from `address`; False if it must be refused."""
+        with self._lock:
+            if ((self.max_connections and self.connections >= self.max_connections) or
+                    (self.max_peer_connections and self._open.get(address, 0) >= self.max_peer_connections)):
+                self.dropped['connections'] += 1
+                return False
+            self.connections += 1
+            self._open[address] = self._open.get(address, 0) + 1
+            self.accepted += 1
+            return True
+
+    def release(self, address):
+        with self._lock:
+            self.connections -= 1
+            count = self._open.get(address, 1) - 1
+            if count:
+                self._open[address] = count
+            else:
+                del self._open[address]
+
+    def throttle(self, address):
+        """Takes one of `address`'s tokens; returns the seconds to wait before serving it."""
+        if not self.peer_rate:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(address)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_PEERS:
+                    self._prune()
+                bucket = self._buckets[address] = TokenBucket(self.peer_rate, self.peer_burst)
+            delay = bucket.take()
+            if delay:
+                self.throttled += 1
+            return delay
+
+    def _prune(self):
+        for address in [a for a, b in self._buckets.items() if a not in self._open and b.idle()]:
+            del self._buckets[address]
+
+    def reserve(self, size):
+        """Claims `size` bytes of the decode budget; raises Overloaded if there isn't room."""
+        with self._lock:
+            if self.max_inflight_bytes and self.inflight_bytes + size > self.max_inflight_bytes:
+                self.dropped['memory'] += 1
+                raise Overloaded(f"Frame of {size} bytes over the decode budget ({self.inflight_bytes} bytes waiting)")
+            self.inflight_bytes += size
+
+    def free(self, size):
+        with self._lock:
+            self.inflight_bytes -= size
+
+    def shed(self, reason):
+        with self._lock:
+            self.dropped[reason] += 1
+
+    def summary(self):
+        with self._lock:
+            return {'connections': self.connections, 'accepted': self.accepted, 'throttled': self.throttled,
+                    'inflight_bytes': self.inflight_bytes, 'dropped': dict(self.dropped)}
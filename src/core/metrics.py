@@ -0,0 +1,244 @@
+import bisect
+import os
+import sys
+import threading
+import time
+
+# Hot-path stages timed for every message, in pipeline order
+STAGES = ('serialize', 'encrypt', 'connect', 'send', 'receive', 'decrypt', 'parse', 'callback')
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(24)) # 1 us to ~8 s, doubling
+DUMP_INTERVAL = 15.0 # Seconds between Prometheus file dumps
+PROFILE_INTERVAL = 0.01 # Seconds between profiler samples
+
+class Histogram:
+    """Latency histogram with fixed, doubling buckets (Prometheus style)."""
+    __slots__ = ('counts', 'count', 'sum', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples (None if empty)."""
+        counts, count, _ = self.snapshot()
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+class Metrics:
+    """Counters, gauges and per-stage latency histograms for a NetworkManager.
+
+    Stages are timed by the network code itself; gauges are callables read
+    when a snapshot is taken. Everything stays in memory unless a dump file
+    is configured with start_dump().
+    """
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self._lock = threading.Lock()
+        self.events = {} # name -> count
+        self.peer_bytes = {} # (address, "in" | "out") -> bytes
+        self.gauges = {} # name -> (help, callable)
+        self._dump_stop = None
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self.events[event] = self.events.get(event, 0) + n
+
+    def add_bytes(self, address, direction, n):
+        key = (address, direction)
+        with self._lock:
+            self.peer_bytes[key] = self.peer_bytes.get(key, 0) + n
+
+    def gauge(self, name, help, func):
+        self.gauges[name] = (help, func)
+
+    def _gauge_values(self):
+        values = {}
+        for name, (_, func) in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception:
+                values[name] = None
+        return values
+
+    def summary(self):
+        """Stage latencies (count, mean, p50, p99 in seconds), events, bytes per peer and gauges."""
+        stages = {}
+        for stage, hist in self.stages.items():
+            _, count, total = hist.snapshot()
+            stages[stage] = {'count': count, 'mean': total / count if count else None,
+                             'p50': hist.percentile(0.5), 'p99': hist.percentile(0.99)}
+        peers = {}
+        with self._lock:
+            events = dict(self.events)
+            for (address, direction), n in self.peer_bytes.items():
+                peers.setdefault(address, {'in': 0, 'out': 0})[direction] = n
+        return {'stages': stages, 'events': events, 'peers': peers, 'gauges': self._gauge_values()}
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = ["# HELP anonbox_stage_seconds Time spent in each hot-path stage.",
+                 "# TYPE anonbox_stage_seconds histogram"]
+        for stage, hist in self.stages.items():
+            counts, count, total = hist.snapshot()
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else f"{bound:.6g}"
+                lines.append(f'anonbox_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'anonbox_stage_seconds_sum{{stage="{stage}"}} {total:.9f}')
+            lines.append(f'anonbox_stage_seconds_count{{stage="{stage}"}} {count}')
+
+        with self._lock:
+            events = sorted(self.events.items())
+            peer_bytes = sorted(self.peer_bytes.items())
+        lines += ["# HELP anonbox_events_total Discovery, connection and drop events.",
+                  "# TYPE anonbox_events_total counter"]
+        lines += [f'anonbox_events_total{{event="{name}"}} {n}' for name, n in events]
+        lines += ["# HELP anonbox_peer_bytes_total Bytes exchanged with each peer address.",
+                  "# TYPE anonbox_peer_bytes_total counter"]
+        lines += [f'anonbox_peer_bytes_total{{peer="{address}",direction="{direction}"}} {n}'
+                  for (address, direction), n in peer_bytes]
+
+        values = self._gauge_values()
+        for name, (help, _) in self.gauges.items():
+            if values[name] is None:
+                continue
+            lines.append(f"# HELP anonbox_{name} {help}")
+            lines.append(f"# TYPE anonbox_{name} gauge")
+            lines.append(f"anonbox_{name} {values[name]}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Written aside and renamed, so a scraper never reads half a file
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def start_dump(self, path, interval=DUMP_INTERVAL, logger=None):
+        """Rewrites `path` every `interval` seconds until stop_dump()."""
+        self._dump_stop = stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    if logger:
+                        logger.error(f"Metrics dump to {path} failed: {e}")
+
+        threading.Thread(target=loop, name="anonbox-metrics", daemon=True).start()
+
+    def stop_dump(self):
+        if self._dump_stop:
+            self._dump_stop.set()
+            self._dump_stop = None
+
+# Functions that mark which stage a sampled thread is in, by (file, function name).
+# The innermost match on a thread's stack wins.
+PROFILE_STAGES = {
+    ('protocol.py', 'encode'): 'serialize', ('protocol.py', 'encode_batch'): 'serialize',
+    ('network.py', '_build_frame'): 'encrypt', ('security.py', 'encrypt'): 'encrypt',
+    ('security.py', 'encrypt_segment'): 'encrypt',
+    ('network.py', '_connect'): 'connect', ('pool.py', '_connect'): 'connect', ('aio.py', '_open'): 'connect',
+    ('network.py', '_write_frame'): 'send', ('aio.py', '_write'): 'send', ('aio.py', '_sendfile'): 'send',
+    ('network.py', '_send_file_round'): 'send',
+    ('network.py', '_recv_all'): 'receive', ('network.py', '_recv_into'): 'receive',
+    ('aio.py', '_read_inbound_frame'): 'receive',
+    ('security.py', 'decrypt'): 'decrypt', ('security.py', 'decrypt_segment'): 'decrypt',
+    ('protocol.py', 'decode'): 'parse', ('protocol.py', 'split_batch'): 'parse',
+    ('network.py', '_deliver'): 'callback',
+    ('network.py', '_build_message'): 'serialize', ('pool.py', 'send'): 'send',
+    # Outermost frames: whatever a reader or decode worker does outside the stages above
+    ('network.py', '_handle_client'): 'receive', ('aio.py', '_handle_conn'): 'receive',
+    ('inbound.py', '_run'): 'dispatch', ('coalesce.py', '_flush'): 'send',
+    ('transfer.py', 'hash_chunks'): 'file hashing', ('transfer.py', 'finish'): 'file hashing',
+}
+
+class StageProfiler:
+    """Opt-in sampling profiler that charges CPU time to hot-path stages.
+
+    Every `interval` it looks at each thread's stack and charges the CPU the
+    thread used since the last sample to the stage it is in. Where per-thread
+    CPU clocks aren't available, it counts samples instead, which also
+    counts threads that are only waiting.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.cpu = {} # stage -> seconds (or samples)
+        self.exact = hasattr(time, 'pthread_getcpuclockid')
+        self._last = {} # thread ident -> CPU seconds at the last sample
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="anonbox-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                used = self._cpu_used(ident)
+                if used:
+                    stage = self._stage(frame)
+                    self.cpu[stage] = self.cpu.get(stage, 0) + used
+
+    def _cpu_used(self, ident):
+        if not self.exact:
+            return 1
+        try:
+            now = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (OSError, OverflowError):
+            return 0 # The thread ended between listing and sampling
+        last = self._last.get(ident, now)
+        self._last[ident] = now
+        return now - last
+
+    def _stage(self, frame):
+        while frame is not None:
+            code = frame.f_code
+            stage = PROFILE_STAGES.get((os.path.basename(code.co_filename), code.co_name))
+            if stage:
+                return stage
+            frame = frame.f_back
+        return 'other'
+
+    def report(self):
+        """(stage, CPU seconds or samples, share) tuples, busiest first."""
+        total = sum(self.cpu.values()) or 1
+        return [(stage, used, used / total) for stage, used in sorted(self.cpu.items(), key=lambda kv: -kv[1])]
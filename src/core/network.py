@@ -1,147 +1,554 @@
 import socket
 import threading
-import json
 import time
 import uuid
 import struct
 import logging
-from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser, ServiceListener
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .security import SecurityManager
+from .pool import ConnectionPool
+from .peers import PeerRegistry, PeerCache
+from .inbound import DecodePool, InboundLimiter, Overloaded
+from .coalesce import Coalescer
+from .relay import Relay
+from .metrics import Metrics
+from . import protocol
+from .compression import Compressor, CODEC_NONE
+from .transfer import IncomingFile, OutgoingFile, PartialFile, END_OF_CHUNKS, split_indexes
 
 # Configuration
 PORT = 0 # Random port
 SERVICE_TYPE = "_anonbox._tcp.local."
 BUF_SIZE = 4096
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # Larger length headers are rejected before allocating
+SERVER_IDLE_TIMEOUT = 120.0 # Close inbound connections with no frames for this long
+BROADCAST_WORKERS = 16 # Peers contacted concurrently by broadcast()
+BROADCAST_CONNECT_TIMEOUT = 2.0
+BROADCAST_SEND_TIMEOUT = 5.0
+# Parallel connections per file send; stays under the receiver's per-peer connection cap
+# (inbound.MAX_PEER_CONNECTIONS, 32), which also counts our pooled chat connection
+MAX_STREAMS = 16
+RESUME_ATTEMPTS = 3 # Rounds a file send makes, resuming after dropped connections
+REPLY_TIMEOUT = 30.0 # Wait for a receiver's file_ack
+RESUME_HASH_RATE = 50 * 1024 * 1024 # Bytes/s a resuming receiver is assumed to re-hash before its file_ack
+FINISH_TIMEOUT = 300.0 # Wait for file_done; the receiver re-hashes the whole file first
+RESOLVE_WORKERS = 4 # mDNS service lookups in flight at once
+RESOLVE_TIMEOUT = 3000 # Milliseconds, as zeroconf counts them
+MAX_PARTIALS = 64 # Unfinished incoming transfers kept open at once
+PARTIAL_IDLE_TIMEOUT = 1800.0 # Unfinished transfers nobody has fed for this long are closed (the .part file stays)
+CACHE_PROBE_TIMEOUT = 0.5 # Cached peers that don't accept a connection this fast are left to mDNS
 
-class PeerListener(ServiceListener):
-    def __init__(self, network_manager):
-        self.nm = network_manager
+def ack_timeout(size):
+    """How long to wait for the file_ack to an offer of `size` bytes.
+
+    A receiver resuming a transfer re-hashes what it already has before
+    answering, so the wait grows with the file.
+    """
+    return REPLY_TIMEOUT + size / RESUME_HASH_RATE
 
-    def remove_service(self, zc, type, name):
-        if name in self.nm.peers:
-           del self.nm.peers[name]
+class PreparedMessage:
+    """A message serialized and encrypted at most once per wire format.
 
-    def add_service(self, zc, type, name):
-        info = zc.get_service_info(type, name)
-        if info:
-            self.nm.add_peer(name, info)
+    Everyone shares the vault key, so each frame is valid for every peer that
+    speaks that format (and codec) and can be sent to any number of them.
+    """
+
+    def __init__(self, network_manager, msg):
+        self.nm = network_manager
+        self.msg = msg
+        self._frames = {}
+        self._lock = threading.Lock()
 
-    def update_service(self, zc, type, name):
-        pass
+    def frame(self, wire, codec=CODEC_NONE):
+        with self._lock:
+            frame = self._frames.get((wire, codec))
+            if frame is None:
+                payload = self.nm._encode(self.msg, wire, codec)
+                frame = self.nm._build_frame(payload)
+                self._frames[(wire, codec)] = frame
+        return frame
 
 class NetworkManager:
-    def __init__(self, security_manager: SecurityManager, username: str = None):
+    def __init__(self, security_manager: SecurityManager, username: str = None, pooled: bool = True, engine: str = "threads",
+                 max_frame_size: int = MAX_FRAME_SIZE, compression: str = "off", peer_cache: PeerCache = None,
+                 limiter: InboundLimiter = None, coalesce: float = 0.0, relay_fanout: int = 0):
         self.security = security_manager
-        self.peers = {} # name -> {address, port, id, username}
+        # name -> {address, port, id, username, wire, codecs, batch, relay, multi, last_seen, latency}
+        self.peers = PeerRegistry()
+        self.peers.subscribe(self._on_peer_event)
+        # Optional in-memory cache of recently seen peers, shared across restarts
+        self.peer_cache = peer_cache
+        if peer_cache:
+            self.peers.subscribe(peer_cache.on_peer_event)
+        self.discovery = None # Set once zeroconf is up, in the background
+        self._discovery_lock = threading.Lock()
+        self.started_at = None
+        self.first_peer_after = None # Seconds from start() to the first peer, for startup timing
+        self.compressor = Compressor(compression)
+        self.partials = {} # transfer id -> PartialFile being received
+        self._partials_lock = threading.Lock()
         self.my_id = str(uuid.uuid4())
         self.username = username if username else f"Anon-{self.my_id[:6]}"
         self.running = False
         self.server_socket = None
         self.port = 0
-        self.zeroconf = Zeroconf()
+        self._clients = set() # Accepted sockets (threads engine)
+        self._clients_lock = threading.Lock()
         self.msg_callback = None
+        self.download_dir = "."
+        self.max_frame_size = max_frame_size
+        # Inbound frames are decoded by a fixed pool; the limiter caps connections, rates and memory
+        self.limiter = limiter or InboundLimiter()
+        self.decoder = DecodePool()
+        # With a window (seconds), chat messages that follow each other closely go out as one batch
+        self.coalescer = Coalescer(self, coalesce) if coalesce else None
+        # Every peer relays others' tree broadcasts; with a fanout, broadcast() sends that way too
+        self.relay = Relay(self, relay_fanout)
+        self.metrics = Metrics()
+        self._register_gauges()
+        # Persistent per-peer connections; None falls back to one connection per message
+        self.pool = ConnectionPool(on_connect=self._on_connect) if pooled else None
+        # Transport: "threads" (thread per connection) or "asyncio" (one event loop)
+        if engine == "asyncio":
+            from .aio import AsyncioEngine
+            self.engine = AsyncioEngine(self)
+            self.pool = None
+        elif engine == "threads":
+            self.engine = None
+        else:
+            raise ValueError(f"Unknown network engine: {engine}")
 
         # Setup server
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind(('0.0.0.0', 0))
         self.port = self.server_socket.getsockname()[1]
-        self.server_socket.listen(5)
+        self.server_socket.listen(socket.SOMAXCONN)
         
-        logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger("AnonBOX")
 
 
-    def start(self, callback):
+    def _register_gauges(self):
+        gauge = self.metrics.gauge
+        gauge('connections', "Open inbound connections.", lambda: self.limiter.connections)
+        gauge('outbound_connections', "Pooled outbound connections.", lambda: len(self.pool._conns) if self.pool else 0)
+        gauge('threads', "Threads in the process.", threading.active_count)
+        gauge('decode_queue_depth', "Frames waiting for a decode worker.", lambda: self.decoder.depth)
+        gauge('inflight_bytes', "Frame bytes read but not yet decoded.", lambda: self.limiter.inflight_bytes)
+        gauge('peers', "Known peers.", lambda: len(self.peers))
+        gauge('throttled_frames', "Frames delayed by per-peer rate limits (total).", lambda: self.limiter.throttled)
+        for reason in ('connections', 'queue', 'memory'):
+            gauge(f'dropped_{reason}', f"Inbound {reason} drops (total).", lambda reason=reason: self.limiter.dropped[reason])
+
+    def start(self, callback, discovery=True):
         self.msg_callback = callback
         self.running = True
+        self.started_at = time.monotonic()
+        self.decoder.start()
+        if self.coalescer:
+            self.coalescer.start()
         
         # Start TCP Server
-        threading.Thread(target=self._accept_loop, daemon=True).start()
-
-        # Register mDNS service
-        props = {'id': self.my_id, 'user': self.username}
-        info = ServiceInfo(
-            SERVICE_TYPE,
-            f"AnonPeer-{self.my_id[:8]}.{SERVICE_TYPE}",
-            addresses=[socket.inet_aton(self._get_local_ip())],
-            port=self.port,
-            properties=props,
-            server=f"anonbox-{self.my_id[:8]}.local."
-        )
-        self.zeroconf.register_service(info)
-
-        # Browse for peers
-        self.browser = ServiceBrowser(self.zeroconf, SERVICE_TYPE, PeerListener(self))
+        if self.engine:
+            self.engine.start()
+        else:
+            threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._maintenance_loop, daemon=True).start()
+
+        if not discovery:
+            self.logger.info(f"Started on port {self.port} without discovery. ID: {self.my_id}")
+            return
+
+        if self.peer_cache:
+            threading.Thread(target=self._restore_cached_peers, daemon=True).start()
+
+        # zeroconf is slow to import and announcing blocks for its probes, so none of it holds up start()
+        threading.Thread(target=self._start_discovery, name="anonbox-discovery", daemon=True).start()
         self.logger.info(f"Started on port {self.port}. ID: {self.my_id}, User: {self.username}")
 
+    def _start_discovery(self):
+        try:
+            from .discovery import Discovery
+            discovery = Discovery(self) # Browsing starts here, before our own announcement
+            with self._discovery_lock:
+                if not self.running:
+                    discovery.close()
+                    return
+                self.discovery = discovery
+            discovery.announce()
+        except Exception as e:
+            if self.running:
+                self.logger.error(f"Discovery failed to start: {e}")
+
     def add_peer(self, name, info):
         properties = info.properties
         peer_id = ""
         peer_user = "Unknown"
+        peer_wire = protocol.WIRE_JSON # Peers that don't advertise a format only speak JSON
+        peer_codecs = set()
+        peer_batch = False
+        peer_relay = False
+        peer_multi = False # Older peers read one frame per connection, then close it
         
         if properties:
             if b'id' in properties:
                 peer_id = properties[b'id'].decode('utf-8')
             if b'user' in properties:
                 peer_user = properties[b'user'].decode('utf-8')
+            if properties.get(b'wire'):
+                peer_wire = properties[b'wire'].decode('utf-8')
+            if properties.get(b'codecs'):
+                peer_codecs = set(properties[b'codecs'].decode('utf-8').split(','))
+            peer_batch = properties.get(b'batch') == b'1'
+            peer_relay = properties.get(b'relay') == b'1'
+            peer_multi = properties.get(b'multi') == b'1'
 
         if peer_id == self.my_id:
              return
 
         address = socket.inet_ntoa(info.addresses[0])
         port = info.port
-        self.peers[name] = {'address': address, 'port': port, 'id': peer_id, 'username': peer_user}
+        self.peers.add(name, {'address': address, 'port': port, 'id': peer_id, 'username': peer_user,
+                              'wire': peer_wire, 'codecs': peer_codecs, 'batch': peer_batch,
+                              'relay': peer_relay, 'multi': peer_multi})
         self.logger.info(f"Found peer: {peer_user} ({name}) at {address}:{port}")
 
+    def _on_peer_event(self, event, name, peer):
+        self.metrics.count(f"peer_{event}")
+        if event == "add" and self.first_peer_after is None and self.started_at is not None:
+            self.first_peer_after = time.monotonic() - self.started_at
+            self.logger.info(f"First peer found {self.first_peer_after * 1000:.0f} ms after start")
+        if event == "update":
+            self.logger.info(f"Peer updated: {peer['username']} ({name}) at {peer['address']}:{peer['port']}")
+        if event == "remove" and self.pool:
+            self.pool.close((peer['address'], peer['port']))
+        if event == "remove" and self.engine:
+            self.engine.close((peer['address'], peer['port']))
+        if event == "remove" and self.coalescer:
+            self.coalescer.forget((peer['address'], peer['port']))
+
+    def _restore_cached_peers(self):
+        # Cached peers that still accept connections are usable before mDNS answers
+        cached = [(name, peer) for name, peer in self.peer_cache.recent() if peer['id'] != self.my_id]
+        if not cached:
+            return
+
+        def probe(entry):
+            name, peer = entry
+            try:
+                socket.create_connection((peer['address'], peer['port']), timeout=CACHE_PROBE_TIMEOUT).close()
+            except OSError:
+                return
+            if self.running and name not in self.peers:
+                peer.pop('last_seen', None)
+                self.peers.add(name, peer)
+                self.logger.info(f"Reconnected to cached peer: {peer['username']} ({name})")
+
+        with ThreadPoolExecutor(max_workers=min(RESOLVE_WORKERS, len(cached)), thread_name_prefix="anonbox-cache") as executor:
+            list(executor.map(probe, cached))
+
     def _accept_loop(self):
         while self.running:
             try:
                 client, addr = self.server_socket.accept()
-                threading.Thread(target=self._handle_client, args=(client,), daemon=True).start()
+                # Replies are small and awaited; don't let Nagle hold them back
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # Over the cap, refuse by closing straight away rather than queueing more threads
+                if not self.limiter.admit(addr[0]):
+                    client.close()
+                    continue
+                with self._clients_lock:
+                    self._clients.add(client)
+                threading.Thread(target=self._handle_client, args=(client, addr[0]), daemon=True).start()
             except Exception as e:
                 if self.running:
                     self.logger.error(f"Accept error: {e}")
 
     def _recv_all(self, sock, count):
-        buf = b''
-        while count:
-            newbuf = sock.recv(count)
-            if not newbuf: return None
-            buf += newbuf
-            count -= len(newbuf)
-        return buf
-
-    def _handle_client(self, client_sock):
+        # Read straight into one preallocated buffer instead of concatenating
+        buf = bytearray(count)
+        return buf if self._recv_into(sock, memoryview(buf)) else None
+
+    def _recv_into(self, sock, view):
+        """Fills `view` from the socket; False if the peer closed first."""
+        pos = 0
+        count = len(view)
+        while pos < count:
+            n = sock.recv_into(view[pos:])
+            if not n: return False
+            pos += n
+        return True
+
+    def _maintenance_loop(self):
+        while self.running:
+            time.sleep(10)
+            if self.pool:
+                self.pool.close_idle()
+            self._expire_partials()
+
+    def _handle_client(self, client_sock, address):
+        # Pooled peers keep the connection open and send many frames on it
+        client_sock.settimeout(SERVER_IDLE_TIMEOUT)
         try:
-            # Read 4-byte length header
-            length_bytes = self._recv_all(client_sock, 4)
-            if not length_bytes:
-                return
-            
-            msg_len = struct.unpack('>I', length_bytes)[0]
-            
-            # Read full message
-            encrypted_data = self._recv_all(client_sock, msg_len)
-            if not encrypted_data:
-                return
+            while self.running:
+                delay = self.limiter.throttle(address)
+                if delay:
+                    # Not reading lets TCP flow control slow the sender down
+                    time.sleep(delay)
+                encrypted_data = self._recv_inbound_frame(client_sock)
+                if encrypted_data is None:
+                    return
 
-            # Decrypt
-            try:
-                decrypted = self.security.decrypt(encrypted_data)
-                # Parse JSON
-                msg = json.loads(decrypted.decode('utf-8'))
-                
-                if self.msg_callback:
-                    self.msg_callback(msg)
-            except Exception as e:
-                 self.logger.error(f"Decryption/Parse error: {e}")
+                self.metrics.add_bytes(address, 'in', 4 + len(encrypted_data))
+                try:
+                    # Waiting for the result keeps this connection's messages in order
+                    offer = self.decoder.submit(self._process_frame, encrypted_data).result()
+                except Overloaded:
+                    self.limiter.shed('queue')
+                    raise
+                except Exception as e:
+                     self.logger.error(f"Decryption/Parse error: {e}")
+                     continue
+                finally:
+                    self.limiter.free(len(encrypted_data))
 
+                # A failed transfer leaves unread chunks on the wire, so drop the connection
+                if offer is not None:
+                    keep_open = self._receive_file(client_sock, offer, address)
+                    self._deliver(offer)
+                    if not keep_open:
+                        return
+
+        except socket.timeout:
+            pass
+        except Overloaded as e:
+            self.logger.warning(f"Shedding connection from {address}: {e}")
         except Exception as e:
             self.logger.error(f"Client error: {e}")
         finally:
+            with self._clients_lock:
+                self._clients.discard(client_sock)
             client_sock.close()
+            self.limiter.release(address)
+
+    def _recv_inbound_frame(self, sock):
+        # Like _recv_frame, but the frame counts against the decode budget until freed
+        length_bytes = self._recv_all(sock, 4)
+        if not length_bytes:
+            return None
+        msg_len = self._check_frame_len(struct.unpack('>I', length_bytes)[0])
+        self.limiter.reserve(msg_len)
+        start = time.perf_counter()
+        try:
+            frame = self._recv_all(sock, msg_len)
+        except BaseException:
+            self.limiter.free(msg_len)
+            raise
+        if frame is None:
+            self.limiter.free(msg_len)
+        else:
+            self.metrics.observe('receive', time.perf_counter() - start)
+        return frame
+
+    def _process_frame(self, frame):
+        """Decode worker job: decrypts and parses a frame and delivers its messages.
+
+        A file offer is returned instead, for the connection's reader to receive.
+        """
+        start = time.perf_counter()
+        decrypted = self.security.decrypt(frame)
+        self.metrics.observe('decrypt', time.perf_counter() - start)
+        if not protocol.is_batch(decrypted):
+            msg = self._parse_message(decrypted)
+            if msg.get('type') == 'file':
+                return msg
+            self._deliver(msg)
+            return None
+        for payload in protocol.split_batch(decrypted):
+            msg = self._parse_message(payload)
+            # Chunks follow a file offer on the wire, so one can't ride in a batch
+            if msg.get('type') == 'file':
+                raise ValueError("File offer inside a batch")
+            self._deliver(msg)
+        return None
+
+    def _deliver(self, msg):
+        if 'relay_id' in msg and not self.relay.receive(msg):
+            return # A tree broadcast seen before (or our own)
+        # Parallel streams of one file are reported once, by whichever finished it
+        if self.msg_callback and not msg.get('stream_part'):
+            start = time.perf_counter()
+            try:
+                self.msg_callback(msg)
+            except Exception as e:
+                self.logger.error(f"Message callback error: {e}")
+            self.metrics.observe('callback', time.perf_counter() - start)
+
+    def _recv_frame(self, sock):
+        # Read 4-byte length header
+        length_bytes = self._recv_all(sock, 4)
+        if not length_bytes:
+            return None
+        msg_len = self._check_frame_len(struct.unpack('>I', length_bytes)[0])
+        # Read full message
+        return self._recv_all(sock, msg_len)
+
+    def _check_frame_len(self, msg_len):
+        if msg_len > self.max_frame_size:
+            raise ValueError(f"Frame of {msg_len} bytes exceeds limit of {self.max_frame_size}")
+        return msg_len
+
+    def _decode_message(self, encrypted_data):
+        return self._parse_message(self.security.decrypt(encrypted_data))
+
+    def _parse_message(self, decrypted):
+        # Binary envelope or JSON, told apart by the leading magic bytes
+        start = time.perf_counter()
+        msg = protocol.decode(decrypted, self.max_frame_size)
+        self.metrics.observe('parse', time.perf_counter() - start)
+        self.peers.touch_id(msg.get('sender_id'))
+        return msg
+
+    def _connect(self, address, timeout=None):
+        # The TCP handshake doubles as a latency sample for the peer
+        start = time.monotonic()
+        sock = socket.create_connection(address, timeout=timeout)
+        self._on_connect(address, time.monotonic() - start)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _on_connect(self, address, seconds):
+        self.peers.record_latency(address, seconds)
+        self.metrics.observe('connect', seconds)
+
+    def _receive_file(self, client_sock, msg, address):
+        """Runs the receive side of a file transfer on `client_sock`."""
+        try:
+            incoming = IncomingFile(self, msg)
+        except ValueError as e:
+            self.logger.error(f"Refused file offer: {e}")
+            return False
+        try:
+            reply = incoming.open()
+            if reply:
+                client_sock.sendall(reply)
+            while not incoming.done:
+                length_bytes = self._recv_all(client_sock, 4)
+                if not length_bytes:
+                    raise ConnectionError("Connection closed mid-transfer")
+                frame_len = incoming.check_frame_len(struct.unpack('>I', length_bytes)[0])
+                self.metrics.add_bytes(address, 'in', 4 + frame_len)
+                if incoming.direct and frame_len > 4:
+                    self._recv_direct_chunk(client_sock, incoming, frame_len)
+                    continue
+                # Buffered chunks count against the decode budget like any inbound frame
+                self.limiter.reserve(frame_len)
+                try:
+                    frame = self._recv_all(client_sock, frame_len)
+                    if frame is None:
+                        raise ConnectionError("Connection closed mid-transfer")
+                    incoming.write_frame(frame)
+                finally:
+                    self.limiter.free(frame_len)
+            reply = incoming.finish()
+            if reply:
+                client_sock.sendall(reply)
+        except Exception as e:
+            self.logger.error(f"File receive error: {e}")
+            incoming.close(e)
+            return False
+        return True
+
+    def _recv_direct_chunk(self, sock, incoming, frame_len):
+        # Plaintext chunks are received straight into the mapped file, with no buffer in between
+        index_bytes = self._recv_all(sock, 4)
+        if index_bytes is None:
+            raise ConnectionError("Connection closed mid-transfer")
+        index = struct.unpack('>I', index_bytes)[0]
+        view = incoming.chunk_view(index, frame_len - 4)
+        if view is None:
+            # A chunk we already have (or a malformed one): take the normal path
+            body = self._recv_all(sock, frame_len - 4)
+            if body is None:
+                raise ConnectionError("Connection closed mid-transfer")
+            incoming.write_chunk(index, body)
+            return
+        if not self._recv_into(sock, view):
+            view.release()
+            raise ConnectionError("Connection closed mid-transfer")
+        incoming.commit(index, view)
+
+    def _get_partial(self, msg):
+        """The PartialFile for an offer, opened and attached to the caller's connection.
+
+        Chunks left by an earlier run are not verified yet; the caller does
+        that with PartialFile.verify(), outside this lock.
+        """
+        with self._partials_lock:
+            partial = self.partials.get(msg['transfer_id'])
+            if partial is None or partial.finished or not partial.matches(msg):
+                if partial is not None and not partial.finished and not partial.idle_for():
+                    raise ValueError("A different file with this transfer id is being received")
+                new = PartialFile(self.download_dir, msg)
+                if partial is not None:
+                    partial.close()
+                    del self.partials[partial.transfer_id]
+                elif len(self.partials) >= MAX_PARTIALS:
+                    self._evict_partial()
+                partial = self.partials[new.transfer_id] = new
+            partial.open()
+            # Attached before the lock is released, so expiry never closes it under the caller
+            partial.attach()
+            return partial
+
+    def _evict_partial(self):
+        # Makes room by closing the transfer that has been idle longest; called with the lock held
+        idle = [(p.idle_for(), tid) for tid, p in self.partials.items()]
+        seconds, transfer_id = max(idle)
+        if not seconds:
+            raise ValueError(f"Too many transfers in progress ({len(self.partials)})")
+        self.partials.pop(transfer_id).close()
+
+    def _expire_partials(self):
+        with self._partials_lock:
+            stale = [tid for tid, p in self.partials.items() if p.idle_for() > PARTIAL_IDLE_TIMEOUT]
+            for transfer_id in stale:
+                self.partials.pop(transfer_id).close()
+        if stale:
+            self.logger.info(f"Closed {len(stale)} idle unfinished transfer(s)")
 
-    def send_message(self, target_ip, target_port, message_type="chat", content=None, filename=None):
+    def _drop_partial(self, partial):
+        with self._partials_lock:
+            if self.partials.get(partial.transfer_id) is partial:
+                del self.partials[partial.transfer_id]
+        partial.close()
+
+    def _reply_frame(self, message_type, **extra):
+        # The receiver doesn't know what the sender speaks, but every peer reads JSON
+        return self._build_message(message_type, **extra).frame(protocol.WIRE_JSON)
+
+    def _read_reply(self, sock):
+        frame = self._recv_frame(sock)
+        if frame is None:
+            raise ConnectionError("Connection closed while waiting for a reply")
+        return self._decode_message(frame)
+
+    def _encode(self, msg, wire, codec=CODEC_NONE):
+        start = time.perf_counter()
+        payload = protocol.encode(msg, wire, self.compressor, codec)
+        self.metrics.observe('serialize', time.perf_counter() - start)
+        return payload
+
+    def _build_frame(self, payload_bytes):
+        # Encrypt with room for the length header in front, then fill it in
+        start = time.perf_counter()
+        frame = self.security.encrypt(payload_bytes, headroom=4)
+        self.metrics.observe('encrypt', time.perf_counter() - start)
+        struct.pack_into('>I', frame, 0, len(frame) - 4)
+        # Read-only, so a prepared frame can be shared between senders safely
+        return memoryview(frame).toreadonly()
+
+    def _build_message(self, message_type, content=None, filename=None, **extra):
         msg_payload = {
             'sender_id': self.my_id,
             'sender_name': self.username,
@@ -150,39 +557,307 @@ class NetworkManager:
             'filename': filename,
             'timestamp': time.time()
         }
-        
-        payload_bytes = json.dumps(msg_payload).encode('utf-8')
-        encrypted = self.security.encrypt(payload_bytes)
-        
-        # Add length header
-        length_header = struct.pack('>I', len(encrypted))
+        msg_payload.update(extra)
+        return PreparedMessage(self, msg_payload)
 
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((target_ip, target_port))
-            s.sendall(length_header + encrypted)
+    def _wire_for(self, address):
+        peer = self.peers.by_endpoint(address)
+        return protocol.WIRE_BINARY if peer and peer['wire'] == protocol.WIRE_BINARY else protocol.WIRE_JSON
+
+    def _codec_for(self, address):
+        # Only binary envelopes have a compression flag
+        peer = self.peers.by_endpoint(address)
+        if not peer or peer['wire'] != protocol.WIRE_BINARY:
+            return CODEC_NONE
+        return self.compressor.pick(peer['codecs'])
+
+    def _frame_for(self, frame, address):
+        if isinstance(frame, PreparedMessage):
+            return frame.frame(self._wire_for(address), self._codec_for(address))
+        return frame
+
+    def _file_codec(self, addresses):
+        codecs = {self._codec_for(address) for address in addresses}
+        return codecs.pop() if len(codecs) == 1 else CODEC_NONE
+
+    def _persistent(self, address):
+        # Only peers that say they read many frames per connection get a kept-open one
+        peer = self.peers.by_endpoint(address)
+        return bool(peer and peer.get('multi'))
+
+    def _can_batch(self, frame, address):
+        if not isinstance(frame, PreparedMessage) or frame.msg['type'] != 'chat':
+            return False
+        peer = self.peers.by_endpoint(address)
+        return bool(peer and peer.get('batch'))
+
+    def _send_frame(self, target_ip, target_port, frame, connect_timeout=None, send_timeout=None, wait=True):
+        address = (target_ip, target_port)
+        if self.coalescer and self._can_batch(frame, address):
+            # Sent now if the peer is idle, or held briefly to share a frame with what follows
+            queued = self.coalescer.send(address, frame, connect_timeout, send_timeout)
+            if queued and wait:
+                # Raises if the batch couldn't be written, or took longer than the caller's timeouts allow
+                queued.result(timeout=self.coalescer.wait_limit(connect_timeout, send_timeout))
+            return
+        self._write_frame(address, self._frame_for(frame, address), connect_timeout, send_timeout)
+
+    def _write_frame(self, address, frame, connect_timeout=None, send_timeout=None):
+        start = time.perf_counter()
+        self._send_bytes(address, frame, connect_timeout, send_timeout)
+        self.metrics.observe('send', time.perf_counter() - start)
+        self.metrics.add_bytes(address[0], 'out', len(frame))
+
+    def _send_bytes(self, address, frame, connect_timeout=None, send_timeout=None):
+        persistent = self._persistent(address)
+        if self.engine:
+            self.engine.send_frame(address, frame, connect_timeout, send_timeout, persistent)
+        elif self.pool and persistent:
+            # Connections are keyed by the peer's advertised endpoint
+            self.pool.send(address, address, frame, connect_timeout, send_timeout)
+        else:
+            s = self._connect(address, connect_timeout)
+            s.settimeout(send_timeout)
+            s.sendall(frame)
             s.close()
+
+    def prepare_message(self, message_type="chat", content=None, filename=None):
+        """Returns a PreparedMessage that can be handed to send_prepared as many times as needed."""
+        return self._build_message(message_type, content, filename)
+
+    def send_prepared(self, target_ip, target_port, frame, wait=True):
+        # With wait=False a message held for coalescing counts as sent once queued
+        try:
+            self._send_frame(target_ip, target_port, frame, wait=wait)
             return True
         except Exception as e:
             self.logger.error(f"Send error: {e}")
             return False
 
-    def broadcast(self, message):
-         for peer in self.peers.values():
-             self.send_message(peer['address'], peer['port'], content=message)
+    def send_message(self, target_ip, target_port, message_type="chat", content=None, filename=None, wait=True):
+        return self.send_prepared(target_ip, target_port, self.prepare_message(message_type, content, filename), wait)
+
+    def send_prepared_to_peers(self, peers, frame, connect_timeout=BROADCAST_CONNECT_TIMEOUT, send_timeout=BROADCAST_SEND_TIMEOUT):
+        """Sends one prepared frame to several peers concurrently.
+
+        `peers` is a list of (name, peer) pairs. Returns {peer name:
+        {'username', 'ok', 'error'}} so callers can report who was reached.
+        """
+        if not peers:
+            return {}
+
+        errors = {}
+        with ThreadPoolExecutor(max_workers=min(BROADCAST_WORKERS, len(peers))) as executor:
+            futures = {
+                executor.submit(self._send_frame, peer['address'], peer['port'], frame, connect_timeout, send_timeout): name
+                for name, peer in peers
+            }
+            for future in as_completed(futures):
+                errors[futures[future]] = future.exception()
+        return self._delivery_report(peers, errors)
+
+    def broadcast(self, message, peers=None, connect_timeout=BROADCAST_CONNECT_TIMEOUT, send_timeout=BROADCAST_SEND_TIMEOUT):
+        """Sends a chat message to `peers` ((name, peer) pairs, default every known peer).
+
+        Returns the report of send_prepared_to_peers. With a relay fanout and
+        more peers than that, the message goes out along a relay tree instead
+        (see Relay.broadcast).
+        """
+        peers = self.peers.items() if peers is None else peers
+        if self.relay.fanout and len(peers) > self.relay.fanout:
+            return self.relay.broadcast(message, peers, connect_timeout, send_timeout)
+        frame = self.prepare_message('chat', message)
+        return self.send_prepared_to_peers(peers, frame, connect_timeout, send_timeout)
 
-    def _get_local_ip(self):
+    def send_file(self, target_ip, target_port, path, streams=1):
+        """Streams a file as a small header frame followed by encrypted chunk frames.
+
+        With `streams` > 1 (up to MAX_STREAMS) the chunks are split across
+        that many parallel connections, each encrypting and sending its own
+        range.
+        """
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(('8.8.8.8', 80))
-            IP = s.getsockname()[0]
-            s.close()
-            return IP
-        except:
-            return "127.0.0.1"
+            error = self._stream_file({'target': (target_ip, target_port)}, path, streams=streams)['target']
+        except Exception as e:
+            error = e
+        if error:
+            self.logger.error(f"File send error: {error}")
+        return error is None
+
+    def share_file(self, peers, path, connect_timeout=BROADCAST_CONNECT_TIMEOUT, send_timeout=BROADCAST_SEND_TIMEOUT):
+        """Streams one file to several peers, reading and encrypting each chunk once.
+
+        `peers` is a list of (name, peer) pairs; returns the same report as
+        send_prepared_to_peers.
+        """
+        targets = {name: (peer['address'], peer['port']) for name, peer in peers}
+        try:
+            errors = self._stream_file(targets, path, connect_timeout, send_timeout)
+        except Exception as e:
+            # Reading the file failed, so nobody got it
+            errors = {name: e for name in targets}
+        return self._delivery_report(peers, errors)
+
+    def _stream_file(self, targets, path, connect_timeout=None, send_timeout=None, streams=1):
+        """Sends `path` to every {name: address} target; returns {name: error or None}.
+
+        Targets whose connection drops are retried, and each retry only sends
+        the chunks the receiver reports missing.
+        """
+        if not 1 <= streams <= MAX_STREAMS:
+            raise ValueError(f"streams must be between 1 and {MAX_STREAMS}")
+        outgoing = OutgoingFile(self, path, self._file_codec(targets.values()))
+        errors = {}
+        pending = dict(targets)
+        try:
+            for attempt in range(RESUME_ATTEMPTS):
+                if attempt:
+                    self.logger.info(f"Resuming transfer of {os.path.basename(path)} to {len(pending)} peer(s)")
+                if self.engine:
+                    round_errors = self.engine.send_file_round(outgoing, pending, connect_timeout, send_timeout, streams)
+                else:
+                    round_errors = self._send_file_round(outgoing, pending, connect_timeout, send_timeout, streams)
+                errors.update(round_errors)
+                pending = {name: pending[name] for name, error in round_errors.items() if self._resumable(error)}
+                if not pending:
+                    break
+        finally:
+            outgoing.close()
+
+        for name in targets:
+            errors.setdefault(name, None)
+        return errors
+
+    def _resumable(self, error):
+        return isinstance(error, ConnectionError) and not isinstance(error, ConnectionRefusedError)
+
+    def _send_file_round(self, outgoing, targets, connect_timeout=None, send_timeout=None, streams=1):
+        # Files get their own connections so chat on the pooled ones isn't held up
+        errors = {}
+        conns = {} # (name, stream) -> socket
+        need = {}
+        header = outgoing.header()
+        # Every stream is offered before any chunk goes out, so the receiver knows to wait for all of them
+        for name, address in targets.items():
+            for stream in range(streams):
+                try:
+                    conns[name, stream] = s = self._connect(address, connect_timeout)
+                    s.settimeout(send_timeout)
+                    s.sendall(self._frame_for(header, address))
+                    s.settimeout(ack_timeout(outgoing.size))
+                    need[name] = outgoing.missing(self._read_reply(s))
+                    s.settimeout(send_timeout)
+                except Exception as e:
+                    errors[name] = e
+                    for key in [key for key in conns if key[0] == name]:
+                        conns.pop(key).close()
+                    break
+
+        def drop(key, error):
+            errors.setdefault(key[0], error)
+            conns.pop(key).close()
+
+        def send_range(stream, indexes):
+            # Each chunk is read and encrypted once, then written to every peer missing it
+            for index in indexes:
+                needed_by = [key for key in list(conns) if key[1] == stream and index in need[key[0]]]
+                if not needed_by:
+                    continue
+                if outgoing.zero_copy:
+                    # Plaintext chunks go from the page cache to the socket with sendfile()
+                    header, offset, length = outgoing.chunk_range(index)
+                    for key in needed_by:
+                        try:
+                            conns[key].sendall(header)
+                            conns[key].sendfile(outgoing.file, offset, length)
+                            self.metrics.add_bytes(targets[key[0]][0], 'out', len(header) + length)
+                        except OSError as e:
+                            drop(key, e)
+                    continue
+                frame = outgoing.chunk_frame(index)
+                for key in needed_by:
+                    try:
+                        conns[key].sendall(frame)
+                        self.metrics.add_bytes(targets[key[0]][0], 'out', len(frame))
+                    except OSError as e:
+                        drop(key, e)
+
+        try:
+            ranges = split_indexes(set().union(*need.values()), streams)
+            if streams == 1:
+                send_range(0, ranges[0])
+            else:
+                with ThreadPoolExecutor(max_workers=streams, thread_name_prefix="anonbox-stream") as executor:
+                    for future in [executor.submit(send_range, stream, indexes) for stream, indexes in enumerate(ranges)]:
+                        future.result()
+
+            # The receiver answers once all streams have ended, so end them all before reading
+            for key in list(conns):
+                try:
+                    conns[key].sendall(END_OF_CHUNKS)
+                except OSError as e:
+                    drop(key, e)
+            for key in list(conns):
+                try:
+                    conns[key].settimeout(FINISH_TIMEOUT)
+                    outgoing.check_done(self._read_reply(conns[key]))
+                except Exception as e:
+                    drop(key, e)
+        finally:
+            for s in conns.values():
+                s.close()
+
+        for name in targets:
+            errors.setdefault(name, None)
+        return errors
+
+    def _delivery_report(self, peers, errors):
+        results = {}
+        for name, peer in peers:
+            error = errors.get(name)
+            if error:
+                self.logger.error(f"Delivery to {peer['username']} failed: {error}")
+            results[name] = {'username': peer['username'], 'ok': error is None, 'error': str(error) if error else None}
+        return results
+
+    def stats(self):
+        """Counters for the frontends' stats views."""
+        inbound = self.limiter.summary()
+        inbound.update(queue_depth=self.decoder.depth, decode_workers=self.decoder.workers)
+        stats = {'compression': self.compressor.summary(), 'inbound': inbound, 'metrics': self.metrics.summary(),
+                 'discovery': {'peers': len(self.peers), 'first_peer_after': self.first_peer_after}}
+        if self.coalescer:
+            stats['coalescing'] = self.coalescer.summary()
+        stats['relay'] = self.relay.summary()
+        return stats
 
     def stop(self):
+        if self.coalescer:
+            self.coalescer.stop()
+        self.metrics.stop_dump()
         self.running = False
-        self.zeroconf.close()
+        self.relay.stop()
+        with self._discovery_lock:
+            discovery, self.discovery = self.discovery, None
+        if discovery:
+            discovery.close()
+        if self.pool:
+            self.pool.close_all()
+        if self.engine:
+            self.engine.stop()
+        self.decoder.stop()
+        try:
+            # close() alone leaves the socket listening while accept() is blocked on it
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.server_socket.close()
+        # Peers see EOF straight away, as when the process exits, rather than writing into a stopped manager
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
@@ -0,0 +1,228 @@
+import bisect
+import threading
+import time
+
+CACHE_TTL = 600.0 # Seconds a cached peer is worth trying again
+
+class PeerRegistry:
+    """Known peers, shared by the discovery thread, the network code and the UI.
+
+    Every access takes a short lock, and iteration works on a copy, so peers
+    can come and go while others are being listed. Peers are indexed by
+    mDNS name, peer id and endpoint, with sorted id, name and username
+    lists for prefix search. Listeners registered with subscribe() are
+    called with ("add" | "update" | "remove", name, peer) on every change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peers = {} # mDNS name -> peer dict
+        self._by_id = {} # peer id -> name
+        self._by_endpoint = {} # (address, port) -> name
+        self._ids = [] # sorted (id, name)
+        self._names = [] # sorted names
+        self._usernames = [] # sorted (lower-cased username, name)
+        self._listeners = []
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _emit(self, event, name, peer):
+        for callback in list(self._listeners):
+            callback(event, name, peer)
+
+    # Changes
+
+    def add(self, name, peer):
+        """Adds or replaces a peer; emits "add", or "update" if it changed."""
+        peer.setdefault('last_seen', time.monotonic())
+        peer.setdefault('latency', None)
+        with self._lock:
+            old = self._peers.get(name)
+            if old is not None:
+                self._unindex(name, old)
+                # Keep what we've measured about a peer across re-announcements
+                peer['latency'] = peer['latency'] if peer['latency'] is not None else old['latency']
+            self._peers[name] = peer
+            self._index(name, peer)
+        if old is None:
+            self._emit("add", name, peer)
+        elif self._describe(old) != self._describe(peer):
+            self._emit("update", name, peer)
+
+    def remove(self, name):
+        """Removes a peer by mDNS name; returns it (or None) and emits "remove"."""
+        with self._lock:
+            peer = self._peers.pop(name, None)
+            if peer is not None:
+                self._unindex(name, peer)
+        if peer is not None:
+            self._emit("remove", name, peer)
+        return peer
+
+    def clear(self):
+        for name in self.names():
+            self.remove(name)
+
+    def _describe(self, peer):
+        return {k: v for k, v in peer.items() if k not in ('last_seen', 'latency')}
+
+    def _index(self, name, peer):
+        self._by_id[peer['id']] = name
+        self._by_endpoint[(peer['address'], peer['port'])] = name
+        bisect.insort(self._ids, (peer['id'], name))
+        bisect.insort(self._names, name)
+        bisect.insort(self._usernames, (peer['username'].lower(), name))
+
+    def _unindex(self, name, peer):
+        if self._by_id.get(peer['id']) == name:
+            del self._by_id[peer['id']]
+        endpoint = (peer['address'], peer['port'])
+        if self._by_endpoint.get(endpoint) == name:
+            del self._by_endpoint[endpoint]
+        self._discard(self._ids, (peer['id'], name))
+        self._discard(self._names, name)
+        self._discard(self._usernames, (peer['username'].lower(), name))
+
+    def _discard(self, items, item):
+        i = bisect.bisect_left(items, item)
+        if i < len(items) and items[i] == item:
+            del items[i]
+
+    # Liveness
+
+    def touch(self, name):
+        """Marks a peer as seen just now."""
+        peer = self._peers.get(name)
+        if peer is not None:
+            peer['last_seen'] = time.monotonic()
+
+    def touch_id(self, peer_id):
+        name = self._by_id.get(peer_id)
+        if name:
+            self.touch(name)
+
+    def record_latency(self, endpoint, seconds):
+        """Records a round-trip estimate (e.g. a TCP handshake) for the peer at `endpoint`."""
+        with self._lock:
+            name = self._by_endpoint.get(endpoint)
+            peer = self._peers.get(name)
+            if peer is None:
+                return
+            # Smoothed like TCP's RTT estimate so one slow handshake doesn't dominate
+            peer['latency'] = seconds if peer['latency'] is None else peer['latency'] * 0.875 + seconds * 0.125
+            peer['last_seen'] = time.monotonic()
+
+    # Lookups
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._peers.get(name, default)
+
+    def by_id(self, peer_id):
+        with self._lock:
+            return self._peers.get(self._by_id.get(peer_id))
+
+    def by_endpoint(self, endpoint):
+        with self._lock:
+            return self._peers.get(self._by_endpoint.get(endpoint))
+
+    def find(self, query):
+        """Finds a peer by exact mDNS name or id, then by id, name or username prefix.
+
+        Returns a (name, peer) pair or None.
+        """
+        with self._lock:
+            name = query if query in self._peers else self._by_id.get(query)
+            if name is None:
+                name = self._prefix(self._ids, query)
+            if name is None:
+                name = self._prefix_name(query)
+            if name is None:
+                name = self._prefix(self._usernames, query.lower())
+            if name is None:
+                return None
+            return name, self._peers[name]
+
+    def _prefix(self, items, prefix):
+        i = bisect.bisect_left(items, (prefix,))
+        if i < len(items) and items[i][0].startswith(prefix):
+            return items[i][1]
+        return None
+
+    def _prefix_name(self, prefix):
+        i = bisect.bisect_left(self._names, prefix)
+        if i < len(self._names) and self._names[i].startswith(prefix):
+            return self._names[i]
+        return None
+
+    # Snapshots
+
+    def items(self):
+        with self._lock:
+            return list(self._peers.items())
+
+    def names(self):
+        with self._lock:
+            return list(self._peers)
+
+    def values(self):
+        with self._lock:
+            return list(self._peers.values())
+
+    def __contains__(self, name):
+        return name in self._peers
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._peers[name]
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __iter__(self):
+        return iter(self.names())
+
+class PeerCache:
+    """Recently seen peers, kept in memory only.
+
+    Hand the same cache to a new NetworkManager (e.g. after the network
+    layer restarts) and it can reconnect to known peers straight away
+    instead of waiting for mDNS browsing to find them again.
+    """
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {} # name -> (peer, monotonic time seen)
+
+    def remember(self, name, peer):
+        with self._lock:
+            self._entries[name] = (dict(peer), time.monotonic())
+
+    def forget(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def recent(self):
+        """(name, peer) pairs seen within the TTL; expired entries are dropped."""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            for name in [n for n, (_, seen) in self._entries.items() if seen < cutoff]:
+                del self._entries[name]
+            return [(name, dict(peer)) for name, (peer, _) in self._entries.items()]
+
+    def on_peer_event(self, event, name, peer):
+        """PeerRegistry listener that keeps the cache in step with discovery."""
+        if event == "remove":
+            self.forget(name)
+        else:
+            self.remember(name, peer)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,127 @@
+import socket
+import select
+import threading
+import time
+
+CONNECT_TIMEOUT = 5.0
+IDLE_TIMEOUT = 30.0 # Client side; kept below the server's idle timeout
+
+class PooledConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def is_stale(self, idle_timeout):
+        if time.monotonic() - self.last_used > idle_timeout:
+            return True
+        # The server never writes on a chat connection, so a readable socket
+        # means the peer has closed it (EOF) or reset it.
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    """Long-lived outbound connections, one per peer, carrying many frames each."""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, idle_timeout=IDLE_TIMEOUT, on_connect=None):
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.on_connect = on_connect # Called with (address, seconds the handshake took)
+        self._conns = {} # key -> PooledConnection
+        self._lock = threading.Lock()
+
+    def _connect(self, address, timeout=None):
+        start = time.monotonic()
+        sock = socket.create_connection(address, timeout=timeout or self.connect_timeout)
+        if self.on_connect:
+            self.on_connect(address, time.monotonic() - start)
+        # Chat frames are small and should leave at once, not wait on Nagle for an ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        return PooledConnection(sock)
+
+    def _acquire(self, key, address, connect_timeout=None):
+        with self._lock:
+            conn = self._conns.get(key)
+        if conn is not None:
+            return conn
+
+        # Connect outside the pool lock so one slow peer doesn't stall the rest
+        conn = self._connect(address, connect_timeout)
+        with self._lock:
+            existing = self._conns.setdefault(key, conn)
+        if existing is not conn:
+            conn.close()
+        return existing
+
+    def _discard(self, key, conn):
+        with self._lock:
+            if self._conns.get(key) is conn:
+                del self._conns[key]
+        conn.close()
+
+    def _sendall(self, key, conn, data, send_timeout):
+        conn.sock.settimeout(send_timeout)
+        try:
+            conn.sock.sendall(data)
+        except socket.timeout:
+            # Part of the frame may be on the wire; the stream can't be reused
+            self._discard(key, conn)
+            raise
+        conn.sock.settimeout(None)
+        conn.last_used = time.monotonic()
+
+    def send(self, key, address, data, connect_timeout=None, send_timeout=None):
+        """Sends one frame to `address`, reconnecting once if the pooled socket is dead.
+
+        A send that exceeds `send_timeout` is not retried.
+        """
+        conn = self._acquire(key, address, connect_timeout)
+        with conn.lock:
+            if not conn.is_stale(self.idle_timeout):
+                try:
+                    self._sendall(key, conn, data, send_timeout)
+                    return
+                except socket.timeout:
+                    raise
+                except OSError:
+                    pass
+        self._discard(key, conn)
+
+        conn = self._acquire(key, address, connect_timeout)
+        with conn.lock:
+            try:
+                self._sendall(key, conn, data, send_timeout)
+            except OSError:
+                self._discard(key, conn)
+                raise
+
+    def close(self, key):
+        with self._lock:
+            conn = self._conns.pop(key, None)
+        if conn:
+            conn.close()
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [k for k, c in self._conns.items() if now - c.last_used > self.idle_timeout]
+            conns = [self._conns.pop(k) for k in idle]
+        for conn in conns:
+            conn.close()
+
+    def close_all(self):
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
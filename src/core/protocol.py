@@ -0,0 +1,160 @@
+import json
+import struct
+from .compression import CODEC_NONE, decompress
+
+# Wire formats a peer can advertise in its mDNS "wire" property
+WIRE_JSON = "json"
+WIRE_BINARY = "bin1"
+
+MAGIC = b'\xabB' # Can't start a JSON document, so receivers tell the formats apart
+VERSION = 1
+BATCH_MAGIC = b'\xabL' # Several payloads sent in one frame, each with a length prefix
+BATCH_ITEM = struct.Struct('>I')
+
+# Message types with a compact code; anything else is sent as JSON
+TYPES = ['chat', 'file']
+TYPE_CODES = {name: code for code, name in enumerate(TYPES, 1)}
+
+FLAG_TEXT = 0x01 # content is UTF-8 text rather than raw bytes
+FLAG_EXTRA = 0x02 # extra fields follow as a small JSON object
+FLAG_COMPRESSED = 0x04 # content is compressed; the codec id is in bits 4-5
+CODEC_SHIFT = 4
+CODEC_MASK = 0x3
+
+MAX_CONTENT = 64 * 1024 * 1024 # Decompression stops here
+
+# magic, version, type, flags, timestamp, sender id, name/filename/extra/content lengths
+HEADER = struct.Struct('>2sBBBxd16sHHHI')
+
+def encode_json(msg):
+    return json.dumps(msg).encode('utf-8')
+
+def decode_json(data):
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    return json.loads(data.decode('utf-8'))
+
+def _id_to_bytes(sender_id):
+    raw = bytes.fromhex(sender_id.replace('-', ''))
+    if len(raw) != 16:
+        raise ValueError("sender_id is not a UUID")
+    return raw
+
+def _id_from_bytes(raw):
+    # Same text as str(uuid.UUID(bytes=raw)), without building the object
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def encode_binary(msg, compressor=None, codec=CODEC_NONE):
+    """Packs a message dict into the versioned binary envelope.
+
+    With a compressor and codec, the content body is compressed first (when
+    it's worth it) and flagged so the receiver knows to inflate it.
+    """
+    flags = 0
+    content = msg.get('content')
+    if content is None:
+        content = b''
+    elif isinstance(content, str):
+        content = content.encode('utf-8')
+        flags |= FLAG_TEXT
+
+    if compressor and codec and content:
+        used, content = compressor.compress(content, codec)
+        if used:
+            flags |= FLAG_COMPRESSED | (used << CODEC_SHIFT)
+
+    name = (msg.get('sender_name') or '').encode('utf-8')
+    filename = (msg.get('filename') or '').encode('utf-8')
+    extra = {k: v for k, v in msg.items() if k not in ('sender_id', 'sender_name', 'type', 'content', 'filename', 'timestamp')}
+    extra = json.dumps(extra, separators=(',', ':')).encode('utf-8') if extra else b''
+    if extra:
+        flags |= FLAG_EXTRA
+
+    header = HEADER.pack(MAGIC, VERSION, TYPE_CODES[msg['type']], flags, msg.get('timestamp', 0.0),
+                         _id_to_bytes(msg['sender_id']), len(name), len(filename), len(extra), len(content))
+    return b''.join((header, name, filename, extra, content))
+
+def is_binary(data):
+    return bytes(data[:2]) == MAGIC
+
+def decode_binary(data, max_content=MAX_CONTENT):
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise ValueError("Truncated binary envelope")
+    (_, version, type_code, flags, timestamp, sender_id,
+     name_len, filename_len, extra_len, content_len) = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    if not 0 < type_code <= len(TYPES):
+        raise ValueError(f"Unknown message type code {type_code}")
+
+    pos = HEADER.size
+    if pos + name_len + filename_len + extra_len + content_len != len(view):
+        raise ValueError("Binary envelope length mismatch")
+    # Short fields are cheaper to slice as bytes; the body stays a view until needed
+    head = bytes(view[pos:pos + name_len + filename_len + extra_len])
+    name = head[:name_len].decode('utf-8')
+    filename = head[name_len:name_len + filename_len].decode('utf-8') or None
+    extra = json.loads(head[name_len + filename_len:]) if flags & FLAG_EXTRA else {}
+    pos += len(head)
+    content = view[pos:]
+    if flags & FLAG_COMPRESSED:
+        content = decompress((flags >> CODEC_SHIFT) & CODEC_MASK, content, max_content)
+    if flags & FLAG_TEXT:
+        content = str(content, 'utf-8')
+    elif content_len:
+        content = bytes(content)
+    else:
+        content = None
+
+    msg = {
+        'sender_id': _id_from_bytes(sender_id),
+        'sender_name': name,
+        'type': TYPES[type_code - 1],
+        'content': content,
+        'filename': filename,
+        'timestamp': timestamp,
+    }
+    msg.update(extra)
+    return msg
+
+def encode_batch(payloads):
+    """Wraps already encoded payloads (either format) so they share one frame."""
+    parts = [BATCH_MAGIC]
+    for payload in payloads:
+        parts.append(BATCH_ITEM.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+def is_batch(data):
+    return bytes(data[:2]) == BATCH_MAGIC
+
+def split_batch(data):
+    """The payloads of a batch, as views into `data`."""
+    view = memoryview(data)
+    payloads = []
+    pos = len(BATCH_MAGIC)
+    while pos < len(view):
+        if pos + BATCH_ITEM.size > len(view):
+            raise ValueError("Truncated batch")
+        (length,) = BATCH_ITEM.unpack_from(view, pos)
+        pos += BATCH_ITEM.size
+        if pos + length > len(view):
+            raise ValueError("Batch item length mismatch")
+        payloads.append(view[pos:pos + length])
+        pos += length
+    return payloads
+
+def encode(msg, wire, compressor=None, codec=CODEC_NONE):
+    if wire == WIRE_BINARY and msg.get('type') in TYPE_CODES:
+        try:
+            return encode_binary(msg, compressor, codec)
+        except (ValueError, struct.error):
+            pass # e.g. a sender id that isn't a UUID or an oversized name; JSON can carry anything
+    return encode_json(msg)
+
+def decode(data, max_content=MAX_CONTENT):
+    if is_binary(data):
+        return decode_binary(data, max_content)
+    return decode_json(data)
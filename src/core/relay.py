@@ -0,0 +1,161 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+RELAY_WORKERS = 4 # Threads forwarding relayed broadcasts
+HANDOFF_WORKERS = 16 # Threads handing chunks of one broadcast to their first peer in parallel
+MAX_SEEN = 8192 # Broadcast ids remembered for deduplication
+RELAY_FIELDS = ('sender_id', 'sender_name', 'type', 'content', 'filename', 'timestamp', 'relay_id')
+
+def split(ids, fanout):
+    """Cuts `ids` into at most `fanout` contiguous chunks of near-equal size."""
+    if not ids:
+        return []
+    size = -(-len(ids) // fanout)
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+class Relay:
+    """Broadcast along a tree of peers instead of unicasting to each one.
+
+    The sender splits the peers it knows into `fanout` chunks and sends the
+    message once per chunk, to the chunk's first peer, along with the ids of
+    the rest. That peer does the same with its list, so the sender's cost is
+    O(fanout) and the tree is O(log N) deep. A peer that can't be reached is
+    skipped and the next one in its chunk takes its place, so peers leaving
+    mid-broadcast don't cut off their subtree. Every broadcast has an id,
+    and ids already seen are dropped, so each peer sees a message once.
+
+    Every peer forwards; only sending in this mode is opt-in.
+    """
+
+    def __init__(self, network_manager, fanout=0):
+        self.nm = network_manager
+        self.fanout = fanout
+        self._lock = threading.Lock()
+        self._seen = OrderedDict() # broadcast id -> None, oldest first
+        self._executor = ThreadPoolExecutor(max_workers=RELAY_WORKERS, thread_name_prefix="anonbox-relay")
+        # Separate from the forwarding pool, whose workers wait on these
+        self._handoffs = ThreadPoolExecutor(max_workers=HANDOFF_WORKERS, thread_name_prefix="anonbox-handoff")
+        self.originated = 0
+        self.forwarded = 0
+        self.duplicates = 0
+        self.lost = 0
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._handoffs.shutdown(wait=False, cancel_futures=True)
+
+    def _prepare(self, msg):
+        from .network import PreparedMessage # network imports this module
+        return PreparedMessage(self.nm, msg)
+
+    def _first_sighting(self, relay_id):
+        with self._lock:
+            if relay_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[relay_id] = None
+            if len(self._seen) > MAX_SEEN:
+                self._seen.popitem(last=False)
+            return True
+
+    def broadcast(self, content, peers, connect_timeout=None, send_timeout=None):
+        """Sends a chat message to `peers` ((name, peer) pairs) through the relay tree.
+
+        Returns the same report as send_prepared_to_peers; peers reached
+        through another peer are marked 'relayed', and their 'ok' means the
+        message was handed to the peer relaying it.
+        """
+        msg = self.nm._build_message('chat', content).msg
+        msg['relay_id'] = os.urandom(8).hex()
+        self._first_sighting(msg['relay_id'])
+        with self._lock:
+            self.originated += 1
+
+        # Peers that don't relay (older versions) get the message straight from us
+        relays = sorted(peer['id'] for _, peer in peers if peer.get('relay') and peer['id'])
+        direct = [(name, peer) for name, peer in peers if not (peer.get('relay') and peer['id'])]
+        results = self.nm.send_prepared_to_peers(direct, self._prepare(msg), connect_timeout, send_timeout) if direct else {}
+
+        errors = {}
+        children = set()
+        for child, chunk_errors in self._hand_off_all(msg, split(relays, self.fanout), self.fanout, connect_timeout, send_timeout):
+            children.add(child)
+            errors.update(chunk_errors)
+        for name, peer in peers:
+            if peer['id'] in errors:
+                error = errors[peer['id']]
+                if error:
+                    self.nm.logger.error(f"Relay to {peer['username']} failed: {error}")
+                results[name] = {'username': peer['username'], 'ok': error is None,
+                                 'error': str(error) if error else None, 'relayed': peer['id'] not in children}
+        return results
+
+    def receive(self, msg):
+        """Called for every inbound relayed message; False if it was seen before.
+
+        The rest of the tree below this peer is forwarded in the background.
+        """
+        relay_to = msg.pop('relay_to', None) or []
+        fanout = msg.pop('relay_fanout', None) or 1
+        if msg.get('sender_id') == self.nm.my_id or not self._first_sighting(msg['relay_id']):
+            return False
+        if relay_to and self.nm.running:
+            base = {key: msg.get(key) for key in RELAY_FIELDS}
+            self._executor.submit(self._forward, base, relay_to, fanout)
+        return True
+
+    def _forward(self, msg, relay_to, fanout):
+        from .network import BROADCAST_CONNECT_TIMEOUT, BROADCAST_SEND_TIMEOUT # network imports this module
+        chunks = split(relay_to, fanout)
+        for _, errors in self._hand_off_all(msg, chunks, fanout, BROADCAST_CONNECT_TIMEOUT, BROADCAST_SEND_TIMEOUT):
+            lost = sum(1 for error in errors.values() if error)
+            with self._lock:
+                self.forwarded += 1
+                self.lost += lost
+            if lost:
+                self.nm.logger.warning(f"Relaying broadcast {msg['relay_id']}: {lost} peer(s) unreachable")
+
+    def _hand_off_all(self, msg, chunks, fanout, connect_timeout=None, send_timeout=None):
+        """Hands off every chunk at once, so a dead peer only delays its own chunk; returns _hand_off's results."""
+        if not chunks:
+            return []
+        # The first chunk is handled on this thread, the rest alongside it
+        futures = [self._handoffs.submit(self._hand_off, msg, chunk, fanout, connect_timeout, send_timeout)
+                   for chunk in chunks[1:]]
+        first = self._hand_off(msg, chunks[0], fanout, connect_timeout, send_timeout)
+        return [first] + [future.result() for future in futures]
+
+    def _hand_off(self, msg, chunk, fanout, connect_timeout=None, send_timeout=None):
+        """Sends `msg` to the first reachable peer in `chunk`, which relays it to the rest.
+
+        Returns (that peer's id or None, {peer id: error or None} for the chunk).
+        """
+        errors = {}
+        unknown = [] # Not known here yet, but possibly to the next relay
+        pending = list(chunk)
+        while pending:
+            peer_id = pending.pop(0)
+            peer = self.nm.peers.by_id(peer_id)
+            if peer is None:
+                unknown.append(peer_id)
+                continue
+            relay_to = unknown + pending
+            frame = self._prepare(dict(msg, relay_to=relay_to, relay_fanout=fanout))
+            try:
+                self.nm._send_frame(peer['address'], peer['port'], frame, connect_timeout, send_timeout)
+            except Exception as e:
+                # Gone or unreachable: the next peer in the chunk takes over its subtree
+                errors[peer_id] = e
+                continue
+            errors[peer_id] = None
+            errors.update((other, None) for other in relay_to)
+            return peer_id, errors
+        errors.update((peer_id, LookupError("Peer not known to any relay")) for peer_id in unknown)
+        return None, errors
+
+    def summary(self):
+        with self._lock:
+            return {'fanout': self.fanout, 'originated': self.originated, 'forwarded': self.forwarded,
+                    'duplicates': self.duplicates, 'lost': self.lost}
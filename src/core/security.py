@@ -1,10 +1,104 @@
 import os
+import struct
 import hashlib
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+STREAM_PREFIX_SIZE = 7 # Random part of a stream nonce; the rest is counter + final flag
+MAX_SEGMENTS = 2 ** 32
+
+def _aesgcm(key):
+    # cryptography takes tens of milliseconds to import, so it's loaded once a key is set
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+def has_into(aesgcm):
+    # encrypt_into/decrypt_into only exist in newer cryptography releases
+    return hasattr(aesgcm, "encrypt_into")
+
+def _stream_nonce(prefix, counter, final):
+    if counter >= MAX_SEGMENTS:
+        raise OverflowError("Too many segments in one stream")
+    return prefix + struct.pack('>IB', counter, 1 if final else 0)
+
+class StreamEncryptor:
+    """Encrypts a sequence of segments with counter-derived nonces (the STREAM construction).
+
+    Nonces are a random per-stream prefix, the segment index and a flag marking
+    the last segment. Nothing but the prefix has to be sent; reordered or
+    replayed segments fail authentication, and so does a stream cut short.
+    """
+
+    def __init__(self, aesgcm, prefix=None):
+        self.aesgcm = aesgcm
+        self.prefix = prefix or os.urandom(STREAM_PREFIX_SIZE)
+        self.has_into = has_into(aesgcm)
+        self.counter = 0
+        self.finished = False
+
+    def encrypt_segment(self, data, final=False, index=None, headroom=0):
+        """Returns a bytearray with `headroom` spare bytes followed by the ciphertext."""
+        if self.finished:
+            raise ValueError("Stream already finished")
+        if index is None:
+            index = self.counter
+            self.counter += 1
+            # Only sequential use can tell where the stream ends
+            self.finished = final
+        nonce = _stream_nonce(self.prefix, index, final)
+
+        if self.has_into:
+            buf = bytearray(headroom + len(data) + TAG_SIZE)
+            self.aesgcm.encrypt_into(nonce, data, None, memoryview(buf)[headroom:])
+            return buf
+        buf = bytearray(headroom)
+        buf += self.aesgcm.encrypt(nonce, data, None)
+        return buf
+
+class StreamDecryptor:
+    """Counterpart of StreamEncryptor.
+
+    Segments are fed in the order they were produced, or with an explicit
+    `index` for random access (e.g. resumed file transfers).
+    """
+
+    def __init__(self, aesgcm, prefix):
+        if len(prefix) != STREAM_PREFIX_SIZE:
+            raise ValueError("Bad stream prefix")
+        self.aesgcm = aesgcm
+        self.prefix = prefix
+        self.has_into = has_into(aesgcm)
+        self.counter = 0
+        self.finished = False
+
+    def decrypt_segment(self, data, final=False, index=None, out=None):
+        """Decrypts one segment; with `out`, plaintext is written there and a view of it returned."""
+        if self.finished:
+            raise ValueError("Data after the final segment")
+        if index is None:
+            index = self.counter
+            self.counter += 1
+            # Only sequential use can tell where the stream ends
+            self.finished = final
+        nonce = _stream_nonce(self.prefix, index, final)
+
+        if out is not None and self.has_into:
+            size = len(data) - TAG_SIZE
+            view = memoryview(out)[:size]
+            self.aesgcm.decrypt_into(nonce, data, None, view)
+            return view
+        return self.aesgcm.decrypt(nonce, data, None)
+
+    def finish(self):
+        """Raises unless the final segment was seen (sequential use only)."""
+        if not self.finished:
+            raise ValueError("Stream truncated before its final segment")
 
 class SecurityManager:
     def __init__(self, password: str = None):
         self.key = None
+        self._aesgcm = None
+        self._has_into = False
         if password:
             self.set_password(password)
 
@@ -12,32 +106,66 @@ class SecurityManager:
         """Derives a 32-byte key from the password using SHA-256."""
         if not password:
             self.key = None
+            self._aesgcm = None
+            self._has_into = False
             return
-        
+
         # Use SHA-256 to get a fixed 32-byte key
         digest = hashlib.sha256(password.encode()).digest()
         self.key = digest
+        # The cipher context only depends on the key, so build it once
+        self._aesgcm = _aesgcm(digest)
+        self._has_into = has_into(self._aesgcm)
 
-    def encrypt(self, data: bytes) -> bytes:
-        """Encrypts data using AES-256-GCM."""
+    def encrypt(self, data: bytes, headroom: int = 0) -> bytes:
+        """Encrypts data using AES-256-GCM.
+
+        With `headroom`, a bytearray is returned with that many spare bytes in
+        front (for a frame header), so the caller needn't concatenate.
+        """
         if not self.key:
-            return data # Return plain if no encryption set (or handle as error)
-        
-        aesgcm = AESGCM(self.key)
-        nonce = os.urandom(12)
-        ciphertext = aesgcm.encrypt(nonce, data, None)
+            if not headroom:
+                return data # Return plain if no encryption set (or handle as error)
+            buf = bytearray(headroom)
+            buf += data
+            return buf
+
+        nonce = os.urandom(NONCE_SIZE)
+        if self._has_into:
+            buf = bytearray(headroom + NONCE_SIZE + len(data) + TAG_SIZE)
+            buf[headroom:headroom + NONCE_SIZE] = nonce
+            self._aesgcm.encrypt_into(nonce, data, None, memoryview(buf)[headroom + NONCE_SIZE:])
+            return buf
+        ciphertext = self._aesgcm.encrypt(nonce, data, None)
+        if headroom:
+            buf = bytearray(headroom)
+            buf += nonce
+            buf += ciphertext
+            return buf
         return nonce + ciphertext
 
     def decrypt(self, data: bytes) -> bytes:
         """Decrypts data using AES-256-GCM."""
         if not self.key:
             return data
-        
-        if len(data) < 12:
+
+        if len(data) < NONCE_SIZE:
             raise ValueError("Data too short")
-        
-        nonce = data[:12]
-        ciphertext = data[12:]
-        aesgcm = AESGCM(self.key)
-        
-        return aesgcm.decrypt(nonce, ciphertext, None)
+
+        # memoryview slices avoid copying the ciphertext out of the receive buffer
+        view = memoryview(data)
+        nonce = view[:NONCE_SIZE]
+        ciphertext = view[NONCE_SIZE:]
+
+        return self._aesgcm.decrypt(nonce, ciphertext, None)
+
+    def stream_encryptor(self):
+        """Returns a StreamEncryptor, or None in plaintext mode."""
+        if not self.key:
+            return None
+        return StreamEncryptor(self._aesgcm)
+
+    def stream_decryptor(self, prefix: bytes):
+        if not self.key:
+            raise ValueError("Encrypted stream received but no vault password is set")
+        return StreamDecryptor(self._aesgcm, prefix)
@@ -0,0 +1,156 @@
+import re
+import time
+import threading
+from collections import deque
+from itertools import islice
+
+MAX_BYTES = 16 * 1024 * 1024 # Default memory cap for stored messages
+RECORD_OVERHEAD = 220 # Per-message cost of the record, its fields and its history/peer index slots
+ENTRY_COST = 9 # Per indexed word: one slot in that word's deque (deques grow in 64-slot blocks)
+KEY_COST = 870 # Per index key (word or peer): its deque with a first block, the key and the dict slot
+WORD = re.compile(rb"\w+")
+
+class StoredMessage:
+    """One chat line in the store; the text is kept as UTF-8 in a bytearray so it can be zeroed."""
+    __slots__ = ('seq', 'timestamp', 'peer_id', 'sender_name', 'type', 'outgoing', 'body')
+
+    def __init__(self, seq, timestamp, peer_id, sender_name, type, outgoing, body):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.peer_id = peer_id
+        self.sender_name = sender_name
+        self.type = type
+        self.outgoing = outgoing
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8', 'replace')
+
+    @property
+    def size(self):
+        return len(self.body) + RECORD_OVERHEAD
+
+    def wipe(self):
+        self.body[:] = bytes(len(self.body))
+        self.body.clear()
+
+class MessageStore:
+    """RAM-only message history with a fixed memory budget.
+
+    Messages sit in a ring buffer (oldest evicted first) with per-peer and
+    per-keyword indexes, so history and keyword search don't scan the whole
+    store. The budget covers the indexes as well as the messages, so text
+    full of distinct words holds fewer messages. Evicted and wiped messages
+    have their text overwritten with zeros.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, max_messages=None):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._messages = deque()
+        self._by_peer = {} # peer id -> deque of messages, oldest first
+        # hash of a lower-cased word -> deque of messages, oldest first. Hashes
+        # rather than words, so no plaintext outlives wipe() as an index key
+        self._by_word = {}
+        self._bytes = 0
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def bytes_used(self):
+        return self._bytes
+
+    def add(self, text, peer_id=None, sender_name=None, type='chat', outgoing=False, timestamp=None):
+        """Stores one message; `peer_id` is the sender, or the recipient of an outgoing one."""
+        body = bytearray(text.encode('utf-8'))
+        with self._lock:
+            self._seq += 1
+            msg = StoredMessage(self._seq, timestamp or time.time(), peer_id, sender_name, type, outgoing, body)
+            self._messages.append(msg)
+            self._bytes += msg.size
+            if peer_id is not None:
+                self._append(self._by_peer, peer_id, msg)
+            # A word repeated in one message is indexed once
+            for word in self._words(body):
+                self._append(self._by_word, word, msg)
+                self._bytes += ENTRY_COST
+            while self._messages and (self._bytes > self.max_bytes or
+                                      (self.max_messages and len(self._messages) > self.max_messages)):
+                self._evict()
+        return msg
+
+    def _append(self, index, key, msg):
+        # Index keys cost far more than messages with few words, so they count against the budget too
+        entries = index.get(key)
+        if entries is None:
+            entries = index[key] = deque()
+            self._bytes += KEY_COST
+        entries.append(msg)
+
+    def _words(self, body):
+        return {hash(word) for word in WORD.findall(body.lower())}
+
+    def _evict(self):
+        # The oldest message is also the oldest entry in each index it appears in
+        msg = self._messages.popleft()
+        self._bytes -= msg.size
+        if msg.peer_id is not None:
+            self._popleft(self._by_peer, msg.peer_id, msg)
+        for word in self._words(msg.body):
+            self._popleft(self._by_word, word, msg)
+            self._bytes -= ENTRY_COST
+        msg.wipe()
+
+    def _popleft(self, index, key, msg):
+        entries = index.get(key)
+        if entries and entries[0] is msg:
+            entries.popleft()
+            if not entries:
+                del index[key]
+                self._bytes -= KEY_COST
+
+    def history(self, peer_id=None, limit=20):
+        """The last `limit` messages, optionally only those to or from one peer."""
+        with self._lock:
+            source = self._messages if peer_id is None else self._by_peer.get(peer_id, ())
+            return list(islice(reversed(source), limit))[::-1]
+
+    def search(self, query, limit=20):
+        """The newest `limit` messages matching `query`, case-insensitively.
+
+        A single word is looked up in the keyword index; other queries, and
+        words that match nothing whole, fall back to a substring scan.
+        """
+        needle = query.encode('utf-8')
+        with self._lock:
+            if WORD.fullmatch(needle):
+                # Index hits are re-checked, since two words can share a hash
+                entries = self._by_word.get(hash(needle.lower()), ())
+                found = self._scan(entries, rb"\b%s\b" % re.escape(needle), limit)
+                if found:
+                    return found
+            return self._scan(self._messages, re.escape(needle), limit)
+
+    def _scan(self, source, pattern, limit):
+        pattern = re.compile(pattern, re.IGNORECASE)
+        found = []
+        for msg in reversed(source):
+            if pattern.search(msg.body):
+                found.append(msg)
+                if len(found) == limit:
+                    break
+        return found[::-1]
+
+    def wipe(self):
+        """Zeroes every stored message and empties the store."""
+        with self._lock:
+            for msg in self._messages:
+                msg.wipe()
+            self._messages.clear()
+            self._by_peer.clear()
+            self._by_word.clear()
+            self._bytes = 0
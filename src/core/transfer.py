@@ -0,0 +1,480 @@
+import os
+import re
+import mmap
+import base64
+import struct
+import hashlib
+import threading
+import time
+from .security import NONCE_SIZE, TAG_SIZE
+from .compression import CODEC_IDS, CODEC_NAMES, CODEC_NONE, decompress
+
+CHUNK_SIZE = 256 * 1024 # Plaintext bytes per file chunk frame
+MAX_CHUNK_SIZE = 16 * 1024 * 1024 # Offers with larger chunks are refused
+CHUNK_OVERHEAD = 4 + 1 + NONCE_SIZE + TAG_SIZE # index, codec byte, AES-GCM nonce + tag
+HASH_SIZE = 32 # SHA-256 digest per chunk in the manifest
+INDEX = struct.Struct('>I')
+CHUNK_HEADER = struct.Struct('>II') # frame length, chunk index
+END_OF_CHUNKS = struct.pack('>I', 0) # Zero-length frame: the sender has nothing more to send
+STREAM_WAIT_TIMEOUT = 300.0 # How long a stream that has ended waits for its siblings
+TRANSFER_ID = re.compile(r'[0-9a-f]{32}') # Senders derive ids from the file hash; they end up in file names
+HAS_SENDFILE = hasattr(os, "sendfile") # Without it socket.sendfile() reads through a shared file position
+
+def chunk_count(size, chunk_size):
+    return -(-size // chunk_size)
+
+def map_file(f, size, write=False):
+    """Memory-maps an open file, or returns None for an empty one (which can't be mapped)."""
+    if not size:
+        return None
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+
+def hash_chunks(data, size, chunk_size):
+    """Returns (concatenated chunk digests, whole-file digest) of a mapped file."""
+    digests = bytearray()
+    whole = hashlib.sha256()
+    if size:
+        view = memoryview(data)
+        for offset in range(0, size, chunk_size):
+            chunk = view[offset:offset + chunk_size]
+            digests += hashlib.sha256(chunk).digest()
+            whole.update(chunk)
+        view.release()
+    return bytes(digests), whole.digest()
+
+def split_indexes(indexes, streams):
+    """Splits sorted chunk indexes into `streams` contiguous runs of similar length."""
+    indexes = sorted(indexes)
+    per_stream = -(-len(indexes) // streams) if indexes else 0
+    return [indexes[i * per_stream:(i + 1) * per_stream] for i in range(streams)]
+
+def encode_bitmap(bitmap):
+    return base64.b64encode(bitmap).decode('ascii')
+
+def decode_bitmap(text, count):
+    bitmap = bytearray(base64.b64decode(text or ''))
+    if len(bitmap) != (count + 7) // 8:
+        raise ValueError("Bitmap size doesn't match the manifest")
+    return bitmap
+
+def has_chunk(bitmap, index):
+    return bitmap[index >> 3] & (1 << (index & 7))
+
+class PartialFile:
+    """A file being received, kept on disk as a temp file plus a bitmap of verified chunks.
+
+    It outlives any one connection, so a sender that reconnects (or the same
+    file shared again) only has to fill in the chunks that are still missing.
+    Parallel streams of one transfer all write into the same PartialFile.
+    """
+
+    def __init__(self, download_dir, msg):
+        self.transfer_id = msg['transfer_id']
+        if not isinstance(self.transfer_id, str) or not TRANSFER_ID.fullmatch(self.transfer_id):
+            raise ValueError("Malformed transfer id")
+        filename = os.path.basename(msg.get('filename') or 'unknown_file')
+        self.path = os.path.join(download_dir, f"received_{filename}")
+        self.part_path = os.path.join(download_dir, f".received_{filename}.{self.transfer_id[:12]}.part")
+        self.size = int(msg['size'])
+        self.chunk_size = int(msg['chunk_size'])
+        self.count = chunk_count(self.size, self.chunk_size)
+        self.manifest = bytes.fromhex(msg['manifest'])
+        self.file_hash = bytes.fromhex(msg['sha256'])
+        if not 0 < self.chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"Unsupported chunk size {self.chunk_size}")
+        if len(self.manifest) != self.count * HASH_SIZE:
+            raise ValueError("Manifest doesn't match the announced size")
+        self.bitmap = bytearray((self.count + 7) // 8)
+        self.have = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.map = None
+        self.active = 0 # Connections currently feeding chunks
+        self.touched = time.monotonic() # Last time a connection attached or detached
+        self.reported = False
+        self.file = None
+        self.finished = False
+        self.scanned = False # Whether chunks left on disk by an earlier run have been looked for
+        self._scan_lock = threading.Lock()
+
+    def matches(self, msg):
+        return (int(msg.get('size', -1)) == self.size and int(msg.get('chunk_size', -1)) == self.chunk_size
+                and msg.get('sha256') == self.file_hash.hex())
+
+    def open(self):
+        """Opens and maps the temp file; cheap, so it can run under the manager's lock."""
+        if self.file:
+            return
+        existed = os.path.exists(self.part_path)
+        self.file = open(self.part_path, "r+b" if existed else "w+b")
+        self.file.truncate(self.size)
+        # Chunks are written (or decrypted, or received) straight into the mapping
+        self.map = map_file(self.file, self.size, write=True)
+        self.scanned = not existed
+
+    def verify(self):
+        """Finds chunks left by an earlier run by hashing them.
+
+        Runs once per file; streams arriving meanwhile wait for it, so none
+        reports what it has before the scan is done.
+        """
+        with self._scan_lock:
+            if self.scanned:
+                return
+            for index in range(self.count):
+                if self._digest_ok(index, self._slice(index)):
+                    with self.lock:
+                        self._mark(index)
+            self.scanned = True
+
+    def chunk_len(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def _slice(self, index):
+        start = index * self.chunk_size
+        return memoryview(self.map)[start:start + self.chunk_len(index)]
+
+    def _digest_ok(self, index, data):
+        expected = self.manifest[index * HASH_SIZE:(index + 1) * HASH_SIZE]
+        return hashlib.sha256(data).digest() == expected
+
+    def _mark(self, index):
+        if not has_chunk(self.bitmap, index):
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.have += 1
+
+    @property
+    def complete(self):
+        return self.have == self.count
+
+    def _check_index(self, index):
+        if not 0 <= index < self.count:
+            raise ValueError(f"Chunk index {index} out of range")
+
+    def chunk_view(self, index):
+        """A writable view of a missing chunk's place in the file, or None if it's already here.
+
+        Fill it, then call commit(); until then the chunk doesn't count as received.
+        """
+        self._check_index(index)
+        if has_chunk(self.bitmap, index):
+            return None
+        return self._slice(index)
+
+    def commit(self, index, view):
+        """Verifies a chunk filled in through chunk_view()."""
+        try:
+            if not self._digest_ok(index, view):
+                raise ValueError(f"Chunk {index} doesn't match the manifest")
+        finally:
+            view.release()
+        with self.lock:
+            self._mark(index)
+            if self.complete:
+                self.changed.notify_all()
+
+    def write(self, index, data):
+        self._check_index(index)
+        if len(data) != self.chunk_len(index) or not self._digest_ok(index, data):
+            raise ValueError(f"Chunk {index} doesn't match the manifest")
+        with self.lock:
+            if has_chunk(self.bitmap, index):
+                return
+            start = index * self.chunk_size
+            self.map[start:start + len(data)] = data
+            self._mark(index)
+            if self.complete:
+                self.changed.notify_all()
+
+    def attach(self):
+        with self.lock:
+            self.active += 1
+            self.touched = time.monotonic()
+            self.reported = False
+
+    def detach(self):
+        with self.lock:
+            self.active -= 1
+            self.touched = time.monotonic()
+            self.changed.notify_all()
+
+    def idle_for(self):
+        """Seconds since the last connection left, or 0 while one is attached."""
+        with self.lock:
+            return 0 if self.active else time.monotonic() - self.touched
+
+    def wait(self, timeout=STREAM_WAIT_TIMEOUT):
+        """Blocks until every chunk is in or no other stream is still sending."""
+        with self.lock:
+            self.changed.wait_for(lambda: self.complete or self.active == 0, timeout)
+
+    def claim_report(self):
+        """True for the first stream to report on the transfer, so it's reported once."""
+        with self.lock:
+            first = not self.reported
+            self.reported = True
+            return first
+
+    def finish(self):
+        """Checks the whole-file hash and moves the temp file into place."""
+        with self.lock:
+            if self.finished:
+                return
+            whole = hashlib.sha256(self.map).digest() if self.map else hashlib.sha256().digest()
+            self._unmap()
+            if whole != self.file_hash:
+                os.remove(self.part_path)
+                raise ValueError("Whole-file hash mismatch")
+            os.replace(self.part_path, self.path)
+            self.finished = True
+
+    def _unmap(self):
+        if self.map:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file and not self.file.closed:
+            self.file.close()
+        self.file = None
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+
+class IncomingFile:
+    """Receive side of one connection's file transfer; engines feed it frames.
+
+    open() and finish() return reply frames (or None) for the engine to write
+    back on the same connection.
+    """
+
+    def __init__(self, network_manager, msg):
+        self.nm = network_manager
+        self.msg = msg
+        self.legacy = msg.get('content') is not None
+        self.partial = None
+        self.attached = False
+        self.decryptor = None
+        self.ended = False
+        self.chunk_size = int(msg.get('chunk_size', CHUNK_SIZE))
+        if not 0 < self.chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"Unsupported chunk size {self.chunk_size}")
+        # Compressed transfers prefix each chunk with the codec byte it used
+        self.codec = msg.get('codec')
+        if self.codec is not None and self.codec not in CODEC_IDS:
+            raise ValueError(f"Unsupported codec {self.codec}")
+        # Chunk frames are held to the same limit as every other frame
+        self.max_frame = min(self.chunk_size + CHUNK_OVERHEAD, network_manager.max_frame_size)
+        self.buffer = None
+
+    @property
+    def done(self):
+        return self.legacy or self.ended
+
+    def open(self):
+        if self.legacy:
+            # Legacy peers send the whole file base64-encoded in the header
+            filename = os.path.basename(self.msg.get('filename') or 'unknown_file')
+            path = os.path.join(self.nm.download_dir, f"received_{filename}")
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(self.msg['content']))
+            self.msg['saved_as'] = path
+            return None
+
+        self.partial = self.nm._get_partial(self.msg) # Already attached
+        self.attached = True
+        # Can take a while on a large resume, so it runs outside the manager's lock
+        self.partial.verify()
+        if self.msg.get('stream'):
+            # Chunks are segments of one authenticated stream, decrypted into a reused buffer
+            self.decryptor = self.nm.security.stream_decryptor(bytes.fromhex(self.msg['stream']))
+            self.buffer = bytearray(self.max_frame)
+        return self.nm._reply_frame('file_ack', transfer_id=self.partial.transfer_id,
+                                    have=encode_bitmap(self.partial.bitmap))
+
+    def check_frame_len(self, frame_len):
+        if frame_len > self.max_frame:
+            raise ValueError(f"Chunk frame too large ({frame_len} bytes)")
+        return frame_len
+
+    @property
+    def direct(self):
+        """True when chunk frames carry raw file bytes, which can be received straight into the file."""
+        return not self.legacy and not self.codec and not self.nm.security.key
+
+    def chunk_view(self, index, length):
+        """Where a direct chunk of `length` bytes can be received, or None to read it as a normal frame."""
+        view = self.partial.chunk_view(index)
+        if view is not None and len(view) != length:
+            view.release()
+            return None
+        return view
+
+    def commit(self, index, view):
+        self.partial.commit(index, view)
+
+    def write_frame(self, frame):
+        """Handles one chunk frame: index, then the (encrypted, maybe compressed) chunk."""
+        if not frame:
+            self.ended = True
+            self._detach()
+            return
+        index = INDEX.unpack_from(frame)[0]
+        self.write_chunk(index, memoryview(frame)[INDEX.size:])
+
+    def write_chunk(self, index, body):
+        final = index == self.partial.count - 1
+        if self.decryptor and not self.codec and self.decryptor.has_into:
+            # Decrypt straight into the mapped file, skipping the intermediate buffer
+            view = self.partial.chunk_view(index)
+            if view is None:
+                return # Already have it
+            if len(body) - TAG_SIZE != len(view):
+                view.release()
+                raise ValueError(f"Chunk {index} has the wrong size")
+            self.decryptor.decrypt_segment(body, final, index=index, out=view)
+            self.partial.commit(index, view)
+            return
+
+        if self.decryptor:
+            chunk = self.decryptor.decrypt_segment(body, final, index=index, out=self.buffer)
+        else:
+            chunk = self.nm.security.decrypt(body)
+        if self.codec:
+            if chunk[0]:
+                chunk = decompress(chunk[0], chunk[1:], self.chunk_size)
+            else:
+                chunk = memoryview(chunk)[1:]
+        self.partial.write(index, chunk)
+
+    def finish(self):
+        """Completes the file if every chunk is in; returns the file_done reply.
+
+        Blocks while sibling streams of the same transfer are still sending.
+        """
+        if self.legacy:
+            self.msg['content'] = None
+            return None
+        partial = self.partial
+        partial.wait()
+        self.msg['content'] = None
+        if not partial.complete:
+            missing = partial.count - partial.have
+            error = f"Transfer incomplete ({missing} of {partial.count} chunks missing); partial data kept for resume"
+            self._report(error=error)
+            return self.nm._reply_frame('file_done', transfer_id=partial.transfer_id, ok=False, resume=True, error=error)
+        try:
+            partial.finish()
+        except Exception as e:
+            self.nm._drop_partial(partial)
+            self._report(error=str(e))
+            return self.nm._reply_frame('file_done', transfer_id=partial.transfer_id, ok=False, error=str(e))
+        self.nm._drop_partial(partial)
+        self._report(saved_as=partial.path)
+        return self.nm._reply_frame('file_done', transfer_id=partial.transfer_id, ok=True)
+
+    def _report(self, **result):
+        self.msg.update(result)
+        if not self.partial.claim_report():
+            # Another stream of this transfer already told the user
+            self.msg['stream_part'] = True
+
+    def _detach(self):
+        if self.attached:
+            self.attached = False
+            self.partial.detach()
+
+    def close(self, error):
+        """Records a failed connection; verified chunks stay on disk for a resume."""
+        self._detach()
+        self.msg['error'] = f"Transfer interrupted: {error}"
+        self.msg['content'] = None
+
+class OutgoingFile:
+    """Send side of a file: its manifest, and chunk frames built on demand.
+
+    Each round (first attempt or resume) gets a fresh stream prefix, so a
+    chunk that has to be resent is never encrypted under a reused nonce.
+    The file is memory-mapped, so chunks are hashed and encrypted where
+    they lie; in plaintext mode they go out with sendfile() instead.
+    """
+
+    def __init__(self, network_manager, path, codec=CODEC_NONE, chunk_size=CHUNK_SIZE):
+        self.nm = network_manager
+        self.path = path
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.count = chunk_count(self.size, chunk_size)
+        self.map = map_file(self.file, self.size)
+        self.manifest, self.file_hash = hash_chunks(self.map, self.size, chunk_size)
+        name = os.path.basename(path)
+        self.transfer_id = hashlib.sha256(self.file_hash + f"{name}:{self.size}:{chunk_size}".encode()).hexdigest()[:32]
+        self.encryptor = None
+
+    def header(self):
+        """Starts a new round; returns the PreparedMessage announcing the file."""
+        self.encryptor = self.nm.security.stream_encryptor()
+        extra = {'stream': self.encryptor.prefix.hex()} if self.encryptor else {}
+        if self.codec:
+            extra['codec'] = CODEC_NAMES[self.codec]
+        return self.nm._build_message('file', filename=os.path.basename(self.path), size=self.size,
+                                      chunk_size=self.chunk_size, transfer_id=self.transfer_id,
+                                      manifest=self.manifest.hex(), sha256=self.file_hash.hex(), **extra)
+
+    def missing(self, ack):
+        """Chunk indexes the receiver still needs, from its file_ack reply."""
+        if ack.get('type') != 'file_ack' or ack.get('transfer_id') != self.transfer_id:
+            raise ConnectionError("Unexpected reply to file offer")
+        have = decode_bitmap(ack.get('have'), self.count)
+        return {i for i in range(self.count) if not has_chunk(have, i)}
+
+    @property
+    def zero_copy(self):
+        """True when chunks can go from the file to the socket untouched."""
+        return HAS_SENDFILE and not self.encryptor and not self.codec and not self.nm.security.key
+
+    def _chunk(self, index):
+        # Touching a mapping of a file that shrank kills the process, so check first
+        if os.fstat(self.file.fileno()).st_size != self.size:
+            raise IOError("File changed while sending")
+        start = index * self.chunk_size
+        return memoryview(self.map)[start:start + min(self.chunk_size, self.size - start)]
+
+    def chunk_frame(self, index):
+        """Builds the frame for one chunk; safe to call from several streams at once."""
+        chunk = self._chunk(index)
+        if self.codec:
+            used, packed = self.nm.compressor.compress(chunk, self.codec)
+            chunk = bytes((used,)) + packed
+
+        headroom = CHUNK_HEADER.size
+        if self.encryptor:
+            frame = self.encryptor.encrypt_segment(chunk, final=index == self.count - 1, index=index, headroom=headroom)
+        else:
+            frame = self.nm.security.encrypt(chunk, headroom=headroom)
+        CHUNK_HEADER.pack_into(frame, 0, len(frame) - 4, index)
+        return frame
+
+    def chunk_range(self, index):
+        """(frame header, file offset, length) for sending a zero_copy chunk with sendfile."""
+        if os.fstat(self.file.fileno()).st_size != self.size:
+            raise IOError("File changed while sending")
+        offset = index * self.chunk_size
+        length = min(self.chunk_size, self.size - offset)
+        return CHUNK_HEADER.pack(length + INDEX.size, index), offset, length
+
+    def check_done(self, reply):
+        if reply.get('type') != 'file_done' or reply.get('transfer_id') != self.transfer_id:
+            raise ConnectionError("Unexpected reply at end of transfer")
+        if reply.get('resume'):
+            # Chunks went missing on another connection; a new round fills them in
+            raise ConnectionError(reply.get('error') or "Receiver is missing chunks")
+        if not reply.get('ok'):
+            raise IOError(reply.get('error') or "Receiver rejected the file")
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.file.close()
@@ -1,11 +1,18 @@
 import customtkinter as ctk
+import queue
 import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import base64
 import os
 from ..core.network import NetworkManager
 from ..core.security import SecurityManager
+from ..core.peers import PeerCache
+from ..core.store import MessageStore, MAX_BYTES
+
+PEER_REFRESH_MS = 200 # How often queued peer changes are applied to the list
+CHAT_REFRESH_MS = 30 # How often queued chat lines are rendered
+CHAT_BATCH = 500 # Lines rendered per refresh at most, so a flood can't freeze the UI
+SCROLLBACK_LINES = 5000 # Older chat lines are trimmed
 
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
@@ -45,7 +52,7 @@ class LoginDialog(ctk.CTkToplevel):
         self.parent.destroy()
 
 class App(ctk.CTk):
-    def __init__(self, cli_password=None, cli_username=None):
+    def __init__(self, cli_password=None, cli_username=None, engine="threads", compression="off", history_bytes=MAX_BYTES, coalesce=0.0, metrics_file=None, relay_fanout=0):
         super().__init__()
         self.withdraw() # Hide until login
 
@@ -65,7 +72,11 @@ class App(ctk.CTk):
         self.deiconify()
 
         self.security = SecurityManager(self.password)
-        self.nm = NetworkManager(self.security, self.username)
+        # Outlives the network layer, so "Restart network" can reach known peers before mDNS answers
+        self.peer_cache = PeerCache()
+        self.options = {'engine': engine, 'compression': compression, 'coalesce': coalesce, 'relay_fanout': relay_fanout}
+        self.metrics_file = metrics_file
+        self.nm = self._build_network(self.username)
         
         # Grid layout
         self.grid_columnconfigure(1, weight=1)
@@ -83,9 +94,14 @@ class App(ctk.CTk):
         self.peers_label = ctk.CTkLabel(self.sidebar_frame, text="Peers:", anchor="w")
         self.peers_label.grid(row=2, column=0, padx=20, pady=(10, 0))
         
-        self.peer_listbox = tk.Listbox(self.sidebar_frame, height=20, bg="#2b2b2b", fg="white", borderwidth=0)
+        # Ctrl/Shift-click selects several peers; messages and files go to all of them
+        self.peer_listbox = tk.Listbox(self.sidebar_frame, height=20, bg="#2b2b2b", fg="white", borderwidth=0, selectmode="extended", exportselection=False)
         self.peer_listbox.grid(row=3, column=0, padx=20, pady=10, sticky="nsew")
         self.peer_listbox.bind('<<ListboxSelect>>', self.on_peer_select)
+
+        # E.g. after switching networks; recently seen peers are tried straight away
+        self.restart_btn = ctk.CTkButton(self.sidebar_frame, text="Restart network", command=self.restart_network)
+        self.restart_btn.grid(row=4, column=0, padx=20, pady=(0, 20))
         
         # Main Chat Area
         self.chat_frame = ctk.CTkFrame(self, corner_radius=0)
@@ -109,13 +125,65 @@ class App(ctk.CTk):
         self.file_btn = ctk.CTkButton(self.input_frame, text="📎", width=40, command=self.send_file)
         self.file_btn.pack(side="right", padx=(0, 10))
 
-        self.selected_peer = None
-        self.after(1000, self.update_peers)
+        self.selected_peers = [] # (name, peer) pairs
+        self.row_ids = [] # listbox row -> peer id
+        self.peer_names = {} # peer id -> mDNS name
+        # Discovery threads queue peer changes; the Tk thread applies them
+        self.peer_events = queue.SimpleQueue()
+        self.nm.peers.subscribe(self.on_peer_event)
+        for name, peer in self.nm.peers.items():
+            self.peer_events.put(("add", name, peer))
+        self.after(PEER_REFRESH_MS, self.update_peers)
+
+        # Network threads queue chat lines and UI work; the Tk thread renders them in batches
+        self.chat_lines = queue.SimpleQueue()
+        self.ui_tasks = queue.SimpleQueue()
+        # The textbox only keeps recent scrollback; the store holds the bounded history
+        self.store = MessageStore(history_bytes)
+        self.after(CHAT_REFRESH_MS, self.render_chat)
         
         # Start Network
         self.nm.start(self.on_network_message)
 
+    def _build_network(self, username):
+        nm = NetworkManager(self.security, username, peer_cache=self.peer_cache, **self.options)
+        if self.metrics_file:
+            nm.metrics.start_dump(self.metrics_file, logger=nm.logger)
+        return nm
+
+    def restart_network(self):
+        self.restart_btn.configure(state="disabled")
+        self.chat_lines.put("[System] Restarting network...\n")
+        old = self.nm
+        old.peers.unsubscribe(self.on_peer_event)
+        # The old registry empties as it stops; that mustn't clear the cache
+        old.peers.unsubscribe(self.peer_cache.on_peer_event)
+        # Stopping waits on sockets and threads, so it runs off the Tk thread
+        threading.Thread(target=self._restart_worker, args=(old,), daemon=True).start()
+
+    def _restart_worker(self, old):
+        old.stop()
+        self.ui_tasks.put(lambda: self._network_restarted(old.username))
+
+    def _network_restarted(self, username):
+        # Changes still queued from the old registry no longer apply
+        while True:
+            try:
+                self.peer_events.get_nowait()
+            except queue.Empty:
+                break
+        for peer_id in list(self.row_ids):
+            self._remove_peer_row(peer_id)
+        self.on_peer_select()
+        self.nm = self._build_network(username)
+        # Subscribed before starting, so cached peers restored by start() show up
+        self.nm.peers.subscribe(self.on_peer_event)
+        self.nm.start(self.on_network_message)
+        self.chat_lines.put(f"[System] Network restarted on port {self.nm.port}.\n")
+        self.restart_btn.configure(state="normal")
+
     def on_network_message(self, msg):
+        # Runs on a network thread: format only, Tk renders it later
         sender_id = msg.get('sender_id', 'unknown')[:8]
         sender_name = msg.get('sender_name', sender_id)
         content = msg.get('content', '')
@@ -123,96 +191,181 @@ class App(ctk.CTk):
         
         display_text = ""
         if msg_type == 'chat':
+            self.store.add(content, msg.get('sender_id'), sender_name)
             display_text = f"[{sender_name}]: {content}\n"
         elif msg_type == 'file':
              filename = msg.get('filename', 'unknown_file')
+             self.store.add(f"sent file: {filename}", msg.get('sender_id'), sender_name, type='file')
              display_text = f"[{sender_name}] sent file: {filename}\n"
-             # Auto-save or prompt? For simplicity, auto-save to 'downloads' or current dir
-             try:
-                 file_data = base64.b64decode(content)
-                 with open(f"received_{filename}", "wb") as f:
-                     f.write(file_data)
-                 display_text += f"(Saved as received_{filename})\n"
-             except Exception as e:
-                 display_text += f"(Error saving file: {e})\n"
-             
-        self.chat_display.configure(state="normal")
-        self.chat_display.insert("end", display_text)
-        self.chat_display.configure(state="disabled")
-        self.chat_display.see("end")
+             # NetworkManager streams the file to disk as it arrives
+             if msg.get('saved_as'):
+                 display_text += f"(Saved as {msg['saved_as']})\n"
+             else:
+                 display_text += f"(Error saving file: {msg.get('error')})\n"
+
+        self.chat_lines.put(display_text)
+
+    def render_chat(self):
+        while True:
+            try:
+                task = self.ui_tasks.get_nowait()
+            except queue.Empty:
+                break
+            task()
+
+        batch = []
+        while len(batch) < CHAT_BATCH:
+            try:
+                batch.append(self.chat_lines.get_nowait())
+            except queue.Empty:
+                break
+
+        if batch:
+            # One insert, trim and scroll for the whole batch
+            self.chat_display.configure(state="normal")
+            self.chat_display.insert("end", "".join(batch))
+            lines = int(self.chat_display.index("end-1c").split(".")[0])
+            if lines > SCROLLBACK_LINES:
+                self.chat_display.delete("1.0", f"{lines - SCROLLBACK_LINES + 1}.0")
+            self.chat_display.configure(state="disabled")
+            self.chat_display.see("end")
+        self.after(CHAT_REFRESH_MS, self.render_chat)
+
+    def on_peer_event(self, event, name, peer):
+        # Called on discovery threads, so only queue it for the Tk thread
+        self.peer_events.put((event, name, peer))
 
     def update_peers(self):
-        # Refresh peer list
-        current_selection = self.peer_listbox.curselection()
-        self.peer_listbox.delete(0, "end")
-        
-        for name, data in self.nm.peers.items():
-            display_name = f"{data['username']} ({name.split('.')[0]})"
-            self.peer_listbox.insert("end", display_name)
-            
-        if current_selection:
-             try:
-                self.peer_listbox.select_set(current_selection[0])
-             except:
-                 pass
-                 
-        self.after(2000, self.update_peers)
-
-    def on_peer_select(self, event):
-        selection = self.peer_listbox.curselection()
-        if selection:
-            display_string = self.peer_listbox.get(selection[0]) # "User (AnonPeer...)"
-            # Find key in peers
-            for original_name, data in self.nm.peers.items():
-                if f"{data['username']} ({original_name.split('.')[0]})" == display_string:
-                    self.selected_peer = data
-                    break
+        # Only the latest change per peer matters, so a burst becomes one edit per row
+        changes = {}
+        while True:
+            try:
+                event, name, peer = self.peer_events.get_nowait()
+            except queue.Empty:
+                break
+            changes[name] = (event, peer)
+
+        for name, (event, peer) in changes.items():
+            if event == "remove":
+                self._remove_peer_row(peer['id'])
+            else:
+                self._set_peer_row(name, peer)
+
+        if changes:
+            self.on_peer_select()
+        self.after(PEER_REFRESH_MS, self.update_peers)
+
+    def _peer_label(self, name, peer):
+        return f"{peer['username']} ({name.split('.')[0]})"
+
+    def _set_peer_row(self, name, peer):
+        peer_id = peer['id']
+        # A peer that came back under the same name with a new id replaces its old row
+        for old_id, old_name in list(self.peer_names.items()):
+            if old_name == name and old_id != peer_id:
+                self._remove_peer_row(old_id)
+        self.peer_names[peer_id] = name
+        if peer_id not in self.row_ids:
+            self.row_ids.append(peer_id)
+            self.peer_listbox.insert("end", self._peer_label(name, peer))
+            return
+        row = self.row_ids.index(peer_id)
+        selected = self.peer_listbox.selection_includes(row)
+        self.peer_listbox.delete(row)
+        self.peer_listbox.insert(row, self._peer_label(name, peer))
+        if selected:
+            self.peer_listbox.select_set(row)
+
+    def _remove_peer_row(self, peer_id):
+        self.peer_names.pop(peer_id, None)
+        if peer_id in self.row_ids:
+            # Tk keeps the selection of the other rows as they shift up
+            self.peer_listbox.delete(self.row_ids.index(peer_id))
+            self.row_ids.remove(peer_id)
+
+    def on_peer_select(self, event=None):
+        # Rows map straight to peer ids; peers that just left are skipped
+        self.selected_peers = []
+        for index in self.peer_listbox.curselection():
+            name = self.peer_names.get(self.row_ids[index])
+            peer = self.nm.peers.get(name)
+            if peer:
+                self.selected_peers.append((name, peer))
+
+    def _failed_names(self, results):
+        return [r['username'] for r in results.values() if not r['ok']]
 
     def send_message(self, event=None):
         text = self.msg_entry.get()
         if not text:
             return
             
-        if not self.selected_peer:
+        if not self.selected_peers:
             messagebox.showwarning("Warning", "Select a peer first!")
             return
 
-        if self.nm.send_message(self.selected_peer['address'], self.selected_peer['port'], content=text):
-             self.chat_display.configure(state="normal")
-             self.chat_display.insert("end", f"[Me]: {text}\n")
-             self.chat_display.configure(state="disabled")
-             self.msg_entry.delete(0, "end")
-        else:
-             messagebox.showerror("Error", "Failed to send message.")
+        # Slow or unreachable peers would freeze the window, so the sending runs on a worker
+        peers = list(self.selected_peers)
+        threading.Thread(target=self._send_message_worker, args=(peers, text), daemon=True).start()
+
+    def _send_message_worker(self, peers, text):
+        try:
+            # Encrypted once for all recipients, or passed along a relay tree for large selections
+            results = self.nm.broadcast(text, peers)
+        except Exception as e:
+            error = f"Sending failed: {e}"
+            self.ui_tasks.put(lambda: messagebox.showerror("Error", error))
+            return
+        self.ui_tasks.put(lambda: self._message_sent(peers, text, results))
+
+    def _message_sent(self, peers, text, results):
+        for name, peer in peers:
+            if results[name]['ok']:
+                self.store.add(text, peer['id'], peer['username'], outgoing=True)
+        failed = self._failed_names(results)
+        if len(failed) < len(peers):
+            self.chat_lines.put(f"[Me]: {text}\n")
+            # Leave anything typed since then alone
+            if self.msg_entry.get() == text:
+                self.msg_entry.delete(0, "end")
+        if failed:
+            messagebox.showerror("Error", f"Failed to send message to: {', '.join(failed)}")
 
     def send_file(self):
-        if not self.selected_peer:
+        if not self.selected_peers:
             messagebox.showwarning("Warning", "Select a peer first!")
             return
             
         filename = filedialog.askopenfilename()
         if filename:
-            try:
-                with open(filename, "rb") as f:
-                    file_data = f.read()
-                    
-                encoded_data = base64.b64encode(file_data).decode('utf-8')
-                short_name = os.path.basename(filename)
-                
-                if self.nm.send_message(self.selected_peer['address'], self.selected_peer['port'], message_type='file', content=encoded_data, filename=short_name):
-                     self.chat_display.configure(state="normal")
-                     self.chat_display.insert("end", f"[Me] sent file: {short_name}\n")
-                     self.chat_display.configure(state="disabled")
-                else:
-                    messagebox.showerror("Error", "Failed to send file.")
-            except Exception as e:
-                messagebox.showerror("Error", f"File processing failed: {e}")
+            # Hashing and streaming a large file would freeze the window, so it runs on a worker
+            peers = list(self.selected_peers)
+            self.chat_lines.put(f"[Me] sending file: {os.path.basename(filename)}...\n")
+            threading.Thread(target=self._send_file_worker, args=(peers, filename), daemon=True).start()
+
+    def _send_file_worker(self, peers, filename):
+        try:
+            short_name = os.path.basename(filename)
+            results = self.nm.share_file(peers, filename)
+            for name, peer in peers:
+                if results[name]['ok']:
+                    self.store.add(f"sent file: {short_name}", peer['id'], peer['username'], type='file', outgoing=True)
+            failed = self._failed_names(results)
+            if len(failed) < len(peers):
+                self.chat_lines.put(f"[Me] sent file: {short_name}\n")
+            if failed:
+                self.ui_tasks.put(lambda: messagebox.showerror("Error", f"Failed to send file to: {', '.join(failed)}"))
+        except Exception as e:
+            error = f"File processing failed: {e}" # `e` is unbound once the handler exits
+            self.ui_tasks.put(lambda: messagebox.showerror("Error", error))
 
     def on_closing(self):
+        self.nm.peers.unsubscribe(self.on_peer_event)
         self.nm.stop()
+        self.store.wipe()
         self.destroy()
 
-def run_gui(password=None, username=None):
-    app = App(password, username)
+def run_gui(password=None, username=None, engine="threads", compression="off", history_bytes=MAX_BYTES, coalesce=0.0, metrics_file=None, relay_fanout=0):
+    app = App(password, username, engine, compression, history_bytes, coalesce, metrics_file, relay_fanout)
     app.protocol("WM_DELETE_WINDOW", app.on_closing)
     app.mainloop()
@@ -0,0 +1,87 @@
+import threading
+import time
+import pytest
+from src.core.network import NetworkManager
+from src.core.security import SecurityManager
+
+PASSWORD = "test"
+WINDOW = 0.02
+PEER = ('127.0.0.1', 9) # Never connected to; writes are intercepted
+
+class Wire:
+    """Stands in for the socket: decodes what the sender writes, in order, with the timeouts used."""
+
+    def __init__(self):
+        self.decoder = NetworkManager(SecurityManager(PASSWORD), "decoder")
+        self.received = []
+        self.decoder.msg_callback = lambda msg: self.received.append(msg['content'])
+        self.writes = [] # (connect_timeout, send_timeout) per frame
+        self.fail = False
+        self.stall = 0.0
+
+    def write(self, address, frame, connect_timeout=None, send_timeout=None):
+        self.writes.append((connect_timeout, send_timeout))
+        if self.stall:
+            time.sleep(self.stall)
+        if self.fail:
+            raise ConnectionResetError("peer went away")
+        self.decoder._process_frame(bytes(frame[4:]))
+
+@pytest.fixture
+def sender():
+    nm = NetworkManager(SecurityManager(PASSWORD), "sender", coalesce=WINDOW)
+    nm.peers.add("peer", {'address': PEER[0], 'port': PEER[1], 'id': 'peer', 'username': "peer",
+                          'wire': 'bin1', 'codecs': set(), 'batch': True, 'multi': True})
+    nm.wire = Wire()
+    nm._write_frame = nm.wire.write
+    nm.start(lambda msg: None, discovery=False)
+    yield nm
+    nm.stop()
+    nm.wire.decoder.stop()
+
+def test_burst_arrives_in_order_in_fewer_frames(sender):
+    sent = [f"message {i}" for i in range(200)]
+    for text in sent:
+        assert sender.send_message(*PEER, content=text, wait=False)
+    sender.coalescer.stop() # Flushes whatever is still held
+    assert sender.wire.received == sent
+    assert len(sender.wire.writes) < len(sent)
+
+def test_concurrent_senders_wait_for_their_batch(sender):
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(sender.send_message(*PEER, content=f"m{i}")))
+               for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Each send returned only once its message had been written
+    assert all(results) and sorted(sender.wire.received) == sorted(f"m{i}" for i in range(20))
+
+def test_failed_batch_is_reported_to_the_sender(sender):
+    assert sender.send_message(*PEER, content="first") # idle peer: written at once
+    sender.wire.fail = True
+    assert not sender.send_message(*PEER, content="queued")
+    report = sender.send_prepared_to_peers(sender.peers.items(), sender.prepare_message('chat', "again"))
+    assert not report['peer']['ok']
+
+def test_batch_is_written_with_the_tightest_timeouts(sender):
+    sender._send_frame(*PEER, sender.prepare_message('chat', "first"), 3.0, 3.0)
+    for connect_timeout, send_timeout in ((2.0, 5.0), (4.0, 1.5), (None, None)):
+        sender._send_frame(*PEER, sender.prepare_message('chat', "queued"), connect_timeout, send_timeout, wait=False)
+    sender.coalescer.stop()
+    assert sender.wire.writes == [(3.0, 3.0), (2.0, 1.5)]
+
+def test_waiting_for_a_stalled_batch_is_bounded(sender):
+    sender._send_frame(*PEER, sender.prepare_message('chat', "first"), 0.05, 0.05)
+    sender.wire.stall = 2.0
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        sender._send_frame(*PEER, sender.prepare_message('chat', "stalled"), 0.05, 0.05)
+    assert time.monotonic() - start < 1.0
+
+def test_sends_after_stop_are_written_directly(sender):
+    sender.coalescer.stop()
+    for i in range(3):
+        assert sender.send_message(*PEER, content=f"late {i}")
+    assert sender.wire.received == ["late 0", "late 1", "late 2"]
@@ -0,0 +1,68 @@
+import threading
+import pytest
+from src.core.inbound import DecodePool, InboundLimiter, Overloaded
+
+def test_admit_enforces_global_and_per_peer_caps():
+    limiter = InboundLimiter(max_connections=3, max_peer_connections=2)
+    assert limiter.admit("a") and limiter.admit("a")
+    assert not limiter.admit("a")
+    assert limiter.admit("b")
+    assert not limiter.admit("c")
+    limiter.release("a")
+    assert limiter.admit("c")
+    summary = limiter.summary()
+    assert summary['connections'] == 3 and summary['accepted'] == 4
+    assert summary['dropped']['connections'] == 2
+
+def test_release_frees_the_peer_slot():
+    limiter = InboundLimiter(max_peer_connections=1)
+    for _ in range(5):
+        assert limiter.admit("a")
+        limiter.release("a")
+    assert limiter.summary()['connections'] == 0
+
+def test_reserve_sheds_frames_over_the_byte_budget():
+    limiter = InboundLimiter(max_inflight_bytes=1000)
+    limiter.reserve(600)
+    with pytest.raises(Overloaded):
+        limiter.reserve(500)
+    assert limiter.dropped['memory'] == 1
+    limiter.free(600)
+    limiter.reserve(1000)
+    assert limiter.summary()['inflight_bytes'] == 1000
+
+def test_throttle_allows_the_burst_then_delays():
+    limiter = InboundLimiter(peer_rate=10.0, peer_burst=5)
+    assert [limiter.throttle("a") for _ in range(5)] == [0.0] * 5
+    delay = limiter.throttle("a")
+    assert 0.05 < delay <= 0.1
+    assert limiter.throttle("b") == 0.0 # buckets are per address
+    assert limiter.throttled == 1
+
+def test_none_disables_limits():
+    limiter = InboundLimiter(None, None, None, None, None)
+    assert all(limiter.admit("a") for _ in range(1000))
+    assert all(limiter.throttle("a") == 0.0 for _ in range(1000))
+    limiter.reserve(1 << 40)
+    limiter.shed('queue')
+    assert limiter.dropped == {'connections': 0, 'queue': 1, 'memory': 0}
+
+def test_decode_pool_runs_work_and_sheds_when_full():
+    pool = DecodePool(workers=1, queue_size=2)
+    pool.start()
+    try:
+        assert pool.submit(sum, [1, 2, 3]).result(timeout=5) == 6
+        with pytest.raises(ZeroDivisionError):
+            pool.submit(lambda: 1 / 0).result(timeout=5)
+
+        gate = threading.Event()
+        started = threading.Event()
+        busy = pool.submit(lambda: (started.set(), gate.wait(5)))
+        started.wait(5)
+        queued = [pool.submit(int, "7") for _ in range(2)]
+        with pytest.raises(Overloaded):
+            pool.submit(int, "8")
+        gate.set()
+        assert busy.result(timeout=5)[1] and [f.result(timeout=5) for f in queued] == [7, 7]
+    finally:
+        pool.stop()
@@ -0,0 +1,65 @@
+import os
+import uuid
+import pytest
+from src.core import protocol
+from src.core.compression import CODEC_LZ4, CODEC_ZLIB, Compressor
+
+SENDER = str(uuid.uuid4())
+
+def message(**fields):
+    msg = {'sender_id': SENDER, 'sender_name': 'Alïce', 'type': 'chat', 'content': 'hello there', 'filename': None, 'timestamp': 1700000000.25}
+    msg.update(fields)
+    return msg
+
+@pytest.mark.parametrize("msg", [
+    message(),
+    message(content=''),
+    message(type='file', content=os.urandom(3000), filename='photo.jpg'),
+    message(type='file', content=None, filename='empty.bin', transfer_id='abc', chunk=3, total=9),
+])
+def test_envelopes_round_trip(msg):
+    binary = protocol.encode(msg, protocol.WIRE_BINARY)
+    assert protocol.is_binary(binary)
+    assert protocol.decode(binary) == msg
+    as_json = protocol.encode(msg, protocol.WIRE_JSON) if msg['type'] == 'chat' else None
+    if as_json is not None:
+        assert not protocol.is_binary(as_json)
+        assert protocol.decode(as_json) == msg
+
+@pytest.mark.parametrize("codec", [CODEC_ZLIB, CODEC_LZ4])
+def test_compressed_round_trip(codec):
+    compressor = Compressor("zlib")
+    msg = message(content="the same words again and again " * 500)
+    binary = protocol.encode(msg, protocol.WIRE_BINARY, compressor, codec)
+    assert len(binary) < len(msg['content']) // 4
+    assert protocol.decode(binary) == msg
+
+def test_decompression_is_bounded():
+    msg = message(content="x" * 100000)
+    binary = protocol.encode(msg, protocol.WIRE_BINARY, Compressor("zlib"), CODEC_ZLIB)
+    with pytest.raises(ValueError):
+        protocol.decode(binary, max_content=1000)
+
+def test_messages_binary_cant_carry_fall_back_to_json():
+    for msg in (message(sender_id='not-a-uuid'), message(type='ping')):
+        data = protocol.encode(msg, protocol.WIRE_BINARY)
+        assert not protocol.is_binary(data)
+        assert protocol.decode(data) == msg
+
+def test_malformed_envelopes_are_rejected():
+    binary = protocol.encode(message(), protocol.WIRE_BINARY)
+    for bad in (binary[:10], binary[:-1], binary + b'!'):
+        with pytest.raises(ValueError):
+            protocol.decode(bad)
+    wrong_version = bytearray(binary)
+    wrong_version[2] = 99
+    with pytest.raises(ValueError):
+        protocol.decode(wrong_version)
+
+def test_batch_round_trip():
+    payloads = [protocol.encode(message(content=f"#{i}"), wire) for i, wire in enumerate([protocol.WIRE_BINARY, protocol.WIRE_JSON, protocol.WIRE_BINARY])]
+    batch = protocol.encode_batch(payloads)
+    assert protocol.is_batch(batch) and not protocol.is_binary(batch)
+    assert [protocol.decode(p)['content'] for p in protocol.split_batch(batch)] == ["#0", "#1", "#2"]
+    with pytest.raises(ValueError):
+        protocol.split_batch(batch[:-1])
@@ -0,0 +1,54 @@
+import threading
+import time
+from src.core.network import NetworkManager, BROADCAST_CONNECT_TIMEOUT, BROADCAST_SEND_TIMEOUT
+from src.core.relay import split
+from src.core.security import SecurityManager
+
+def relaying_manager(peer_count, dead=()):
+    """A manager that knows `peer_count` relaying peers; sends are recorded, and sends to `dead` hang then fail."""
+    nm = NetworkManager(SecurityManager("test"), "origin", relay_fanout=3)
+    nm.running = True
+    for i in range(peer_count):
+        nm.peers.add(f"p{i}", {'address': '127.0.0.1', 'port': 20000 + i, 'id': f"id{i:03d}", 'username': f"p{i}",
+                               'wire': 'bin1', 'codecs': set(), 'relay': True, 'multi': True})
+    nm.sent = [] # (peer id, seconds after the first send, connect_timeout, send_timeout)
+    lock = threading.Lock()
+    start = []
+
+    def send(ip, port, frame, connect_timeout=None, send_timeout=None, wait=True):
+        peer_id = nm.peers.by_endpoint((ip, port))['id']
+        with lock:
+            start.append(time.monotonic())
+            nm.sent.append((peer_id, time.monotonic() - start[0], connect_timeout, send_timeout))
+        if peer_id in dead:
+            time.sleep(0.5)
+            raise ConnectionRefusedError("gone")
+
+    nm._send_frame = send
+    return nm
+
+def test_split_covers_every_peer_once():
+    ids = [f"id{i}" for i in range(10)]
+    chunks = split(ids, 3)
+    assert len(chunks) == 3 and sum(chunks, []) == ids
+
+def test_forward_uses_broadcast_timeouts_and_skips_dead_peers_concurrently():
+    nm = relaying_manager(9, dead={"id000"})
+    relay_to = [f"id{i:03d}" for i in range(9)]
+    nm.relay._forward({'relay_id': "r1", 'type': 'chat', 'content': "hi"}, relay_to, 3)
+    firsts = {peer_id: (at, ct, st) for peer_id, at, ct, st in nm.sent}
+    # The other chunks' heads were reached without waiting for the dead one
+    assert firsts["id003"][0] < 0.3 and firsts["id006"][0] < 0.3
+    # Its neighbour took over its chunk
+    assert "id001" in firsts and nm.relay.lost == 1
+    assert all((ct, st) == (BROADCAST_CONNECT_TIMEOUT, BROADCAST_SEND_TIMEOUT) for _, ct, st in firsts.values())
+    nm.relay.stop()
+    nm.stop()
+
+def test_broadcast_reports_every_peer():
+    nm = relaying_manager(10, dead={"id004"})
+    results = nm.broadcast("hello")
+    assert len(results) == 10
+    assert not results["p4"]['ok'] and sum(r['ok'] for r in results.values()) == 9
+    nm.relay.stop()
+    nm.stop()
@@ -0,0 +1,83 @@
+import random
+import string
+import tracemalloc
+import pytest
+from src.core.store import MessageStore
+
+CAP = 1024 * 1024
+
+def random_words(rng, count=12):
+    return ' '.join(''.join(rng.choices(string.ascii_lowercase, k=6)) for _ in range(count))
+
+def measured(fill):
+    """Heap bytes held by a store capped at CAP after fill(store), as tracemalloc sees them."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        store = MessageStore(CAP)
+        fill(store)
+        return tracemalloc.get_traced_memory()[0] - before, store
+    finally:
+        tracemalloc.stop()
+
+def test_memory_stays_under_the_cap_with_distinct_words():
+    rng = random.Random(1)
+
+    def fill(store):
+        for i in range(6000):
+            store.add(random_words(rng), peer_id=f"peer{i % 5}")
+
+    used, store = measured(fill)
+    assert store.bytes_used <= CAP
+    assert used <= CAP * 1.15, f"{used} bytes held for a {CAP} byte cap"
+
+def test_memory_stays_under_the_cap_with_a_small_vocabulary():
+    rng = random.Random(2)
+    vocabulary = [''.join(rng.choices(string.ascii_lowercase, k=6)) for _ in range(1000)]
+
+    def fill(store):
+        for i in range(6000):
+            store.add(' '.join(rng.choices(vocabulary, k=12)) + f" token{i}", peer_id=f"peer{i % 5}")
+
+    used, store = measured(fill)
+    assert store.bytes_used <= CAP
+    assert used <= CAP * 1.15, f"{used} bytes held for a {CAP} byte cap"
+
+def test_eviction_drops_the_oldest_and_zeroes_it():
+    store = MessageStore(max_messages=2)
+    first = store.add("alpha one", peer_id="a")
+    store.add("beta two", peer_id="b")
+    store.add("gamma three", peer_id="a")
+    assert [m.text for m in store.history()] == ["beta two", "gamma three"]
+    assert [m.text for m in store.history("a")] == ["gamma three"]
+    assert not store.search("alpha")
+    assert first.body == bytearray()
+
+def test_accounting_returns_to_zero():
+    store = MessageStore(max_messages=3)
+    for i in range(50):
+        store.add(f"message {i} with words", peer_id=f"p{i % 4}")
+    while store._messages:
+        store._evict()
+    assert store.bytes_used == 0 and not store._by_word and not store._by_peer
+
+def test_search_uses_words_and_substrings():
+    store = MessageStore()
+    store.add("Meet at the harbour", peer_id="a")
+    store.add("harbourmaster says hi", peer_id="b")
+    assert [m.text for m in store.search("HARBOUR")] == ["Meet at the harbour"]
+    assert [m.text for m in store.search("bourmas")] == ["harbourmaster says hi"]
+
+def test_wipe_zeroes_every_message():
+    store = MessageStore()
+    messages = [store.add(f"secret {i}") for i in range(10)]
+    bodies = [m.body for m in messages]
+    store.wipe()
+    assert len(store) == 0 and store.bytes_used == 0
+    assert all(body == bytearray() for body in bodies)
+    assert not store.search("secret")
+
+@pytest.mark.parametrize("text", ["", "ünïcødé wörds"])
+def test_odd_text_round_trips(text):
+    store = MessageStore()
+    assert store.add(text).text == text
@@ -0,0 +1,119 @@
+import os
+import time
+import pytest
+from src.core import network
+from src.core.network import NetworkManager, ack_timeout, REPLY_TIMEOUT
+from src.core.security import SecurityManager
+from src.core.transfer import PartialFile, OutgoingFile, CHUNK_SIZE
+
+PASSWORD = "test"
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.bin"
+    path.write_bytes(os.urandom(5 * CHUNK_SIZE + 1234)) # six chunks, the last one short
+    return str(path)
+
+@pytest.fixture
+def managers(tmp_path):
+    receiver = NetworkManager(SecurityManager(PASSWORD), "receiver")
+    receiver.download_dir = str(tmp_path / "downloads")
+    os.mkdir(receiver.download_dir)
+    sender = NetworkManager(SecurityManager(PASSWORD), "sender")
+    receiver.start(lambda msg: None, discovery=False)
+    yield sender, receiver
+    sender.stop()
+    receiver.stop()
+
+def offer(nm, path):
+    outgoing = OutgoingFile(nm, path)
+    try:
+        return outgoing.header().msg
+    finally:
+        outgoing.close()
+
+def leave_chunks(download_dir, msg, source, indexes):
+    # What an interrupted earlier transfer leaves behind
+    partial = PartialFile(download_dir, msg)
+    partial.open()
+    with open(source, "rb") as f:
+        data = f.read()
+    for index in indexes:
+        partial.write(index, data[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE])
+    partial.close()
+
+def test_resume_finds_chunks_left_on_disk(tmp_path, source):
+    nm = NetworkManager(SecurityManager(PASSWORD))
+    msg = offer(nm, source)
+    leave_chunks(str(tmp_path), msg, source, [0, 2, 5])
+
+    partial = PartialFile(str(tmp_path), msg)
+    partial.open()
+    assert not partial.scanned and partial.have == 0
+    partial.verify()
+    assert partial.have == 3
+    partial.close()
+
+def test_resume_sends_only_missing_chunks(managers, source):
+    sender, receiver = managers
+    leave_chunks(receiver.download_dir, offer(sender, source), source, [0, 1, 2, 3])
+
+    assert sender.send_file('127.0.0.1', receiver.port, source)
+    with open(source, "rb") as f, open(os.path.join(receiver.download_dir, "received_source.bin"), "rb") as g:
+        assert f.read() == g.read()
+    # Only chunk 4, the short last chunk and some framing went out
+    sent = sender.metrics.summary()['peers']['127.0.0.1']['out']
+    assert CHUNK_SIZE + 1234 < sent < 2 * CHUNK_SIZE
+
+def test_get_partial_leaves_hashing_to_the_caller(managers, source):
+    sender, receiver = managers
+    msg = offer(sender, source)
+    leave_chunks(receiver.download_dir, msg, source, [1])
+
+    partial = receiver._get_partial(msg)
+    # Other offers can go ahead while this one re-hashes
+    assert not partial.scanned and receiver._partials_lock.acquire(blocking=False)
+    receiver._partials_lock.release()
+    partial.verify()
+    assert partial.have == 1 and partial.active == 1
+    partial.detach()
+
+def test_ack_timeout_grows_with_size():
+    assert ack_timeout(0) == REPLY_TIMEOUT
+    assert ack_timeout(10 * 1024 ** 3) > ack_timeout(1024 ** 3) > REPLY_TIMEOUT
+
+def test_malformed_transfer_id_is_refused(tmp_path, source):
+    msg = dict(offer(NetworkManager(SecurityManager(PASSWORD)), source), transfer_id="../../" + "a" * 26)
+    with pytest.raises(ValueError):
+        PartialFile(str(tmp_path), msg)
+
+def test_chunk_size_is_bounded(tmp_path, source):
+    msg = dict(offer(NetworkManager(SecurityManager(PASSWORD)), source), chunk_size=2 ** 32 - 64)
+    with pytest.raises(ValueError):
+        PartialFile(str(tmp_path), msg)
+
+def small_offer(i):
+    return {'transfer_id': f"{i:032x}", 'filename': f"f{i}", 'size': 10, 'chunk_size': 4,
+            'manifest': '00' * 96, 'sha256': '00' * 32}
+
+def test_partials_are_bounded_and_expire(tmp_path, monkeypatch):
+    monkeypatch.setattr(network, 'MAX_PARTIALS', 2)
+    nm = NetworkManager(SecurityManager(None))
+    nm.download_dir = str(tmp_path)
+    first, second = nm._get_partial(small_offer(0)), nm._get_partial(small_offer(1))
+    with pytest.raises(ValueError):
+        nm._get_partial(small_offer(2)) # both still attached
+
+    first.detach()
+    time.sleep(0.01)
+    third = nm._get_partial(small_offer(2))
+    assert first.map is None and set(nm.partials) == {f"{1:032x}", f"{2:032x}"}
+
+    second.detach()
+    third.detach()
+    monkeypatch.setattr(network, 'PARTIAL_IDLE_TIMEOUT', 0.0)
+    time.sleep(0.01)
+    nm._expire_partials()
+    assert not nm.partials and second.file is None
+    # The data stays on disk for a later resume
+    assert any(name.endswith(".part") for name in os.listdir(tmp_path))